@@ -0,0 +1,85 @@
+"""
+Session management for the API.
+
+FastAPI routes take their session from a dependency instead of opening and
+closing SessionLocal() by hand, so it is always closed, even when the handler
+raises. get_db yields an AsyncSession on an asyncpg engine, so queries no longer
+block the event loop. Sync-only code (enqueue, search ranking, ...) can run on
+it without blocking via `await db.run_sync(fn)`. Syncs that drive the sync
+service classes are handed to the ingestion queue instead of running in a handler.
+"""
+import os
+from typing import AsyncIterator, Optional
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from app.models import DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING
+from app.utils.db_pool import InstrumentedAsyncQueuePool
+
+# Separate from DB_POOL_SIZE: the async pool only serves API requests, the sync
+# pool everything else. A process can hold up to the sum of both pools.
+DB_ASYNC_POOL_SIZE = int(os.getenv("DB_ASYNC_POOL_SIZE", "5"))
+DB_ASYNC_MAX_OVERFLOW = int(os.getenv("DB_ASYNC_MAX_OVERFLOW", "5"))
+
+_async_engine: Optional[AsyncEngine] = None
+_async_sessionmaker: Optional[async_sessionmaker] = None
+
+def async_database_url(db_url: str):
+    """
+    DATABASE_URL rewritten for asyncpg. libpq's sslmode is not understood by
+    asyncpg, so it is moved into connect_args as `ssl` (same mode names).
+    Returns (url, connect_args).
+    """
+    url = make_url(db_url)
+    query = dict(url.query)
+    connect_args = {}
+    sslmode = query.pop("sslmode", None)
+    if sslmode:
+        connect_args["ssl"] = sslmode
+    return url.set(drivername="postgresql+asyncpg", query=query), connect_args
+
+def get_async_engine() -> AsyncEngine:
+    """The process-wide async engine, created on first use (workers and scripts never need it)."""
+    global _async_engine
+    if _async_engine is None:
+        db_url = os.getenv("DATABASE_URL")
+        if not db_url:
+            raise ValueError("DATABASE_URL not set")
+        url, connect_args = async_database_url(db_url)
+        _async_engine = create_async_engine(
+            url,
+            connect_args=connect_args,
+            poolclass=InstrumentedAsyncQueuePool,
+            pool_size=DB_ASYNC_POOL_SIZE,
+            max_overflow=DB_ASYNC_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+            pool_use_lifo=True
+        )
+        # No pgvector.asyncpg codec: the Vector column type already binds '[x,y,...]'
+        # strings, which asyncpg sends through the default text codec.
+    return _async_engine
+
+def get_async_sessionmaker() -> async_sessionmaker:
+    global _async_sessionmaker
+    if _async_sessionmaker is None:
+        # expire_on_commit=False: handlers return ORM rows after committing
+        _async_sessionmaker = async_sessionmaker(get_async_engine(), expire_on_commit=False, autoflush=False)
+    return _async_sessionmaker
+
+async def dispose_async_engine():
+    global _async_engine, _async_sessionmaker
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+        _async_sessionmaker = None
+
+async def get_db() -> AsyncIterator[AsyncSession]:
+    """FastAPI dependency: one AsyncSession per request, rolled back if the handler fails."""
+    async with get_async_sessionmaker()() as session:
+        try:
+            yield session
+        except Exception:
+            await session.rollback()
+            raise
+
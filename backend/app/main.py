@@ -1,17 +1,31 @@
-from fastapi import FastAPI, BackgroundTasks, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.responses import RedirectResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, Dict, Any, List
 import uvicorn
 import httpx
-from app.services.deepseek import DeepSeekService
-from app.services.ingestion import process_ingestion
+from app.services.deepseek import DeepSeekService, close_llm_http_client, bypass_summary_cache
+from app.services.ingestion_queue import enqueue, IngestionWorkerPool, INGESTION_WORKERS
+from app.services.ingestion import GMAIL_DIRECT_PLATFORM
 from app.services.gmail_direct import GmailDirectService
+from app.services.config_cache import get_setting
+from app.services.nango import NANGO_SYNC_CONCURRENCY, NANGO_API_BASE, SYNC_CONFIG_ENDPOINTS
+from app.services.search import SemanticSearch, SEARCH_KINDS
+from app.services.registry import reset_services, get_deepseek_service
+from app.services.positioning import get_playbook_index, refresh_playbook_index, stream_positioning
+from app.services.vector_index import ensure_vector_indexes, ensure_fts_indexes
 from app.models import get_db_engine, IngestionAuditLog, init_db, SessionLocal, SystemConfig, Playbook, PendingAction
-from sqlalchemy.orm import sessionmaker
+from app.database import get_db, get_async_engine, get_async_sessionmaker, dispose_async_engine
+from app.utils import metrics
+from app.utils.db_pool import pool_status
+from app.services.agent import AGENT_THREAD_WORKERS
+from sqlalchemy import text, select
+from sqlalchemy.ext.asyncio import AsyncSession
 import asyncio
+import time
 import os
+from datetime import datetime
 import uuid
 import logging
 
@@ -20,6 +34,7 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Project Compass API")
+ingestion_workers: Optional[IngestionWorkerPool] = None
 
 @app.on_event("startup")
 async def startup_event():
@@ -30,6 +45,42 @@ async def startup_event():
     except Exception as e:
         logger.error(f"[Compass] Database initialization failed: {e}")
 
+    asyncio.create_task(warm_playbook_index())
+    asyncio.create_task(build_missing_indexes())
+
+    # In-process ingestion workers; the Procfile sets INGESTION_WORKERS=0 here and
+    # leaves the queue to its `worker` process (scripts/ingestion_worker.py)
+    global ingestion_workers
+    if INGESTION_WORKERS > 0:
+        ingestion_workers = IngestionWorkerPool(INGESTION_WORKERS)
+        ingestion_workers.start()
+
+async def warm_playbook_index():
+    """Build the playbook chunk index before the first /meeting/positioning call."""
+    try:
+        async with get_async_sessionmaker()() as db:
+            await get_playbook_index(db)
+    except Exception as e:
+        logger.error(f"[Compass] Playbook index warm-up failed: {e}")
+
+async def build_missing_indexes():
+    """Create missing vector and full-text indexes (CONCURRENTLY) without holding up startup."""
+    try:
+        await asyncio.to_thread(ensure_fts_indexes, get_db_engine())
+    except Exception as e:
+        logger.error(f"[Compass] Full-text index build failed: {e}")
+    try:
+        await asyncio.to_thread(ensure_vector_indexes, get_db_engine())
+    except Exception as e:
+        logger.error(f"[Compass] Vector index build failed: {e}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if ingestion_workers:
+        await ingestion_workers.stop()
+    await close_llm_http_client()
+    await dispose_async_engine()
+
 # Pydantic models for API
 class ConfigUpdate(BaseModel):
     key: str
@@ -54,81 +105,132 @@ class MeetingText(BaseModel):
 async def root():
     return {"message": "Welcome to Project Compass API"}
 
+@app.get("/metrics")
+async def get_metrics():
+    """In-process counters and latency summaries (LLM calls, tokens, ...)"""
+    return metrics.snapshot()
+
+@app.get("/health/db")
+async def db_health():
+    """Round-trip latency and pool stats, for sizing DB_POOL_SIZE against the worker count."""
+    started = time.perf_counter()
+    try:
+        async with get_async_engine().connect() as conn:
+            await conn.execute(text("SELECT 1"))
+        status, error = "ok", None
+    except Exception as e:
+        status, error = "error", str(e)
+    body = {
+        "status": status,
+        "error": error,
+        "latency_ms": round((time.perf_counter() - started) * 1000, 2),
+        "pool": pool_status(get_db_engine()),
+        "async_pool": pool_status(get_async_engine()),
+        "checkout_wait_ms": metrics.snapshot()["summaries"].get("db.pool.checkout_wait_ms"),
+        "async_checkout_wait_ms": metrics.snapshot()["summaries"].get("db.async_pool.checkout_wait_ms"),
+        "workers": {
+            "ingestion_workers": INGESTION_WORKERS,
+            "agent_thread_workers": AGENT_THREAD_WORKERS,
+            "nango_sync_concurrency": NANGO_SYNC_CONCURRENCY
+        }
+    }
+    return JSONResponse(body, status_code=200 if status == "ok" else 503)
+
+@app.get("/search")
+async def search(q: str, kinds: Optional[str] = None, source: Optional[str] = None, entity_id: Optional[str] = None,
+                 start: Optional[datetime] = None, end: Optional[datetime] = None, limit: int = 20, offset: int = 0,
+                 probes: Optional[int] = None, ef_search: Optional[int] = None, mode: str = "hybrid",
+                 db: AsyncSession = Depends(get_db)):
+    """
+    Hybrid semantic + full-text search across threads, messages and meetings.
+    kinds is a comma-separated subset of threads,messages,meetings.
+    """
+    if mode not in ("hybrid", "vector", "text"):
+        raise HTTPException(status_code=400, detail="mode must be hybrid, vector or text")
+    selected = [k for k in (kinds.split(",") if kinds else SEARCH_KINDS) if k in SEARCH_KINDS]
+    return await SemanticSearch(db).search(
+        q, kinds=selected, source=source, entity_id=entity_id, start=start, end=end,
+        limit=min(max(limit, 1), 100), offset=max(offset, 0), probes=probes, ef_search=ef_search, mode=mode
+    )
+
+@app.post("/meeting/positioning")
+async def meeting_positioning(data: MeetingText, db: AsyncSession = Depends(get_db)):
+    """
+    Stream positioning advice for a live meeting transcript segment as SSE:
+    one word per event, [CONFLICT] first on a playbook violation, [DONE] last.
+    """
+    received_at = time.perf_counter()
+    index = await get_playbook_index(db)
+    # The session is not needed while streaming; give the connection back now
+    await db.close()
+    return StreamingResponse(
+        stream_positioning(data.text, index, get_deepseek_service(), received_at),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/config")
-async def get_config():
-    db = SessionLocal()
-    configs = db.query(SystemConfig).all()
-    db.close()
+async def get_config(db: AsyncSession = Depends(get_db)):
+    configs = (await db.scalars(select(SystemConfig))).all()
     return {c.key: c.value for c in configs}
 
 @app.post("/config")
-async def update_config(data: ConfigUpdate):
-    db = SessionLocal()
-    config = db.query(SystemConfig).filter(SystemConfig.key == data.key).first()
+async def update_config(data: ConfigUpdate, db: AsyncSession = Depends(get_db)):
+    config = await db.get(SystemConfig, data.key)
     if not config:
         config = SystemConfig(key=data.key, value=data.value)
         db.add(config)
     else:
         config.value = data.value
-    db.commit()
-    db.close()
+    await db.commit()
+    # Rebuild cached config and LLM client so the change applies without a restart
+    reset_services()
     return {"status": "updated"}
 
 @app.get("/playbook")
-async def get_playbook():
-    db = SessionLocal()
-    playbook = db.query(Playbook).filter(Playbook.is_active == True).first()
-    db.close()
+async def get_playbook(db: AsyncSession = Depends(get_db)):
+    playbook = (await db.scalars(select(Playbook).where(Playbook.is_active == True).limit(1))).first()
     if playbook:
         return {"content": playbook.content}
     return {"content": "# Strategic Playbook\n\nDefine your strategic principles here..."}
 
 @app.post("/playbook")
-async def update_playbook(data: PlaybookUpdate):
-    db = SessionLocal()
-    playbook = db.query(Playbook).filter(Playbook.is_active == True).first()
+async def update_playbook(data: PlaybookUpdate, db: AsyncSession = Depends(get_db)):
+    playbook = (await db.scalars(select(Playbook).where(Playbook.is_active == True).limit(1))).first()
     if not playbook:
         playbook = Playbook(content=data.content)
         db.add(playbook)
     else:
         playbook.content = data.content
-    db.commit()
-    db.close()
+    await db.commit()
+    # Re-chunk and re-embed in the background so the next positioning call is fast
+    asyncio.create_task(refresh_playbook_index(data.content))
     return {"status": "updated"}
 
 @app.get("/actions")
-async def list_pending_actions():
-    db = SessionLocal()
-    actions = db.query(PendingAction).filter(PendingAction.status == 'pending').order_by(PendingAction.created_at.desc()).all()
-    db.close()
-    return actions
+async def list_pending_actions(db: AsyncSession = Depends(get_db)):
+    return (await db.scalars(
+        select(PendingAction).where(PendingAction.status == 'pending').order_by(PendingAction.created_at.desc())
+    )).all()
 
 @app.post("/actions/{action_id}")
-async def update_action_status(action_id: str, data: Dict[str, str]):
-    db = SessionLocal()
-    action = db.query(PendingAction).filter(PendingAction.id == action_id).first()
+async def update_action_status(action_id: str, data: Dict[str, str], db: AsyncSession = Depends(get_db)):
+    try:
+        action = await db.get(PendingAction, uuid.UUID(action_id))
+    except ValueError:
+        action = None
     if not action:
-        db.close()
         raise HTTPException(status_code=404, detail="Action not found")
     
     action.status = data.get("status", "pending")
-    db.commit()
-    db.close()
+    await db.commit()
     return {"status": "updated"}
 
 @app.get("/nango/debug-all-syncs")
 async def debug_all_nango_syncs():
-    db = SessionLocal()
-    nango_secret_entry = db.query(SystemConfig).filter(SystemConfig.key == "NANGO_SECRET_KEY").first()
-    db.close()
-    nango_secret = nango_secret_entry.value if nango_secret_entry else os.getenv("NANGO_SECRET_KEY")
+    nango_secret = get_setting("NANGO_SECRET_KEY")
     
-    endpoints = [
-        "https://api.nango.dev/sync/configurations",
-        "https://api.nango.dev/sync-configs",
-        "https://api.nango.dev/sync/status",
-        "https://api.nango.dev/sync/definitions"
-    ]
+    endpoints = [f"{NANGO_API_BASE}{path}" for path in SYNC_CONFIG_ENDPOINTS]
     
     results = {}
     async with httpx.AsyncClient() as client:
@@ -144,51 +246,54 @@ async def debug_all_nango_syncs():
     return results
 
 @app.post("/nango/manual-sync")
-async def manual_nango_sync():
+async def manual_nango_sync(refresh: bool = False):
+    """Sync every Nango connection. refresh=true re-summarizes instead of using the summary cache."""
     from app.services.gmail import GmailService
     from app.services.slack import SlackService
     
-    db = SessionLocal()
-    nango_secret_entry = db.query(SystemConfig).filter(SystemConfig.key == "NANGO_SECRET_KEY").first()
-    nango_secret = nango_secret_entry.value if nango_secret_entry else os.getenv("NANGO_SECRET_KEY")
+    nango_secret = get_setting("NANGO_SECRET_KEY")
     
     if not nango_secret:
-        db.close()
         return {"error": "NANGO_SECRET_KEY_MISSING"}
 
     async with httpx.AsyncClient() as client:
         conn_res = await client.get("https://api.nango.dev/connection", headers={"Authorization": f"Bearer {nango_secret}"})
         conns = conn_res.json().get("connections", [])
-        
-        results = []
-        for conn in conns:
-            cid = conn["connection_id"]
-            platform = conn["provider_config_key"]
-            
-            if "google-mail" in platform:
-                service = GmailService(db)
-                # Try multiple possible model names for Gmail
-                for model in ["Message", "Thread", "gmail-sync", "emails", "google-mail"]:
-                    res = await service.sync_gmail_threads(cid, model=model)
-                    results.append({"platform": platform, "model": model, "result": res})
-            elif "slack" in platform:
-                service = SlackService(db)
-                res = await service.sync_slack_messages(cid)
-                results.append({"platform": platform, "result": res})
-        
-        db.close()
-        return {"status": "manual_sync_completed", "details": results}
+
+    semaphore = asyncio.Semaphore(NANGO_SYNC_CONCURRENCY)
+
+    async def sync_connection(conn):
+        cid = conn["connection_id"]
+        platform = conn["provider_config_key"]
+        if "google-mail" not in platform and "slack" not in platform:
+            return None
+        async with semaphore:
+            # Each concurrent sync gets its own session
+            db = SessionLocal()
+            try:
+                if "google-mail" in platform:
+                    # The working model is discovered once per connection and cached
+                    res = await GmailService(db).sync_gmail_threads(cid, provider_config_key=platform)
+                else:
+                    res = await SlackService(db).sync_slack_messages(cid)
+                return {"platform": platform, "connection_id": cid, "result": res}
+            except Exception as e:
+                logger.error(f"[Compass] Manual sync failed for {platform}/{cid}: {e}")
+                return {"platform": platform, "connection_id": cid, "error": str(e)}
+            finally:
+                db.close()
+
+    # Tasks copy the current context, so the bypass reaches every sync
+    with bypass_summary_cache(refresh):
+        results = await asyncio.gather(*(sync_connection(conn) for conn in conns))
+    return {"status": "manual_sync_completed", "details": [r for r in results if r]}
 
 @app.post("/nango/session")
 async def create_nango_session(request: Request):
     body = await request.json()
     provider = body.get("provider", "google-mail")
     
-    db = SessionLocal()
-    nango_secret_entry = db.query(SystemConfig).filter(SystemConfig.key == "NANGO_SECRET_KEY").first()
-    db.close()
-
-    nango_secret = nango_secret_entry.value if nango_secret_entry else os.getenv("NANGO_SECRET_KEY")
+    nango_secret = get_setting("NANGO_SECRET_KEY")
 
     if not nango_secret:
         return {"error": "NANGO_SECRET_KEY_MISSING", "status_code": 500}
@@ -211,35 +316,28 @@ async def create_nango_session(request: Request):
             return {"error": "BACKEND_EXCEPTION", "detail": str(e)}
 
 @app.post("/ingest/webhook")
-async def nango_webhook(request: Request, background_tasks: BackgroundTasks):
+async def nango_webhook(request: Request, db: AsyncSession = Depends(get_db)):
     payload = await request.json()
-    db = SessionLocal()
-    audit_entry = IngestionAuditLog(
+    audit_entry = await db.run_sync(lambda session: enqueue(
+        session,
         source_uuid=str(payload.get("connectionId", uuid.uuid4())),
         source_platform=payload.get("providerConfigKey", "unknown"),
-        raw_payload=payload,
-        status="received"
-    )
-    db.add(audit_entry)
-    db.commit()
-    db.refresh(audit_entry)
-    db.close()
-    background_tasks.add_task(process_ingestion, str(audit_entry.id))
-    return {"status": "audited", "id": str(audit_entry.id)}
+        payload=payload
+    ))
+    await db.commit()
+    # Durable: the job survives restarts and is picked up by any ingestion worker
+    if ingestion_workers:
+        ingestion_workers.notify()
+    return {"status": "coalesced" if audit_entry.status == "coalesced" else "audited", "id": str(audit_entry.id)}
 
 @app.get("/nango/debug-db")
-async def debug_nango_db():
-    db = SessionLocal()
-    logs = db.query(IngestionAuditLog).order_by(IngestionAuditLog.created_at.desc()).limit(10).all()
-    db.close()
+async def debug_nango_db(db: AsyncSession = Depends(get_db)):
+    logs = (await db.scalars(select(IngestionAuditLog).order_by(IngestionAuditLog.created_at.desc()).limit(10))).all()
     return {"logs": [{"platform": l.source_platform, "status": l.status} for l in logs]}
 
 @app.get("/nango/debug-connections")
 async def debug_nango_connections():
-    db = SessionLocal()
-    nango_secret_entry = db.query(SystemConfig).filter(SystemConfig.key == "NANGO_SECRET_KEY").first()
-    db.close()
-    nango_secret = nango_secret_entry.value if nango_secret_entry else os.getenv("NANGO_SECRET_KEY")
+    nango_secret = get_setting("NANGO_SECRET_KEY")
     async with httpx.AsyncClient() as client:
         res = await client.get("https://api.nango.dev/connection", headers={"Authorization": f"Bearer {nango_secret}"})
         return res.json()
@@ -254,21 +352,18 @@ async def start_gmail_oauth():
     # #region agent log
     logger.info("[Compass] /auth/gmail/start called")
     # #endregion
-    db = SessionLocal()
-    gmail_service = GmailDirectService(db)
+    gmail_service = GmailDirectService(None)
     auth_url = gmail_service.get_authorization_url()
-    db.close()
     logger.info(f"[Compass] Redirecting to Gmail OAuth: {auth_url}")
     return RedirectResponse(url=auth_url)
 
 @app.get("/auth/gmail/callback")
-async def gmail_oauth_callback(code: str, state: str = "default"):
+async def gmail_oauth_callback(code: str, state: str = "default", db: AsyncSession = Depends(get_db)):
     """Handle Gmail OAuth callback"""
     # #region agent log
     logger.info(f"[Compass] /auth/gmail/callback called with code: {code[:10]}...")
     # #endregion
-    db = SessionLocal()
-    gmail_service = GmailDirectService(db)
+    gmail_service = GmailDirectService(None)
     
     try:
         # Exchange code for token
@@ -288,11 +383,10 @@ async def gmail_oauth_callback(code: str, state: str = "default"):
                 logger.info(f"[Compass] User email retrieved: {user_email}")
         
         # Save token
-        gmail_service.save_token(token_data, user_email)
+        await db.run_sync(lambda session: gmail_service.save_token(token_data, user_email, session=session))
         
         # Redirect to frontend settings page with success
         frontend_url = os.getenv("FRONTEND_URL", "https://project-compass-os-hdke9.ondigitalocean.app")
-        db.close()
         logger.info(f"[Compass] Gmail connected. Redirecting to: {frontend_url}/dashboard/settings?gmail=connected")
         return RedirectResponse(url=f"{frontend_url}/dashboard/settings?gmail=connected")
         
@@ -301,49 +395,51 @@ async def gmail_oauth_callback(code: str, state: str = "default"):
         # #region agent log
         logger.error(f"[Compass] EXCEPTION in callback: {type(e).__name__}: {str(e)}")
         # #endregion
-        db.close()
         frontend_url = os.getenv("FRONTEND_URL", "https://project-compass-os-hdke9.ondigitalocean.app")
         return RedirectResponse(url=f"{frontend_url}/dashboard/settings?gmail=error")
 
 @app.post("/gmail/sync")
-async def sync_gmail():
-    """Manually sync Gmail messages"""
+async def sync_gmail(refresh: bool = False, db: AsyncSession = Depends(get_db)):
+    """
+    Queue a manual Gmail sync for the ingestion workers. refresh=true bypasses
+    the summary cache. Repeated requests coalesce into one pending sync.
+    """
     # #region agent log
     logger.info("[Compass] /gmail/sync called")
     # #endregion
-    db = SessionLocal()
-    gmail_service = GmailDirectService(db)
-    
     try:
-        result = await gmail_service.sync_messages()
+        job = await db.run_sync(lambda session: enqueue(
+            session,
+            source_uuid="default_user",
+            source_platform=GMAIL_DIRECT_PLATFORM,
+            payload={"refresh": refresh}
+        ))
+        await db.commit()
+        if ingestion_workers:
+            ingestion_workers.notify()
         # #region agent log
-        logger.info(f"[Compass] Sync result: {result}")
+        logger.info(f"[Compass] Gmail sync queued: {job.id}")
         # #endregion
-        db.close()
-        return result
+        return {"status": "coalesced" if job.status == "coalesced" else "queued", "id": str(job.id)}
     except Exception as e:
         logger.error(f"[Compass] Gmail sync error: {str(e)}")
         # #region agent log
         logger.error(f"[Compass] SYNC EXCEPTION: {str(e)}")
         # #endregion
-        db.close()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/gmail/status")
-async def gmail_connection_status():
+async def gmail_connection_status(db: AsyncSession = Depends(get_db)):
     """Check if Gmail is connected"""
-    db = SessionLocal()
-    gmail_service = GmailDirectService(db)
+    gmail_service = GmailDirectService(None)
     
     try:
-        token = await gmail_service.get_valid_token()
-        db.close()
+        token = await gmail_service.get_valid_token(db)
         if token:
             return {"status": "connected", "has_token": True}
         else:
             return {"status": "disconnected", "has_token": False}
     except Exception as e:
-        db.close()
         return {"status": "error", "has_token": False, "error": str(e)}
 
 if __name__ == "__main__":
@@ -1,13 +1,21 @@
-from sqlalchemy import create_engine, Column, String, Text, DateTime, JSON, ForeignKey, Table, Float, text, Boolean
+from sqlalchemy import create_engine, Column, String, Text, DateTime, JSON, ForeignKey, Table, Float, text, Boolean, UniqueConstraint, Integer, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.dialects.postgresql import UUID, JSONB
+from pgvector.sqlalchemy import Vector
 import os
 from datetime import datetime
 import uuid
+import logging
+from app.utils.db_pool import InstrumentedQueuePool
 
 Base = declarative_base()
 
+logger = logging.getLogger(__name__)
+
+# Must match the vector(N) columns in schema.sql and the embedding model's output size
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "1536"))
+
 class Entity(Base):
     __tablename__ = 'entities'
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
@@ -24,6 +32,7 @@ class Thread(Base):
     id = Column(String, primary_key=True)
     title = Column(String)
     rolling_summary = Column(JSONB, default={})
+    summary_vector = Column(Vector(EMBEDDING_DIM))  # Cleared whenever rolling_summary changes
     last_updated = Column(DateTime(timezone=True), default=datetime.utcnow)
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
     messages = relationship("Message", back_populates="thread")
@@ -36,8 +45,13 @@ class Message(Base):
     source = Column(String, nullable=False)
     raw_content = Column(Text)
     cleaned_content = Column(Text)
+    message_vector = Column(Vector(EMBEDDING_DIM))
     timestamp = Column(DateTime(timezone=True), nullable=False)
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    summarized_at = Column(DateTime(timezone=True))  # NULL until folded into the thread's rolling summary
+    # Summarization retries (see app.services.agent.queue_unsummarized)
+    summarize_attempts = Column(Integer, default=0, nullable=False)
+    summarize_retry_at = Column(DateTime(timezone=True))  # Claimed until then; NULL until first retried
     thread = relationship("Thread", back_populates="messages")
 
 class Meeting(Base):
@@ -47,6 +61,7 @@ class Meeting(Base):
     transcript = Column(Text)
     action_items = Column(JSONB, default=[])
     positioning_notes = Column(Text)
+    meeting_vector = Column(Vector(EMBEDDING_DIM))
     start_time = Column(DateTime(timezone=True))
     end_time = Column(DateTime(timezone=True))
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
@@ -70,9 +85,22 @@ class IngestionAuditLog(Base):
     source_uuid = Column(String, nullable=False)
     source_platform = Column(String, nullable=False)
     raw_payload = Column(JSONB)
-    status = Column(String, default='received')
+    status = Column(String, default='received')  # received, processing, retry, processed, ignored, dead
     error_message = Column(Text)
+    # Work-queue bookkeeping (see app.services.ingestion_queue)
+    attempts = Column(Integer, default=0, nullable=False)
+    available_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    locked_at = Column(DateTime(timezone=True))
+    locked_by = Column(String)
+    coalesced_into = Column(UUID(as_uuid=True))  # Job that absorbed this event
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    updated_at = Column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow)
+    __table_args__ = (
+        Index('ingestion_audit_log_queue_idx', 'status', 'available_at'),
+        # At most one in-flight sync per connection
+        Index('ingestion_audit_log_inflight_idx', 'source_platform', 'source_uuid',
+              unique=True, postgresql_where=text("status = 'processing'")),
+    )
 
 class SystemConfig(Base):
     __tablename__ = 'system_config'
@@ -102,24 +130,112 @@ class OAuthToken(Base):
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
     updated_at = Column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow)
 
-# Note: pgvector specific columns and indexes are best handled via raw SQL or specialized extensions
-# like pgvector-python. For this scaffold, we'll stick to basic SQLAlchemy.
+class EmbeddingCacheEntry(Base):
+    __tablename__ = 'embedding_cache'
+    content_hash = Column(String, primary_key=True)  # sha256 of model + text
+    model = Column(String, nullable=False)
+    embedding = Column(Vector(EMBEDDING_DIM), nullable=False)
+    created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
 
-def get_db_engine():
-    db_url = os.getenv("DATABASE_URL")
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    __table_args__ = (UniqueConstraint('provider', 'connection_id', 'resource'),)
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    provider = Column(String, nullable=False)  # 'gmail', 'nango', etc.
+    connection_id = Column(String, nullable=False)  # OAuth user_id or Nango connectionId
+    resource = Column(String, nullable=False)  # 'history', a Nango model name, etc.
+    cursor = Column(String)  # Opaque checkpoint (Gmail historyId, Nango watermark)
+    state = Column(JSONB, default={})
+    updated_at = Column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Pool sizing (env only: the pool has to exist before SystemConfig can be read).
+# Size it for the sync users of the process:
+# INGESTION_WORKERS x AGENT_THREAD_WORKERS agent runs and NANGO_SYNC_CONCURRENCY
+# manual syncs. Async API sessions have their own pool (DB_ASYNC_POOL_SIZE in
+# app/database.py); the connection budget per process is the sum of both.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+
+_engine = None
+
+def create_db_engine(db_url: str = None):
+    db_url = db_url or os.getenv("DATABASE_URL")
     if not db_url:
         raise ValueError("DATABASE_URL not set")
-    return create_engine(db_url)
+    return create_engine(
+        db_url,
+        poolclass=InstrumentedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        # Reuse the most recent connection so idle ones age out via recycle
+        pool_use_lifo=True
+    )
+
+def get_db_engine():
+    """The process-wide engine. Every session, worker and script shares its pool."""
+    global _engine
+    if _engine is None:
+        _engine = create_db_engine()
+    return _engine
 
 engine = get_db_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Idempotent DDL for columns added after a table first shipped. create_all() only
+# creates missing tables, so existing deployments pick these up on startup.
+MIGRATIONS = [
+    "ALTER TABLE ingestion_audit_log ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE ingestion_audit_log ADD COLUMN IF NOT EXISTS available_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP",
+    "ALTER TABLE ingestion_audit_log ADD COLUMN IF NOT EXISTS locked_at TIMESTAMP WITH TIME ZONE",
+    "ALTER TABLE ingestion_audit_log ADD COLUMN IF NOT EXISTS locked_by TEXT",
+    "ALTER TABLE ingestion_audit_log ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP",
+    "CREATE INDEX IF NOT EXISTS ingestion_audit_log_queue_idx ON ingestion_audit_log (status, available_at)",
+    "ALTER TABLE ingestion_audit_log ADD COLUMN IF NOT EXISTS coalesced_into UUID",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ingestion_audit_log_inflight_idx ON ingestion_audit_log (source_platform, source_uuid) WHERE status = 'processing'",
+    f"ALTER TABLE threads ADD COLUMN IF NOT EXISTS summary_vector vector({EMBEDDING_DIM})",
+    f"ALTER TABLE messages ADD COLUMN IF NOT EXISTS message_vector vector({EMBEDDING_DIM})",
+    f"ALTER TABLE meetings ADD COLUMN IF NOT EXISTS meeting_vector vector({EMBEDDING_DIM})",
+    # Summary watermark: rows that exist before this column are treated as summarized
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS summarized_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP",
+    "ALTER TABLE messages ALTER COLUMN summarized_at DROP DEFAULT",
+    "CREATE INDEX IF NOT EXISTS messages_unsummarized_idx ON messages (created_at) WHERE summarized_at IS NULL",
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS summarize_attempts INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS summarize_retry_at TIMESTAMP WITH TIME ZONE",
+]
+
+# Fuzzy name matching for app.services.identity. Applied in its own transaction:
+# the role may not be allowed to create extensions, and that must not roll back
+# MIGRATIONS. Without pg_trgm, identity falls back to ILIKE matching.
+TRGM_MIGRATIONS = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS entities_name_trgm_idx ON entities USING gin (name gin_trgm_ops)",
+]
+
 def init_db():
-    engine = get_db_engine()
     with engine.connect() as conn:
         conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
         conn.commit()
     Base.metadata.create_all(engine)
+    with engine.connect() as conn:
+        for statement in MIGRATIONS:
+            conn.execute(text(statement))
+        conn.commit()
+    try:
+        with engine.begin() as conn:
+            for statement in TRGM_MIGRATIONS:
+                conn.execute(text(statement))
+    except Exception as e:
+        logger.error(f"[Compass] Could not set up pg_trgm (needs CREATE privilege or a superuser to "
+                     f"CREATE EXTENSION pg_trgm); identity name matching falls back to ILIKE: {e}")
+    # Vector and full-text indexes can take minutes to build on a large table, so
+    # they are not created here: the API builds missing ones in the background
+    # after startup, and scripts/vector_index.py creates or rebuilds them on demand.
     print("Database tables created.")
 
 if __name__ == "__main__":
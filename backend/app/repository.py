@@ -0,0 +1,91 @@
+"""
+Bulk persistence helpers for the sync services.
+Existing rows are preloaded with one IN query per batch and writes go out as
+batched INSERT ... ON CONFLICT, so re-ingesting a record is a no-op instead of
+an IntegrityError.
+"""
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Set, Iterable
+from sqlalchemy import update, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from app.models import Thread, Message
+
+BULK_BATCH_SIZE = 500
+
+def _batches(items: List[Any], size: int = BULK_BATCH_SIZE) -> Iterable[List[Any]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def existing_message_ids(db: Session, message_ids: Iterable[str]) -> Set[str]:
+    """IDs from message_ids that are already stored."""
+    ids = list({i for i in message_ids if i})
+    found: Set[str] = set()
+    for batch in _batches(ids):
+        found.update(row.id for row in db.query(Message.id).filter(Message.id.in_(batch)))
+    return found
+
+def load_threads(db: Session, thread_ids: Iterable[str]) -> Dict[str, Thread]:
+    """Threads by ID, fetched with one IN query per batch."""
+    ids = list({i for i in thread_ids if i})
+    threads: Dict[str, Thread] = {}
+    for batch in _batches(ids):
+        threads.update((t.id, t) for t in db.query(Thread).filter(Thread.id.in_(batch)))
+    return threads
+
+def bulk_upsert_threads(db: Session, rows: List[Dict[str, Any]]):
+    """
+    Insert threads ({"id", "title", "last_updated"}), refreshing last_updated on
+    threads that already exist. Titles and rolling summaries are never overwritten.
+    """
+    unique = list({row["id"]: row for row in rows}.values())
+    for batch in _batches(unique):
+        stmt = insert(Thread)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Thread.id],
+            set_={"last_updated": stmt.excluded.last_updated}
+        )
+        db.execute(stmt, batch)
+
+def bulk_insert_messages(db: Session, rows: List[Dict[str, Any]]) -> Set[str]:
+    """
+    Insert messages, skipping IDs that already exist.
+    Returns the IDs that were actually inserted.
+    """
+    unique = list({row["id"]: row for row in rows}.values())
+    inserted: Set[str] = set()
+    for batch in _batches(unique):
+        stmt = insert(Message).on_conflict_do_nothing(index_elements=[Message.id]).returning(Message.id)
+        inserted.update(db.scalars(stmt, batch))
+    return inserted
+
+def claim_unsummarized_messages(db: Session, created_before: datetime, exclude_ids: Iterable[str], limit: int,
+                                max_attempts: int, backoff_seconds: float) -> List[Message]:
+    """
+    Claim messages no agent run has summarized yet, oldest first (served by
+    messages_unsummarized_idx). Rows locked by another claim are skipped, and
+    each claimed row gets summarize_attempts + 1 and summarize_retry_at pushed
+    out by backoff_seconds * 2^attempts, so no other sync retries it meanwhile.
+    Rows that used up max_attempts are left alone. The caller commits the claim.
+    """
+    now = datetime.utcnow()
+    query = db.query(Message).filter(
+        Message.summarized_at == None,
+        Message.created_at < created_before,
+        Message.summarize_attempts < max_attempts,
+        or_(Message.summarize_retry_at == None, Message.summarize_retry_at <= now)
+    )
+    exclude = list({i for i in exclude_ids if i})
+    if exclude:
+        query = query.filter(Message.id.notin_(exclude))
+    messages = query.order_by(Message.created_at, Message.timestamp).limit(limit).with_for_update(skip_locked=True).all()
+    for message in messages:
+        message.summarize_retry_at = now + timedelta(seconds=backoff_seconds * 2 ** message.summarize_attempts)
+        message.summarize_attempts += 1
+    db.flush()
+    return messages
+
+def mark_summarized(db: Session, message_ids: Iterable[str]):
+    ids = list({i for i in message_ids if i})
+    for batch in _batches(ids):
+        db.execute(update(Message).where(Message.id.in_(batch)).values(summarized_at=datetime.utcnow()))
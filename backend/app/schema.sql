@@ -33,7 +33,10 @@ CREATE TABLE IF NOT EXISTS messages (
     cleaned_content TEXT,
     message_vector vector(1536),
     timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    summarized_at TIMESTAMP WITH TIME ZONE, -- NULL until the agent folds it into the thread summary
+    summarize_attempts INTEGER NOT NULL DEFAULT 0, -- Summarization retries claimed so far
+    summarize_retry_at TIMESTAMP WITH TIME ZONE -- Retry claimed until then (backoff)
 );
 
 -- Meetings table
@@ -69,14 +72,56 @@ CREATE TABLE IF NOT EXISTS ingestion_audit_log (
     source_uuid TEXT NOT NULL, -- UUID from incoming webhook (e.g., Nango/Gmail messageId)
     source_platform TEXT NOT NULL,
     raw_payload JSONB,
-    status TEXT DEFAULT 'received', -- 'received', 'processed', 'failed'
+    status TEXT DEFAULT 'received', -- 'received', 'processing', 'retry', 'processed', 'ignored', 'coalesced', 'dead'
     error_message TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0, -- Work-queue bookkeeping
+    available_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    locked_at TIMESTAMP WITH TIME ZONE,
+    locked_by TEXT,
+    coalesced_into UUID, -- Job that absorbed this event (status 'coalesced')
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Claimable jobs are looked up by status and due time
+CREATE INDEX IF NOT EXISTS ingestion_audit_log_queue_idx ON ingestion_audit_log (status, available_at);
+-- At most one in-flight sync per connection
+CREATE UNIQUE INDEX IF NOT EXISTS ingestion_audit_log_inflight_idx ON ingestion_audit_log (source_platform, source_uuid) WHERE status = 'processing';
+
+-- Sync checkpoints (Gmail historyId, Nango watermarks) for incremental ingestion
+CREATE TABLE IF NOT EXISTS sync_state (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    provider TEXT NOT NULL,
+    connection_id TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    cursor TEXT,
+    state JSONB DEFAULT '{}',
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (provider, connection_id, resource)
+);
+
+-- Embeddings by content hash (sha256 of model + text), shared by every source
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    content_hash TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    embedding vector(1536) NOT NULL,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
--- Index for vector search
-CREATE INDEX IF NOT EXISTS threads_vector_idx ON threads USING ivfflat (summary_vector l2_distance) WITH (lists = 100);
-CREATE INDEX IF NOT EXISTS messages_vector_idx ON messages USING ivfflat (message_vector l2_distance) WITH (lists = 100);
-CREATE INDEX IF NOT EXISTS meetings_vector_idx ON meetings USING ivfflat (meeting_vector l2_distance) WITH (lists = 100);
+-- Index for vector search (HNSW, L2). Managed by app/services/vector_index.py;
+-- use scripts/vector_index.py to rebuild with another method or metric.
+CREATE INDEX IF NOT EXISTS threads_vector_idx ON threads USING hnsw (summary_vector vector_l2_ops) WITH (m = 16, ef_construction = 64);
+CREATE INDEX IF NOT EXISTS messages_vector_idx ON messages USING hnsw (message_vector vector_l2_ops) WITH (m = 16, ef_construction = 64);
+CREATE INDEX IF NOT EXISTS meetings_vector_idx ON meetings USING hnsw (meeting_vector vector_l2_ops) WITH (m = 16, ef_construction = 64);
+
+-- Messages still waiting for (a retry of) summarization
+CREATE INDEX IF NOT EXISTS messages_unsummarized_idx ON messages (created_at) WHERE summarized_at IS NULL;
 
+-- Trigram index for fuzzy sender name matching (app/services/identity.py)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS entities_name_trgm_idx ON entities USING gin (name gin_trgm_ops);
 
+-- Full-text search indexes (expressions must match FTS_INDEXES in app/services/vector_index.py)
+CREATE INDEX IF NOT EXISTS threads_fts_idx ON threads USING gin (to_tsvector('english'::regconfig, coalesce(title, '') || ' ' || coalesce(rolling_summary ->> 'strategic_context', '')));
+CREATE INDEX IF NOT EXISTS messages_fts_idx ON messages USING gin (to_tsvector('english'::regconfig, coalesce(cleaned_content, raw_content, '')));
+CREATE INDEX IF NOT EXISTS meetings_fts_idx ON meetings USING gin (to_tsvector('english'::regconfig, coalesce(title, '') || ' ' || coalesce(transcript, '')));
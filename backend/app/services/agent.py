@@ -1,26 +1,117 @@
-from typing import TypedDict, List, Dict, Any
+from typing import TypedDict, List, Dict, Any, Optional
 from langgraph.graph import StateGraph, END
 from .deepseek import DeepSeekService
-from ..models import get_db_engine, Thread, Message, PendingAction, Entity
-from sqlalchemy.orm import sessionmaker
+from .identity import IdentityResolver
+from langchain_core.runnables import RunnableConfig
+from ..models import SessionLocal, Thread, Message, PendingAction
+from ..repository import claim_unsummarized_messages, mark_summarized
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
 import os
+import time
+import asyncio
+import weakref
+import logging
+from app.utils import metrics
 
-# Setup Database Session
-engine = get_db_engine()
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+logger = logging.getLogger(__name__)
+
+# Threads summarized concurrently per run_threads call (the LLM semaphore still caps in-flight calls)
+AGENT_THREAD_WORKERS = int(os.getenv("AGENT_THREAD_WORKERS", "4"))
+# Messages left unsummarized by a failed run are picked up by a later sync once this old;
+# each retry backs off twice as long, and a message is given up on after AGENT_RETRY_MAX_ATTEMPTS
+AGENT_RETRY_AFTER_SECONDS = float(os.getenv("AGENT_RETRY_AFTER_SECONDS", "300"))
+AGENT_RETRY_LIMIT = int(os.getenv("AGENT_RETRY_LIMIT", "200"))
+AGENT_RETRY_MAX_ATTEMPTS = int(os.getenv("AGENT_RETRY_MAX_ATTEMPTS", "5"))
+
+# One lock per thread id while it is being processed; entries vanish once unused
+_thread_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _thread_lock(thread_id: str) -> asyncio.Lock:
+    lock = _thread_locks.get(thread_id)
+    if lock is None:
+        lock = _thread_locks[thread_id] = asyncio.Lock()
+    return lock
 
 class AgentState(TypedDict):
     thread_id: str
     new_message: str
+    new_messages: List[str]
     sender_info: Dict[str, Any]
     current_summary: Dict[str, Any]
     extracted_tasks: List[Dict[str, Any]]
     potential_matches: List[Dict[str, Any]]
     actions: List[Dict[str, Any]]
 
+class ThreadBatch(TypedDict):
+    thread_id: str
+    messages: List[str]
+    message_ids: List[str]
+    current_summary: Dict[str, Any]
+    sender_info: Dict[str, Any]
+
+def queue_message(batches: Dict[str, ThreadBatch], thread_id: str, message: str,
+                  current_summary: Dict[str, Any], sender_info: Dict[str, Any], message_id: Optional[str] = None):
+    """
+    Group a new message under its thread for CompassAgent.run_threads.
+    Messages must be queued oldest first; the latest sender wins. message_id is
+    marked summarized when the thread's run commits.
+    """
+    batch = batches.get(thread_id)
+    if batch is None:
+        batch = batches[thread_id] = {
+            "thread_id": thread_id,
+            "messages": [],
+            "message_ids": [],
+            "current_summary": current_summary,
+            "sender_info": sender_info
+        }
+    batch["messages"].append(message)
+    if message_id:
+        batch["message_ids"].append(message_id)
+    if sender_info:
+        batch["sender_info"] = sender_info
+
+def queue_unsummarized(db: Session, batches: Dict[str, ThreadBatch], limit: int = AGENT_RETRY_LIMIT) -> int:
+    """
+    Add messages whose agent run failed in an earlier sync (summarized_at still
+    NULL after AGENT_RETRY_AFTER_SECONDS) to `batches`, ahead of the new messages
+    of their thread. Returns how many were queued.
+
+    The messages are claimed with a backoff stamp, so commit before running the
+    batches: a concurrent sync in another process then skips them, and a message
+    that keeps failing is retried less and less often, then dropped.
+    """
+    created_before = datetime.utcnow() - timedelta(seconds=AGENT_RETRY_AFTER_SECONDS)
+    queued_ids = [i for batch in batches.values() for i in batch["message_ids"]]
+    pending = claim_unsummarized_messages(db, created_before, queued_ids, limit,
+                                          AGENT_RETRY_MAX_ATTEMPTS, AGENT_RETRY_AFTER_SECONDS)
+    exhausted = sum(1 for message in pending if message.summarize_attempts >= AGENT_RETRY_MAX_ATTEMPTS)
+    if exhausted:
+        metrics.increment("agent.summary.abandoned", exhausted)
+        logger.warning(f"[Compass] Last summarization retry for {exhausted} messages")
+    retries: Dict[str, ThreadBatch] = {}
+    for message in pending:
+        queue_message(retries, message.thread_id, message.cleaned_content or message.raw_content or "", {}, {}, message.id)
+    for thread_id, retry in retries.items():
+        batch = batches.get(thread_id)
+        if batch is None:
+            batches[thread_id] = retry
+        else:
+            batch["messages"][:0] = retry["messages"]
+            batch["message_ids"][:0] = retry["message_ids"]
+    if pending:
+        metrics.increment("agent.summary.retried", len(pending))
+        logger.info(f"[Compass] Retrying summarization of {len(pending)} messages in {len(retries)} threads")
+    return len(pending)
+
+def _session(config: RunnableConfig) -> Session:
+    """The session run_batch injected for this graph run."""
+    return config["configurable"]["db"]
+
 class CompassAgent:
-    def __init__(self):
-        self.deepseek = DeepSeekService()
+    def __init__(self, deepseek: DeepSeekService = None):
+        self.deepseek = deepseek or DeepSeekService()
         self.workflow = self._build_workflow()
 
     def _build_workflow(self):
@@ -39,48 +130,39 @@ class CompassAgent:
 
         return workflow.compile()
 
-    async def _resolve_identity_node(self, state: AgentState):
+    async def _resolve_identity_node(self, state: AgentState, config: RunnableConfig):
         """
         Identity Resolution Engine:
-        Scans for existing entities that might match the sender.
-        If no match found but info exists, we suggest a profile merge.
+        Exact email / Slack ID matches from the entity cache, else ranked
+        fuzzy name matches. If nothing matches, we suggest a profile merge.
         """
-        sender = state.get("sender_info", {})
-        email = sender.get("email")
-        slack_id = sender.get("slack_id")
-        
-        db = SessionLocal()
-        # 1. Exact Email Match
-        entity = db.query(Entity).filter(Entity.email == email).first()
-        if not entity and slack_id:
-            # 2. Slack ID Match
-            entity = db.query(Entity).filter(Entity.slack_id == slack_id).first()
-        
-        db.close()
+        matches = IdentityResolver(_session(config)).resolve(state.get("sender_info") or {})
+        return {"potential_matches": matches}
 
-        if entity:
-            return {"potential_matches": [{"id": str(entity.id), "name": entity.name}]}
-        
-        # If we have name but no ID match, return a potential match by name
-        if sender.get("name"):
-            db = SessionLocal()
-            matches = db.query(Entity).filter(Entity.name.ilike(f"%{sender['name']}%")).all()
-            db.close()
-            return {"potential_matches": [{"id": str(m.id), "name": m.name} for m in matches]}
+    async def _summarize_node(self, state: AgentState, config: RunnableConfig):
+        # Only summarize if it's a new message or update needed
+        new_messages = state.get('new_messages') or [state['new_message']]
 
-        return {"potential_matches": []}
+        # Fold onto the stored summary, not the caller's snapshot: the snapshot was
+        # taken before the thread lock, and an overlapping sync may have updated it
+        # since (run_threads gives each run a fresh session, so this reads the row)
+        db = _session(config)
+        thread = db.get(Thread, state['thread_id'])
+        current_summary = thread.rolling_summary if thread and thread.rolling_summary else state.get('current_summary') or {}
 
-    async def _summarize_node(self, state: AgentState):
-        # Only summarize if it's a new message or update needed
-        summary = await self.deepseek.summarize_thread(state.get('current_summary', {}), state['new_message'])
+        if len(new_messages) == 1:
+            summary = await self.deepseek.summarize_thread(current_summary, new_messages[0])
+        else:
+            summary = await self.deepseek.summarize_thread_batch(current_summary, new_messages)
         
-        # Persist to DB
-        db = SessionLocal()
-        thread = db.query(Thread).filter(Thread.id == state['thread_id']).first()
-        if thread:
+        # Persist with the run's unit of work (committed by run_batch)
+        if thread and summary != thread.rolling_summary:
             thread.rolling_summary = summary
-            db.commit()
-        db.close()
+            # Stale now; re-embedded by the embedding pipeline
+            thread.summary_vector = None
+        elif thread:
+            # Nothing material changed: keep the row and its existing vector
+            metrics.increment("agent.summary.unchanged")
 
         return {"current_summary": summary}
 
@@ -88,10 +170,10 @@ class CompassAgent:
         tasks = state.get('current_summary', {}).get("pending_tasks", [])
         return {"extracted_tasks": tasks}
 
-    async def _generate_actions_node(self, state: AgentState):
+    async def _generate_actions_node(self, state: AgentState, config: RunnableConfig):
         actions = []
         thread_id = state.get('thread_id')
-        db = SessionLocal()
+        db = _session(config)
         
         # 1. Merge Profile Actions (Reliability Layer)
         if not state.get('potential_matches') and state.get('sender_info', {}).get('email'):
@@ -132,19 +214,81 @@ class CompassAgent:
                     "data": action.data
                 })
         
-        db.commit()
-        db.close()
         return {"actions": actions}
 
-    async def run(self, thread_id: str, message: str, current_summary: Dict[str, Any], sender_info: Dict[str, Any] = {}):
+    async def run(self, thread_id: str, message: str, current_summary: Dict[str, Any], sender_info: Dict[str, Any] = {},
+                  db: Optional[Session] = None, message_id: Optional[str] = None):
+        return await self.run_batch(thread_id, [message], current_summary, sender_info, db=db,
+                                    message_ids=[message_id] if message_id else None)
+
+    async def run_batch(self, thread_id: str, messages: List[str], current_summary: Dict[str, Any], sender_info: Dict[str, Any] = {},
+                        db: Optional[Session] = None, message_ids: Optional[List[str]] = None):
+        """
+        Run the graph once for several new messages of the same thread (oldest first).
+        sender_info should describe the sender of the most recent message.
+
+        All nodes share one session and the run is a single unit of work: committed
+        once at the end, rolled back if any node fails. Pass the caller's session
+        to see (and commit) its pending changes; otherwise a short-lived session
+        from the shared pool is used. message_ids are marked summarized in the same
+        commit, so a failed run leaves them for queue_unsummarized to retry.
+        """
         initial_state = {
             "thread_id": thread_id,
-            "new_message": message,
+            "new_message": messages[-1],
+            "new_messages": messages,
             "sender_info": sender_info,
             "current_summary": current_summary,
             "extracted_tasks": [],
             "potential_matches": [],
             "actions": []
         }
-        return await self.workflow.ainvoke(initial_state)
+        owns_session = db is None
+        db = db or SessionLocal()
+        try:
+            result = await self.workflow.ainvoke(initial_state, config={"configurable": {"db": db}})
+            if message_ids:
+                mark_summarized(db, message_ids)
+            db.commit()
+            return result
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            if owns_session:
+                db.close()
+
+    async def run_threads(self, batches: Dict[str, ThreadBatch], workers: int = AGENT_THREAD_WORKERS) -> Dict[str, Any]:
+        """
+        Run one batch per thread, up to `workers` threads at a time. Threads are
+        independent; within a thread the messages stay in order in a single batch,
+        and the per-thread lock serializes overlapping syncs on the same thread;
+        each run re-reads the stored rolling summary once it holds the lock.
+        Each thread is its own unit of work on a pooled session (callers commit
+        their threads first), so a failing thread is rolled back, logged and
+        skipped without aborting the rest of the sync; its messages stay
+        unsummarized and queue_unsummarized retries them.
+        """
+        semaphore = asyncio.Semaphore(max(1, workers))
+        results = {}
+
+        async def run_thread(thread_id: str, batch: ThreadBatch):
+            async with _thread_lock(thread_id), semaphore:
+                started = time.perf_counter()
+                try:
+                    results[thread_id] = await self.run_batch(
+                        thread_id=thread_id,
+                        messages=batch["messages"],
+                        current_summary=batch["current_summary"],
+                        sender_info=batch["sender_info"],
+                        message_ids=batch.get("message_ids")
+                    )
+                except Exception as e:
+                    metrics.increment("agent.threads.errors")
+                    logger.error(f"[Compass] Agent failed for thread {thread_id}: {e}")
+                finally:
+                    metrics.observe("agent.threads.run_ms", (time.perf_counter() - started) * 1000)
 
+        with metrics.timer("agent.run_threads_ms"):
+            await asyncio.gather(*(run_thread(thread_id, batch) for thread_id, batch in batches.items()))
+        return results
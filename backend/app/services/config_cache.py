@@ -0,0 +1,43 @@
+"""
+Process-wide cache of the system_config table.
+Rows are loaded once and served from memory; POST /config invalidates the cache.
+Environment variables remain the fallback for keys not set in the database.
+"""
+import os
+import threading
+import logging
+from typing import Dict, Optional
+from app.models import SessionLocal, SystemConfig
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_cache: Optional[Dict[str, str]] = None
+
+def get_config() -> Dict[str, str]:
+    """All SystemConfig rows as a dict, loaded from the database on first use."""
+    global _cache
+    with _lock:
+        if _cache is not None:
+            return _cache
+        try:
+            db = SessionLocal()
+            try:
+                _cache = {c.key: c.value for c in db.query(SystemConfig).all()}
+            finally:
+                db.close()
+        except Exception as e:
+            # Not cached, so the next call retries once the database is reachable
+            logger.warning(f"[Compass] Could not load system config, using environment: {e}")
+            return {}
+        return _cache
+
+def get_setting(key: str, default: Optional[str] = None) -> Optional[str]:
+    """A SystemConfig value, falling back to the environment and then to default."""
+    value = get_config().get(key)
+    return value if value else os.getenv(key, default)
+
+def invalidate_config():
+    global _cache
+    with _lock:
+        _cache = None
@@ -1,58 +1,202 @@
 import os
 import json
-from openai import OpenAI
-from typing import Dict, Any
-from app.models import SessionLocal, SystemConfig
+import time
+import asyncio
+import hashlib
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+import httpx
+from openai import AsyncOpenAI
+from typing import Dict, Any, List, Optional, Callable, Awaitable, AsyncIterator
+from app.services.config_cache import get_setting
+from app.services.embedding_cache import get_embedding_cache, content_hash
+from app.utils import metrics
+from app.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Shared, pooled connection to the vLLM node. One keep-alive pool per process
+# instead of a fresh client per DeepSeekService instance.
+LLM_TIMEOUT = float(os.getenv("DEEPSEEK_TIMEOUT", "120"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("DEEPSEEK_CONNECT_TIMEOUT", "5"))
+LLM_MAX_CONNECTIONS = int(os.getenv("DEEPSEEK_MAX_CONNECTIONS", "20"))
+LLM_MAX_CONCURRENCY = int(os.getenv("DEEPSEEK_MAX_CONCURRENCY", "8"))
+
+_http_client: Optional[httpx.AsyncClient] = None
+_llm_semaphore: Optional[asyncio.Semaphore] = None
+
+# Summaries keyed by (model, prompt version, current summary, new messages). Bump
+# SUMMARY_PROMPT_VERSION whenever _build_summary_prompt changes meaningfully.
+SUMMARY_PROMPT_VERSION = "2"
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", "2048"))
+SUMMARY_CACHE_TTL_SECONDS = float(os.getenv("SUMMARY_CACHE_TTL_SECONDS", "86400"))
+
+_summary_cache = LRUCache(SUMMARY_CACHE_SIZE, ttl=SUMMARY_CACHE_TTL_SECONDS)
+_use_summary_cache: ContextVar[bool] = ContextVar("use_summary_cache", default=True)
+
+@contextmanager
+def bypass_summary_cache(bypass: bool = True):
+    """
+    Force fresh summaries for everything run inside the block (including tasks
+    it spawns), e.g. a sync requested with ?refresh=true. Fresh results are still cached.
+    """
+    token = _use_summary_cache.set(not bypass)
+    try:
+        yield
+    finally:
+        _use_summary_cache.reset(token)
+
+def clear_summary_cache():
+    _summary_cache.clear()
+
+def get_llm_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS),
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+        )
+    return _http_client
+
+async def close_llm_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+def _get_llm_semaphore() -> asyncio.Semaphore:
+    """Caps in-flight requests to the vLLM node across all service instances."""
+    global _llm_semaphore
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+    return _llm_semaphore
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token) for prompt budgeting."""
+    return len(text) // 4 + 1
+
+def chunk_messages(messages: List[str], token_budget: int) -> List[List[str]]:
+    """
+    Split messages into consecutive chunks whose estimated size fits the budget.
+    A single message larger than the budget gets a chunk of its own.
+    """
+    chunks: List[List[str]] = []
+    current: List[str] = []
+    current_tokens = 0
+    for message in messages:
+        tokens = estimate_tokens(message)
+        if current and current_tokens + tokens > token_budget:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(message)
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
 
 class DeepSeekService:
     def __init__(self):
-        try:
-            db = SessionLocal()
-            api_key = db.query(SystemConfig).filter(SystemConfig.key == "DEEPSEEK_API_KEY").first()
-            base_url = db.query(SystemConfig).filter(SystemConfig.key == "DEEPSEEK_API_BASE").first()
-            model = db.query(SystemConfig).filter(SystemConfig.key == "DEEPSEEK_MODEL").first()
-            db.close()
-
-            self.api_key = api_key.value if api_key else os.getenv("DEEPSEEK_API_KEY")
-            self.base_url = base_url.value if base_url else os.getenv("DEEPSEEK_API_BASE")
-            self.model = model.value if model else os.getenv("DEEPSEEK_MODEL", "LEXA")
-        except Exception:
-            self.api_key = os.getenv("DEEPSEEK_API_KEY")
-            self.base_url = os.getenv("DEEPSEEK_API_BASE")
-            self.model = os.getenv("DEEPSEEK_MODEL", "LEXA")
+        self.api_key = get_setting("DEEPSEEK_API_KEY")
+        self.base_url = get_setting("DEEPSEEK_API_BASE")
+        self.model = get_setting("DEEPSEEK_MODEL", "LEXA")
+        self.embedding_model = get_setting("EMBEDDING_MODEL", "text-embedding-3-small")
 
-        self.client = OpenAI(
+        # Approximate prompt budget for the new messages folded into one summary call
+        self.batch_token_budget = int(os.getenv("DEEPSEEK_BATCH_TOKEN_BUDGET", "6000"))
+
+        self.client = AsyncOpenAI(
             api_key=self.api_key,
-            base_url=self.base_url
+            base_url=self.base_url,
+            http_client=get_llm_http_client(),
+            timeout=LLM_TIMEOUT
         )
+        self.embedding_cache = get_embedding_cache()
+
+    async def _call(self, kind: str, request: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run one LLM request under the shared concurrency limit and record
+        queue wait, latency and token usage under llm.<kind>.*
+        """
+        queued_at = time.perf_counter()
+        async with _get_llm_semaphore():
+            started_at = time.perf_counter()
+            metrics.observe(f"llm.{kind}.queue_wait_ms", (started_at - queued_at) * 1000)
+            try:
+                response = await request()
+            except Exception:
+                metrics.increment(f"llm.{kind}.errors")
+                raise
+            latency_ms = (time.perf_counter() - started_at) * 1000
+
+        metrics.increment(f"llm.{kind}.calls")
+        metrics.observe(f"llm.{kind}.latency_ms", latency_ms)
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            metrics.increment(f"llm.{kind}.prompt_tokens", getattr(usage, "prompt_tokens", 0) or 0)
+            metrics.increment(f"llm.{kind}.completion_tokens", getattr(usage, "completion_tokens", 0) or 0)
+        logger.debug(f"[Compass] LLM {kind} call took {latency_ms:.0f}ms")
+        return response
+
+    async def stream_chat(self, kind: str, messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        """
+        Stream a chat completion as text deltas, recording llm.<kind>.ttft_ms and
+        latency_ms. Interactive streams skip the shared concurrency limit so live
+        meeting advice never queues behind batch summarization.
+        """
+        started_at = time.perf_counter()
+        first_token_at = None
+        try:
+            stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=max_tokens,
+                stream=True
+            )
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    metrics.observe(f"llm.{kind}.ttft_ms", (first_token_at - started_at) * 1000)
+                yield delta
+        except Exception:
+            metrics.increment(f"llm.{kind}.errors")
+            raise
+        metrics.increment(f"llm.{kind}.calls")
+        metrics.observe(f"llm.{kind}.latency_ms", (time.perf_counter() - started_at) * 1000)
 
     async def ping(self) -> bool:
         """
         Pulse check against the vLLM node.
         """
         try:
-            self.client.models.list()
+            await self._call("ping", lambda: self.client.models.list())
             return True
         except Exception:
             return False
 
-    async def summarize_thread(self, current_summary: Dict[str, Any], new_message: str) -> Dict[str, Any]:
-        """
-        Optimized for DeepSeek-V3-Distill-Llama-70B:
-        Recursive Summarization with strategic reasoning.
-        """
-        prompt = f"""
+    def _build_summary_prompt(self, current_summary: Dict[str, Any], new_messages: List[str]) -> str:
+        if len(new_messages) == 1:
+            incoming = f"""### New Incoming Message:
+        {new_messages[0]}"""
+        else:
+            numbered = "\n\n".join(f"[{i}] {msg}" for i, msg in enumerate(new_messages, start=1))
+            incoming = f"""### New Incoming Messages (oldest first, fold all of them into one updated summary):
+        {numbered}"""
+
+        return f"""
         ### Task: Update Founder's Communication Thread Summary
         ### Role: You are a strategic Chief of Staff for a startup founder.
         
         ### Current Summary:
         {json.dumps(current_summary)}
         
-        ### New Incoming Message:
-        {new_message}
+        {incoming}
         
         ### Instructions:
-        1. Analyze the new message for strategic shifts, commitments, or risks.
+        1. Analyze the new message(s) for strategic shifts, commitments, or risks.
         2. Update the 'rolling_summary' JSON object.
         3. Maintain a high 'Confidence Score'—if information is ambiguous, mark it as 'needs_clarification'.
         4. Focus on:
@@ -78,27 +222,88 @@ class DeepSeekService:
             "needs_clarification": ["Ambiguous points to follow up on"]
         }}
         """
-        
-        response = self.client.chat.completions.create(
+
+    def _summary_cache_key(self, current_summary: Dict[str, Any], new_messages: List[str]) -> str:
+        payload = json.dumps([self.model, SUMMARY_PROMPT_VERSION, current_summary, new_messages], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def _complete_summary(self, current_summary: Dict[str, Any], new_messages: List[str],
+                                use_cache: Optional[bool] = None) -> Dict[str, Any]:
+        if use_cache is None:
+            use_cache = _use_summary_cache.get()
+        key = self._summary_cache_key(current_summary, new_messages)
+        if use_cache:
+            cached = _summary_cache.get(key)
+            if cached is not None:
+                metrics.increment("llm.summarize.cache_hits")
+                return json.loads(cached)
+            metrics.increment("llm.summarize.cache_misses")
+
+        prompt = self._build_summary_prompt(current_summary, new_messages)
+        response = await self._call("summarize", lambda: self.client.chat.completions.create(
             model=self.model,
             messages=[
                 {"role": "system", "content": "You are a strategic AI assistant for a startup founder. Output only valid JSON."},
                 {"role": "user", "content": prompt}
             ],
             response_format={"type": "json_object"}
-        )
+        ))
         
-        return json.loads(response.choices[0].message.content)
+        content = response.choices[0].message.content
+        summary = json.loads(content)
+        # Stored as JSON so callers never share (and mutate) a cached dict
+        _summary_cache.set(key, content)
+        metrics.set_gauge("llm.summarize.cache_size", len(_summary_cache))
+        return summary
+
+    async def summarize_thread(self, current_summary: Dict[str, Any], new_message: str,
+                               use_cache: Optional[bool] = None) -> Dict[str, Any]:
+        """
+        Optimized for DeepSeek-V3-Distill-Llama-70B:
+        Recursive Summarization with strategic reasoning.
+        Replays of the same (summary, message) pair are served from the summary cache
+        unless use_cache is False (default: on, unless bypass_summary_cache is active).
+        """
+        return await self._complete_summary(current_summary, [new_message], use_cache)
+
+    async def summarize_thread_batch(self, current_summary: Dict[str, Any], new_messages: List[str],
+                                     use_cache: Optional[bool] = None) -> Dict[str, Any]:
+        """
+        Fold several new messages of one thread into the rolling summary.
+        Messages are packed into as few prompts as the token budget allows,
+        so a thread costs one LLM call per chunk instead of one per message.
+        """
+        summary = current_summary
+        for chunk in chunk_messages(new_messages, self.batch_token_budget):
+            summary = await self._complete_summary(summary, chunk, use_cache)
+        return summary
 
     async def get_embedding(self, text: str):
         """
         Get vector embedding for search.
         """
-        # Note: Scaleway DeepSeek might not support embeddings directly, 
-        # but if it does, use this. Otherwise, use OpenAI embeddings.
-        response = self.client.embeddings.create(
-            input=text,
-            model="text-embedding-3-small" # Or equivalent
-        )
-        return response.data[0].embedding
+        return (await self.get_embeddings([text]))[0]
+
+    async def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed several texts with one multi-input request. Output order matches input.
+        Texts already in the embedding cache (or repeated within the batch) are not sent.
+        """
+        keys = [content_hash(self.embedding_model, text) for text in texts]
+        vectors = await self.embedding_cache.get_many(keys)
+        pending: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                pending.setdefault(key, text)
 
+        if pending:
+            # Note: Scaleway DeepSeek might not support embeddings directly, 
+            # but if it does, use this. Otherwise, use OpenAI embeddings.
+            response = await self._call("embedding", lambda: self.client.embeddings.create(
+                input=list(pending.values()),
+                model=self.embedding_model
+            ))
+            fresh = list(zip(pending, (item.embedding for item in sorted(response.data, key=lambda d: d.index))))
+            await self.embedding_cache.put_many(self.embedding_model, fresh)
+            vectors.update(fresh)
+        return [vectors[key] for key in keys]
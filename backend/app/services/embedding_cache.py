@@ -0,0 +1,97 @@
+"""
+Content-addressed embedding cache.
+
+Vectors are keyed by sha256(model + text), so the same text is embedded once
+no matter which thread, message or meeting it came from. Lookups go through an
+in-process LRU first and the embedding_cache table second; only the remaining
+misses reach the embedding model. Table reads and writes run in a worker
+thread, so memory hits never wait and the event loop never blocks on the
+database. Counters: embeddings.cache.{hits,db_hits,misses}.
+"""
+import os
+import asyncio
+import array
+import hashlib
+import logging
+from functools import lru_cache
+from typing import Dict, List, Iterable, Tuple
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from app.models import SessionLocal, EmbeddingCacheEntry
+from app.utils import metrics
+from app.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+EMBEDDING_CACHE_DB = os.getenv("EMBEDDING_CACHE_DB", "true").lower() == "true"
+
+def content_hash(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    def __init__(self, maxsize: int = EMBEDDING_CACHE_SIZE, use_db: bool = EMBEDDING_CACHE_DB):
+        # Vectors are held as float32 arrays (pgvector's precision) to keep the LRU compact
+        self.memory = LRUCache(maxsize)
+        self.use_db = use_db
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, List[float]]:
+        keys = list(keys)
+        found: Dict[str, List[float]] = {}
+        missing = []
+        for key in keys:
+            vector = self.memory.get(key)
+            if vector is not None:
+                found[key] = vector.tolist()
+            else:
+                missing.append(key)
+        metrics.increment("embeddings.cache.hits", len(found))
+
+        if missing and self.use_db:
+            try:
+                rows = await asyncio.to_thread(self._load, missing)
+                for key, embedding in rows:
+                    vector = array.array("f", embedding)
+                    self.memory.set(key, vector)
+                    found[key] = vector.tolist()
+                metrics.increment("embeddings.cache.db_hits", len(rows))
+            except SQLAlchemyError as e:
+                logger.warning(f"[Compass] Embedding cache lookup failed: {e}")
+
+        metrics.increment("embeddings.cache.misses", len(keys) - len(found))
+        metrics.set_gauge("embeddings.cache.size", len(self.memory))
+        return found
+
+    async def put_many(self, model: str, entries: Iterable[Tuple[str, List[float]]]):
+        rows = []
+        for key, vector in entries:
+            self.memory.set(key, array.array("f", vector))
+            rows.append({"content_hash": key, "model": model, "embedding": vector})
+        metrics.set_gauge("embeddings.cache.size", len(self.memory))
+        if not rows or not self.use_db:
+            return
+        try:
+            await asyncio.to_thread(self._store, rows)
+        except SQLAlchemyError as e:
+            logger.warning(f"[Compass] Embedding cache write failed: {e}")
+
+    @staticmethod
+    def _load(keys: List[str]) -> List[Tuple[str, List[float]]]:
+        with SessionLocal() as db:
+            return db.query(EmbeddingCacheEntry.content_hash, EmbeddingCacheEntry.embedding).filter(
+                EmbeddingCacheEntry.content_hash.in_(keys)
+            ).all()
+
+    @staticmethod
+    def _store(rows: List[Dict]):
+        with SessionLocal() as db:
+            db.execute(insert(EmbeddingCacheEntry).values(rows).on_conflict_do_nothing(index_elements=["content_hash"]))
+            db.commit()
+
+    def clear(self):
+        self.memory.clear()
+
+@lru_cache(maxsize=None)
+def get_embedding_cache() -> EmbeddingCache:
+    """Process-wide cache shared by every DeepSeekService instance."""
+    return EmbeddingCache()
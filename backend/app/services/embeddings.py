@@ -0,0 +1,140 @@
+"""
+Embedding pipeline for the pgvector columns.
+
+Rows whose vector is NULL are selected in id order, embedded in multi-input
+batches and written back with one bulk UPDATE per batch, committed as it goes.
+A run that stops half-way simply resumes on the rows that are still NULL.
+Thread vectors are cleared whenever the rolling summary changes, so the same
+pass also refreshes stale summaries.
+"""
+import os
+import re
+import math
+import hashlib
+import logging
+from typing import Dict, Any, List, Optional, Iterable
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from app.models import Thread, Message, Meeting, EMBEDDING_DIM
+from app.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_MAX_CHARS = int(os.getenv("EMBEDDING_MAX_CHARS", "24000"))
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "llm")  # 'llm' or 'hash'
+EMBED_ON_SYNC = os.getenv("EMBED_ON_SYNC", "true").lower() == "true"
+
+class HashEmbedder:
+    """
+    Deterministic local embedder (signed feature hashing over word tokens).
+    No network, same text -> same vector; used for tests and offline backfills.
+    """
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+
+    def embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dim
+        for token in re.findall(r"\w+", text.lower()):
+            digest = hashlib.sha256(token.encode("utf-8")).digest()
+            bucket = int.from_bytes(digest[:4], "big") % self.dim
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    async def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed(text) for text in texts]
+
+def get_embedder():
+    """The configured embedder: the shared LLM client, or HashEmbedder when EMBEDDING_BACKEND=hash."""
+    if EMBEDDING_BACKEND == "hash":
+        return HashEmbedder()
+    from app.services.registry import get_deepseek_service
+    return get_deepseek_service()
+
+def thread_text(thread: Thread) -> str:
+    summary = thread.rolling_summary or {}
+    parts = [thread.title or "", summary.get("strategic_context") or ""]
+    for key in ("key_decisions", "leverage_points", "needs_clarification"):
+        parts.extend(str(item) for item in summary.get(key) or [])
+    parts.extend(task.get("description", "") for task in summary.get("pending_tasks") or [] if isinstance(task, dict))
+    return "\n".join(p for p in parts if p)
+
+def message_text(message: Message) -> str:
+    return message.cleaned_content or message.raw_content or ""
+
+def meeting_text(meeting: Meeting) -> str:
+    return "\n".join(p for p in (meeting.title, meeting.positioning_notes, meeting.transcript) if p)
+
+# table name -> (model, vector column attribute, text builder)
+EMBED_TARGETS: Dict[str, tuple] = {
+    "threads": (Thread, "summary_vector", thread_text),
+    "messages": (Message, "message_vector", message_text),
+    "meetings": (Meeting, "meeting_vector", meeting_text),
+}
+
+class EmbeddingPipeline:
+    def __init__(self, db: Session, embedder=None, batch_size: int = EMBEDDING_BATCH_SIZE):
+        self.db = db
+        self.embedder = embedder or get_embedder()
+        self.batch_size = batch_size
+
+    async def embed_pending(self, table: str, ids: Optional[Iterable[Any]] = None, limit: Optional[int] = None) -> int:
+        """
+        Embed rows of `table` that have no vector yet, optionally restricted to ids.
+        Returns the number of rows written.
+        """
+        model, column_name, to_text = EMBED_TARGETS[table]
+        vector_column = getattr(model, column_name)
+        id_filter = list(ids) if ids is not None else None
+        if id_filter is not None and not id_filter:
+            return 0
+
+        written = 0
+        last_id = None
+        while limit is None or written < limit:
+            query = self.db.query(model).filter(vector_column == None)
+            if id_filter is not None:
+                query = query.filter(model.id.in_(id_filter))
+            if last_id is not None:
+                # Keyset pagination, so rows without text are passed over instead of reselected
+                query = query.filter(model.id > last_id)
+            # The last batch is clamped so `limit` is never overshot
+            batch_size = self.batch_size if limit is None else min(self.batch_size, limit - written)
+            rows = query.order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            pending = [(row.id, to_text(row)[:EMBEDDING_MAX_CHARS]) for row in rows]
+            pending = [(row_id, text) for row_id, text in pending if text.strip()]
+            if not pending:
+                continue
+
+            with metrics.timer(f"embeddings.{table}.batch_ms"):
+                vectors = await self.embedder.get_embeddings([text for _, text in pending])
+            self.db.execute(update(model), [
+                {"id": row_id, column_name: vector} for (row_id, _), vector in zip(pending, vectors)
+            ])
+            self.db.commit()
+            written += len(pending)
+            metrics.increment(f"embeddings.{table}.written", len(pending))
+        return written
+
+    async def backfill(self, tables: Iterable[str] = EMBED_TARGETS.keys(), limit: Optional[int] = None) -> Dict[str, int]:
+        return {table: await self.embed_pending(table, limit=limit) for table in tables}
+
+async def embed_synced_content(db: Session, message_ids: Iterable[str], thread_ids: Iterable[str]):
+    """
+    Incremental step after a sync: embed the new messages and the threads whose
+    summaries were just rewritten. Failures are logged; the backfill CLI catches up.
+    """
+    if not EMBED_ON_SYNC:
+        return
+    try:
+        pipeline = EmbeddingPipeline(db)
+        await pipeline.embed_pending("messages", ids=message_ids)
+        await pipeline.embed_pending("threads", ids=thread_ids)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"[Compass] Incremental embedding failed: {e}")
@@ -1,100 +1,136 @@
 import httpx
 import os
-from typing import List, Dict, Any
-from app.services.deepseek import DeepSeekService
-from app.services.agent import CompassAgent
-from app.models import Thread, Message
-from datetime import datetime
+from typing import List, Dict, Any, Optional
+from app.services.agent import ThreadBatch, queue_message, queue_unsummarized
+from app.services.embeddings import embed_synced_content
+from app.services.config_cache import get_setting
+from app.services.nango import NangoClient, NangoError, RecordWatermark, v2_model_name
+from app.services.registry import get_deepseek_service, get_compass_agent
+from app.repository import existing_message_ids, load_threads, bulk_upsert_threads, bulk_insert_messages
+from datetime import datetime, timezone
 import uuid
 
 class GmailService:
     def __init__(self, db_session):
-        self.nango_secret = os.getenv("NANGO_SECRET_KEY")
-        self.deepseek = DeepSeekService()
-        self.agent = CompassAgent()
+        self.nango_secret = get_setting("NANGO_SECRET_KEY")
+        self.nango = NangoClient(self.nango_secret)
+        self.deepseek = get_deepseek_service()
+        self.agent = get_compass_agent()
         self.db = db_session
 
-    async def sync_gmail_threads(self, connection_id: str, model: str = "gmail-sync"):
+    async def sync_gmail_threads(self, connection_id: str, model: Optional[str] = None,
+                                 provider_config_key: str = "google-mail", api_version: Optional[str] = None):
         """
-        Sync threads from Gmail via Nango.
-        Tries both Nango v1 and v2 URL patterns to find data.
+        Sync threads from Gmail via Nango, streaming records page by page and only
+        asking for records modified since the stored watermark.
+        Without an explicit model, the working (API version, model) pair is
+        discovered once per connection and reused on every later sync.
         """
-        records = []
-        async with httpx.AsyncClient() as client:
-            # TRY V1 PATTERN
-            v1_url = f"https://api.nango.dev/sync/records?model={model}&connectionId={connection_id}"
-            try:
-                res = await client.get(v1_url, headers={"Authorization": f"Bearer {self.nango_secret}", "Accept": "application/json"})
-                if res.status_code == 200 and "application/json" in res.headers.get("content-type", ""):
-                    records = res.json().get("records", [])
-            except:
-                pass
+        if model is None:
+            resolved = await self.nango.resolve_model(self.db, connection_id, provider_config_key)
+            if not resolved:
+                print(f"DEBUG: No working Gmail model found for connection {connection_id}")
+                return {"status": "no_model_found"}
+            api_version, model = resolved
+            sources = [resolved]
+        elif api_version:
+            sources = [(api_version, model)]
+        else:
+            # Explicit model without a version: try both Nango v1 and v2 URL patterns
+            sources = [("v1", model), ("v2", v2_model_name(model))]
 
-            # IF V1 FAILED, TRY V2 PATTERN
-            if not records:
-                # Nango v2 capitalization rule: model must start with Capital
-                model_v2 = model[0].upper() + model[1:] if model else model
-                v2_url = f"https://api.nango.dev/records?model={model_v2}&connection_id={connection_id}"
-                try:
-                    res = await client.get(v2_url, headers={"Authorization": f"Bearer {self.nango_secret}", "Accept": "application/json"})
-                    if res.status_code == 200 and "application/json" in res.headers.get("content-type", ""):
-                        records = res.json().get("records", [])
-                except:
-                    pass
+        watermark = RecordWatermark(self.db, connection_id, model)
+        total_records = processed = threads = 0
 
-        if not records:
-            print(f"DEBUG: No records found for model {model} using both v1 and v2")
+        for source_version, version_model in sources:
+            try:
+                async for records in self.nango.iter_record_pages(connection_id, version_model, source_version, modified_after=watermark.modified_after):
+                    if not records:
+                        continue
+                    print(f"DEBUG: Page of {len(records)} records for model {version_model} ({source_version}). First record: {str(records[0])[:500]}")
+                    total_records += len(records)
+                    watermark.observe(records)
+                    page_processed, page_threads = await self._process_records(records)
+                    processed += page_processed
+                    threads += page_threads
+            except (NangoError, httpx.HTTPError) as e:
+                print(f"DEBUG: Nango {source_version} records failed for model {version_model}: {e}")
+                if len(sources) == 1:
+                    # The cached pair stopped working; rediscover on the next sync
+                    self.nango.forget_model(self.db, connection_id)
+                    return {"status": "error", "message": str(e)}
+                continue
+            # IF V1 FOUND NOTHING ON A FIRST SYNC, TRY V2 PATTERN
+            if total_records or watermark.modified_after:
+                break
+
+        if not total_records:
+            print(f"DEBUG: No new records found for model {model}")
             return {"status": "no_records_found", "tried_model": model}
 
-        # 2. Process records into threads and messages
-        print(f"DEBUG: Found {len(records)} records for model {model}. First record: {str(records[0])[:500]}")
-        count = 0
+        watermark.save()
+        self.db.commit()
+        return {"status": "success", "model": model, "processed_records": processed, "threads": threads, "fetched_records": total_records}
+
+    async def _process_records(self, records: List[Dict[str, Any]]):
+        """
+        Store one page of records and run the agent on the new messages.
+        Returns (new_messages, threads_summarized).
+        """
+        thread_rows, message_rows, parsed = [], [], []
+        existing_ids = existing_message_ids(self.db, [record.get("id") for record in records])
         for record in records:
             try:
                 # Nango standard Gmail fields often use 'id', 'body', 'subject'
                 thread_id = record.get("threadId") or record.get("id")
                 message_body = record.get("body") or record.get("text") or record.get("snippet") or ""
                 
-                # Check if thread exists, else create
-                thread = self.db.query(Thread).filter(Thread.id == thread_id).first()
-                if not thread:
-                    thread = Thread(id=thread_id, title=record.get("subject", "No Subject"))
-                    self.db.add(thread)
-                
-                # Trigger Agent
+                # Records already stored are not re-summarized
+                msg_id = record.get("id") or str(uuid.uuid4())
+                if msg_id in existing_ids:
+                    continue
+
+                timestamp = datetime.utcnow() # Fallback
+                if record.get("date"):
+                    try:
+                        timestamp = datetime.fromisoformat(record.get("date").replace('Z', '+00:00'))
+                    except:
+                        pass
+
+                thread_rows.append({"id": thread_id, "title": record.get("subject", "No Subject"), "last_updated": datetime.utcnow()})
+                message_rows.append({
+                    "id": msg_id,
+                    "thread_id": thread_id,
+                    "source": "gmail",
+                    "raw_content": message_body,
+                    "timestamp": timestamp
+                })
                 sender_info = {
                     "email": record.get("from_email") or record.get("from", ""),
                     "name": record.get("from_name") or ""
                 }
-                
-                await self.agent.run(
-                    thread_id=thread_id,
-                    message=message_body,
-                    current_summary=thread.rolling_summary or {},
-                    sender_info=sender_info
-                )
-                
-                # Save message
-                msg_id = record.get("id") or str(uuid.uuid4())
-                existing_msg = self.db.query(Message).filter(Message.id == msg_id).first()
-                if not existing_msg:
-                    msg = Message(
-                        id=msg_id,
-                        thread_id=thread_id,
-                        source="gmail",
-                        raw_content=message_body,
-                        timestamp=datetime.utcnow() # Fallback
-                    )
-                    if record.get("date"):
-                        try:
-                            msg.timestamp = datetime.fromisoformat(record.get("date").replace('Z', '+00:00'))
-                        except:
-                            pass
-                    self.db.add(msg)
-                    count += 1
+                parsed.append((timestamp, msg_id, thread_id, message_body, sender_info))
             except Exception as e:
                 print(f"Error processing record: {e}")
                 continue
+        # Pages are not ordered by date; the agent needs each thread's messages oldest first
+        parsed.sort(key=lambda item: item[0] if item[0].tzinfo else item[0].replace(tzinfo=timezone.utc))
         
+        # Batched upserts; duplicate IDs are skipped instead of raising
+        bulk_upsert_threads(self.db, thread_rows)
+        inserted_ids = bulk_insert_messages(self.db, message_rows)
+        threads = load_threads(self.db, [row["id"] for row in thread_rows])
+
+        # Queue for the agent, one run per thread
+        batches: Dict[str, ThreadBatch] = {}
+        for _, msg_id, thread_id, message_body, sender_info in parsed:
+            if msg_id in inserted_ids:
+                queue_message(batches, thread_id, message_body, threads[thread_id].rolling_summary or {}, sender_info, msg_id)
+        # Plus messages whose summarization failed in an earlier sync
+        queue_unsummarized(self.db, batches)
         self.db.commit()
-        return {"status": "success", "processed_records": count}
+
+        # Threads are committed first so the agent's summary writes can see them
+        await self.agent.run_threads(batches)
+        await embed_synced_content(self.db, inserted_ids, batches.keys())
+        return len(inserted_ids), len(batches)
@@ -2,28 +2,45 @@
 Direct Gmail API Integration (No Nango)
 Handles OAuth flow and email fetching directly from Google.
 """
+import asyncio
 import httpx
 import os
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 from urllib.parse import urlencode
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from app.models import OAuthToken, Thread, Message
-from app.services.agent import CompassAgent
+from app.models import OAuthToken
+from app.repository import existing_message_ids, load_threads, bulk_upsert_threads, bulk_insert_messages
+from app.services.agent import ThreadBatch, queue_message, queue_unsummarized
+from app.services.embeddings import embed_synced_content
+from app.services.registry import get_compass_agent
+from app.services.sync_state import get_sync_state, save_sync_state
+from app.utils.resilience import request_with_retry
 import logging
 import base64
 
 logger = logging.getLogger(__name__)
 
+# Messages listed at most when the historyId checkpoint has expired and the gap is re-read
+GMAIL_RESYNC_MAX_MESSAGES = int(os.getenv("GMAIL_RESYNC_MAX_MESSAGES", "5000"))
+
+class HistoryExpiredError(Exception):
+    """Raised when Gmail no longer retains history for the stored historyId."""
+
 class GmailDirectService:
-    def __init__(self, db_session: Session):
+    def __init__(self, db_session: Optional[Session]):
         self.db = db_session
-        self.agent = CompassAgent()
+        self.agent = get_compass_agent()
         
         # OAuth Configuration
         self.client_id = os.getenv("GOOGLE_CLIENT_ID")
         self.client_secret = os.getenv("GOOGLE_CLIENT_SECRET")
         self.redirect_uri = os.getenv("GOOGLE_REDIRECT_URI", "https://lexa-pa-api-l5lm3.ondigitalocean.app/auth/gmail/callback")
+        # Gmail API (overridable so the fetch engine can run against a local stub server)
+        self.api_base = os.getenv("GMAIL_API_BASE", "https://gmail.googleapis.com/gmail/v1/users/me")
+        self.fetch_concurrency = int(os.getenv("GMAIL_FETCH_CONCURRENCY", "10"))
+        self.http_timeout = float(os.getenv("GMAIL_HTTP_TIMEOUT", "30"))
         self.scopes = [
             "https://www.googleapis.com/auth/gmail.readonly",
             "https://www.googleapis.com/auth/userinfo.email"
@@ -73,13 +90,18 @@ class GmailDirectService:
             response.raise_for_status()
             return response.json()
     
-    def save_token(self, token_data: Dict[str, Any], user_email: str = None):
-        """Save or update OAuth token in database"""
-        # Check if token exists
-        existing = self.db.query(OAuthToken).filter(
+    def load_token(self, session: Optional[Session] = None) -> Optional[OAuthToken]:
+        """The stored Gmail token row, if any"""
+        return (session or self.db).query(OAuthToken).filter(
             OAuthToken.provider == "gmail",
             OAuthToken.user_id == "default_user"
         ).first()
+
+    def save_token(self, token_data: Dict[str, Any], user_email: str = None, session: Optional[Session] = None):
+        """Save or update OAuth token in database (self.db unless a session is given)"""
+        db = session or self.db
+        # Check if token exists
+        existing = self.load_token(db)
         
         expiry = None
         if "expires_in" in token_data:
@@ -103,17 +125,21 @@ class GmailDirectService:
                 scopes=self.scopes,
                 metadata={"email": user_email} if user_email else {}
             )
-            self.db.add(new_token)
+            db.add(new_token)
         
-        self.db.commit()
+        db.commit()
         logger.info(f"[Compass] Gmail token saved for user: {user_email or 'default'}")
     
-    async def get_valid_token(self) -> Optional[str]:
-        """Get a valid access token, refreshing if necessary"""
-        token_record = self.db.query(OAuthToken).filter(
-            OAuthToken.provider == "gmail",
-            OAuthToken.user_id == "default_user"
-        ).first()
+    async def get_valid_token(self, db: Optional[AsyncSession] = None) -> Optional[str]:
+        """
+        Get a valid access token, refreshing if necessary.
+        With db, the token row is read and saved through that AsyncSession
+        (for async handlers) instead of the service's sync session.
+        """
+        async def run(fn):
+            return await db.run_sync(fn) if db is not None else fn(self.db)
+
+        token_record = await run(self.load_token)
         
         if not token_record:
             logger.warning("[Compass] No Gmail token found in database")
@@ -125,7 +151,7 @@ class GmailDirectService:
             if token_record.refresh_token:
                 try:
                     new_token_data = await self.refresh_access_token(token_record.refresh_token)
-                    self.save_token(new_token_data)
+                    await run(lambda session: self.save_token(new_token_data, session=session))
                     return new_token_data["access_token"]
                 except Exception as e:
                     logger.error(f"[Compass] Failed to refresh token: {e}")
@@ -136,33 +162,160 @@ class GmailDirectService:
         
         return token_record.access_token
     
+    def _auth_headers(self, access_token: str) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {access_token}"}
+
+    async def _get_json(self, client: httpx.AsyncClient, path: str, access_token: str, params: Dict[str, Any] = None) -> Dict[str, Any]:
+        """GET a Gmail API resource, retrying 429/5xx with backoff"""
+        response = await request_with_retry(
+            client, "GET", f"{self.api_base}{path}",
+            headers=self._auth_headers(access_token),
+            params=params
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def list_message_ids(self, client: httpx.AsyncClient, access_token: str, max_results: int = 50, label_id: str = "INBOX") -> List[str]:
+        """List message IDs, following nextPageToken until max_results is reached"""
+        message_ids = []
+        page_token = None
+        while len(message_ids) < max_results:
+            params = {"maxResults": min(max_results - len(message_ids), 500), "labelIds": label_id}
+            if page_token:
+                params["pageToken"] = page_token
+            page = await self._get_json(client, "/messages", access_token, params)
+            message_ids.extend(m["id"] for m in page.get("messages", []))
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                break
+        return message_ids[:max_results]
+
+    async def list_unseen_message_ids(self, client: httpx.AsyncClient, access_token: str, max_results: int = GMAIL_RESYNC_MAX_MESSAGES,
+                                      label_id: str = "INBOX") -> Tuple[List[str], bool]:
+        """
+        List message IDs newest first, page by page, until reaching a page with
+        IDs that are already stored (everything older was synced before) or
+        max_results. Returns (unseen_ids, capped); capped means max_results
+        stopped the listing before a stored message was reached.
+        """
+        message_ids = []
+        page_token = None
+        while len(message_ids) < max_results:
+            params = {"maxResults": min(max_results - len(message_ids), 500), "labelIds": label_id}
+            if page_token:
+                params["pageToken"] = page_token
+            page = await self._get_json(client, "/messages", access_token, params)
+            page_ids = [m["id"] for m in page.get("messages", [])]
+            known = existing_message_ids(self.db, page_ids)
+            message_ids.extend(msg_id for msg_id in page_ids if msg_id not in known)
+            page_token = page.get("nextPageToken")
+            if known or not page_token:
+                return message_ids, False
+        return message_ids, True
+
+    async def fetch_message_details(self, client: httpx.AsyncClient, access_token: str, message_ids: List[str], skip_missing: bool = False) -> List[Dict[str, Any]]:
+        """
+        Fetch full messages concurrently, bounded by fetch_concurrency. Preserves input order.
+        With skip_missing, messages deleted since they were listed (404) are dropped instead of raising.
+        Any other failure cancels the remaining fetches before the client is closed.
+        """
+        semaphore = asyncio.Semaphore(self.fetch_concurrency)
+
+        async def fetch_one(msg_id: str) -> Optional[Dict[str, Any]]:
+            async with semaphore:
+                try:
+                    return await self._get_json(client, f"/messages/{msg_id}", access_token, {"format": "full"})
+                except httpx.HTTPStatusError as e:
+                    if skip_missing and e.response.status_code == 404:
+                        return None
+                    raise
+
+        try:
+            async with asyncio.TaskGroup() as group:
+                tasks = [group.create_task(fetch_one(msg_id)) for msg_id in message_ids]
+        except ExceptionGroup as e:
+            # Surface the first failure, as gather did
+            raise e.exceptions[0]
+        results = [task.result() for task in tasks]
+        return [msg for msg in results if msg is not None]
+
+    async def list_history_message_ids(self, client: httpx.AsyncClient, access_token: str, start_history_id: str, label_id: str = "INBOX") -> Tuple[List[str], str]:
+        """
+        List IDs of messages added since start_history_id via users.history.list.
+        Returns (message_ids, latest_history_id). Raises HistoryExpiredError if Gmail
+        no longer holds history that far back.
+        """
+        message_ids = []
+        seen = set()
+        latest_history_id = start_history_id
+        page_token = None
+        while True:
+            params = {"startHistoryId": start_history_id, "historyTypes": "messageAdded", "labelId": label_id, "maxResults": 500}
+            if page_token:
+                params["pageToken"] = page_token
+            try:
+                page = await self._get_json(client, "/history", access_token, params)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code == 404:
+                    raise HistoryExpiredError(start_history_id) from e
+                raise
+            for record in page.get("history", []):
+                for added in record.get("messagesAdded", []):
+                    msg_id = added["message"]["id"]
+                    if msg_id not in seen:
+                        seen.add(msg_id)
+                        message_ids.append(msg_id)
+            latest_history_id = page.get("historyId", latest_history_id)
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                break
+        return message_ids, latest_history_id
+
+    async def fetch_new_messages(self, max_results: int = 50) -> Tuple[List[Dict[str, Any]], str, str]:
+        """
+        Fetch messages added since the stored historyId checkpoint.
+        Without a checkpoint, fetches the latest max_results messages. When the
+        checkpoint has expired, lists back until already-stored messages (up to
+        GMAIL_RESYNC_MAX_MESSAGES) so the gap is not skipped.
+        Returns (messages, history_id, mode).
+        """
+        access_token = await self.get_valid_token()
+        if not access_token:
+            raise Exception("No valid Gmail token available. Please reconnect Gmail.")
+
+        checkpoint = get_sync_state(self.db, "gmail", "default_user", "history")
+        async with httpx.AsyncClient(timeout=self.http_timeout) as client:
+            expired = False
+            if checkpoint and checkpoint.cursor:
+                try:
+                    message_ids, history_id = await self.list_history_message_ids(client, access_token, checkpoint.cursor)
+                    messages = await self.fetch_message_details(client, access_token, message_ids, skip_missing=True)
+                    return messages, history_id, "incremental"
+                except HistoryExpiredError:
+                    logger.warning(f"[Compass] Gmail historyId {checkpoint.cursor} expired, falling back to full resync")
+                    expired = True
+
+            # Read the mailbox historyId before listing so nothing added mid-sync is missed next time
+            profile = await self._get_json(client, "/profile", access_token)
+            if expired:
+                message_ids, capped = await self.list_unseen_message_ids(client, access_token)
+                if capped:
+                    logger.warning(f"[Compass] Gmail resync stopped at GMAIL_RESYNC_MAX_MESSAGES={GMAIL_RESYNC_MAX_MESSAGES} "
+                                   f"before reaching stored messages; older mail in the gap is not synced")
+            else:
+                message_ids = await self.list_message_ids(client, access_token, max_results=max_results)
+            messages = await self.fetch_message_details(client, access_token, message_ids, skip_missing=True)
+            return messages, profile["historyId"], "resync" if expired else "full"
+
     async def fetch_messages(self, max_results: int = 50) -> List[Dict[str, Any]]:
         """Fetch recent messages from Gmail"""
         access_token = await self.get_valid_token()
         if not access_token:
             raise Exception("No valid Gmail token available. Please reconnect Gmail.")
         
-        messages = []
-        async with httpx.AsyncClient() as client:
-            # List message IDs
-            list_response = await client.get(
-                "https://gmail.googleapis.com/gmail/v1/users/me/messages",
-                headers={"Authorization": f"Bearer {access_token}"},
-                params={"maxResults": max_results, "labelIds": "INBOX"}
-            )
-            list_response.raise_for_status()
-            message_list = list_response.json().get("messages", [])
-            
-            # Fetch full message details
-            for msg_ref in message_list[:max_results]:
-                msg_id = msg_ref["id"]
-                msg_response = await client.get(
-                    f"https://gmail.googleapis.com/gmail/v1/users/me/messages/{msg_id}",
-                    headers={"Authorization": f"Bearer {access_token}"},
-                    params={"format": "full"}
-                )
-                msg_response.raise_for_status()
-                messages.append(msg_response.json())
+        async with httpx.AsyncClient(timeout=self.http_timeout) as client:
+            message_ids = await self.list_message_ids(client, access_token, max_results=max_results)
+            messages = await self.fetch_message_details(client, access_token, message_ids)
         
         logger.info(f"[Compass] Fetched {len(messages)} messages from Gmail")
         return messages
@@ -185,13 +338,21 @@ class GmailDirectService:
         return ""
     
     async def sync_messages(self) -> Dict[str, Any]:
-        """Sync messages from Gmail to local database"""
+        """Sync new messages from Gmail to local database, using the historyId checkpoint when available"""
         try:
-            messages = await self.fetch_messages(max_results=50)
-            processed = 0
+            messages, history_id, mode = await self.fetch_new_messages(max_results=50)
+
+            # One query for all already-stored IDs instead of a lookup per message
+            existing_ids = existing_message_ids(self.db, [msg["id"] for msg in messages])
+            
+            # Oldest first, so each thread's messages fold into its summary in order
+            messages.sort(key=lambda m: int(m.get("internalDate", 0)))
+            thread_rows, message_rows, parsed = [], [], []
             
             for msg in messages:
                 msg_id = msg["id"]
+                if msg_id in existing_ids:
+                    continue
                 thread_id = msg["threadId"]
                 headers = msg["payload"].get("headers", [])
                 
@@ -209,43 +370,41 @@ class GmailDirectService:
                     logger.debug(f"[Compass] Skipping message {msg_id} - no body content")
                     continue
                 
-                # Check if message already exists
-                existing = self.db.query(Message).filter(Message.id == msg_id).first()
-                if existing:
-                    continue
-                
-                # Get or create thread
-                thread = self.db.query(Thread).filter(Thread.id == thread_id).first()
-                if not thread:
-                    thread = Thread(id=thread_id, title=subject)
-                    self.db.add(thread)
-                
-                # Run agent for summarization and entity detection
-                sender_info = {"email": from_email, "name": from_name}
-                await self.agent.run(
-                    thread_id=thread_id,
-                    message=body,
-                    current_summary=thread.rolling_summary or {},
-                    sender_info=sender_info
-                )
-                
-                # Save message
-                new_message = Message(
-                    id=msg_id,
-                    thread_id=thread_id,
-                    source="gmail",
-                    raw_content=body,
-                    timestamp=timestamp
-                )
-                self.db.add(new_message)
-                processed += 1
+                thread_rows.append({"id": thread_id, "title": subject, "last_updated": datetime.utcnow()})
+                message_rows.append({
+                    "id": msg_id,
+                    "thread_id": thread_id,
+                    "source": "gmail",
+                    "raw_content": body,
+                    "timestamp": timestamp
+                })
+                parsed.append((msg_id, thread_id, body, {"email": from_email, "name": from_name}))
+            
+            # Batched upserts; IDs stored concurrently by another sync are skipped, not errors
+            bulk_upsert_threads(self.db, thread_rows)
+            inserted_ids = bulk_insert_messages(self.db, message_rows)
+            threads = load_threads(self.db, [row["id"] for row in thread_rows])
+
+            # Queue for summarization and entity detection, one agent run per thread
+            batches: Dict[str, ThreadBatch] = {}
+            for msg_id, thread_id, body, sender_info in parsed:
+                if msg_id in inserted_ids:
+                    queue_message(batches, thread_id, body, threads[thread_id].rolling_summary or {}, sender_info, msg_id)
+            # Plus messages whose summarization failed in an earlier sync
+            queue_unsummarized(self.db, batches)
             
+            # Advance the checkpoint in the same transaction as the messages it covers
+            save_sync_state(self.db, "gmail", "default_user", "history", cursor=str(history_id))
             self.db.commit()
-            logger.info(f"[Compass] Successfully processed {processed} new messages")
-            return {"status": "success", "processed": processed, "total_fetched": len(messages)}
+
+            # Threads are committed first so the agent's summary writes can see them
+            await self.agent.run_threads(batches)
+            await embed_synced_content(self.db, inserted_ids, batches.keys())
+            processed = len(inserted_ids)
+            logger.info(f"[Compass] Successfully processed {processed} new messages in {len(batches)} threads ({mode} sync)")
+            return {"status": "success", "mode": mode, "processed": processed, "total_fetched": len(messages)}
             
         except Exception as e:
             logger.error(f"[Compass] Error syncing Gmail messages: {e}")
             self.db.rollback()
             raise
-
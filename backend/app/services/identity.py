@@ -0,0 +1,194 @@
+"""
+Identity resolution for message senders.
+
+Exact matches go through an in-process cache of every entity keyed by
+normalized email and Slack ID, so they cost a dict lookup instead of a query.
+The cache reloads after any Entity insert/update/delete in this process, and
+at least every ENTITY_CACHE_TTL_SECONDS, so writes from other processes show
+up too. Name-only senders are matched fuzzily with pg_trgm: candidates come
+from the entities_name_trgm_idx GIN index and are ranked by similarity, capped
+at IDENTITY_MATCH_LIMIT. Where pg_trgm is not installed, names fall back to
+an ILIKE on the name's words over at most IDENTITY_FALLBACK_CANDIDATES rows,
+ranked in Python. Fuzzy results are cached per normalized name until the next
+invalidation.
+"""
+import os
+import re
+import time
+import threading
+import logging
+from difflib import SequenceMatcher
+from email.utils import parseaddr
+from typing import Dict, Any, List, Optional
+from sqlalchemy import event, func, select, text, or_
+from sqlalchemy.orm import Session
+from app.models import Entity
+from app.utils import metrics
+from app.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+IDENTITY_MATCH_LIMIT = int(os.getenv("IDENTITY_MATCH_LIMIT", "5"))
+IDENTITY_MIN_SIMILARITY = float(os.getenv("IDENTITY_MIN_SIMILARITY", "0.3"))
+ENTITY_CACHE_TTL_SECONDS = float(os.getenv("ENTITY_CACHE_TTL_SECONDS", "300"))
+IDENTITY_FALLBACK_CANDIDATES = int(os.getenv("IDENTITY_FALLBACK_CANDIDATES", "50"))
+
+# Providers that ignore dots in the local part
+_DOTLESS_DOMAINS = {"gmail.com": "gmail.com", "googlemail.com": "gmail.com"}
+
+def normalize_email(value: Optional[str]) -> Optional[str]:
+    """'Jane Doe <Jane.Doe+deals@GoogleMail.com>' -> 'janedoe@gmail.com'"""
+    if not value:
+        return None
+    address = parseaddr(value)[1].strip().lower()
+    if address.startswith("mailto:"):
+        address = address[len("mailto:"):]
+    local, sep, domain = address.rpartition("@")
+    if not sep or not local or not domain:
+        return None
+    local = local.split("+", 1)[0]
+    if domain in _DOTLESS_DOMAINS:
+        local = local.replace(".", "")
+        domain = _DOTLESS_DOMAINS[domain]
+    return f"{local}@{domain}"
+
+def normalize_slack_id(value: Optional[str]) -> Optional[str]:
+    """'<@u024be7lh|bob>' -> 'U024BE7LH'"""
+    if not value:
+        return None
+    value = value.strip().strip("<>").lstrip("@").split("|", 1)[0]
+    return value.upper() or None
+
+def normalize_name(value: Optional[str]) -> Optional[str]:
+    if not value:
+        return None
+    value = re.sub(r"[^\w\s'-]", " ", value.casefold())
+    return " ".join(value.split()) or None
+
+def _match(entity_id: Any, name: str, match: str, score: float = 1.0) -> Dict[str, Any]:
+    return {"id": str(entity_id), "name": name, "match": match, "score": round(score, 3)}
+
+class EntityCache:
+    def __init__(self, ttl: float = ENTITY_CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._by_email: Dict[str, tuple] = {}
+        self._by_slack: Dict[str, tuple] = {}
+        self._loaded_at: Optional[float] = None
+        self._trgm = False
+        self.fuzzy = LRUCache(2048)
+
+    def invalidate(self):
+        self._loaded_at = None
+        self.fuzzy.clear()
+
+    def _ensure_loaded(self, db: Session):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return
+            by_email, by_slack = {}, {}
+            for entity_id, name, email, slack_id in db.execute(
+                select(Entity.id, Entity.name, Entity.email, Entity.slack_id)
+            ):
+                if normalize_email(email):
+                    by_email[normalize_email(email)] = (entity_id, name)
+                if normalize_slack_id(slack_id):
+                    by_slack[normalize_slack_id(slack_id)] = (entity_id, name)
+            self._by_email, self._by_slack = by_email, by_slack
+            self._trgm = db.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+            self.fuzzy.clear()
+            self._loaded_at = time.monotonic()
+            metrics.increment("identity.cache.reloads")
+            metrics.set_gauge("identity.cache.entities", len(by_email) + len(by_slack))
+
+    def by_email(self, db: Session, email: str) -> Optional[tuple]:
+        self._ensure_loaded(db)
+        return self._by_email.get(email)
+
+    def by_slack_id(self, db: Session, slack_id: str) -> Optional[tuple]:
+        self._ensure_loaded(db)
+        return self._by_slack.get(slack_id)
+
+    def has_trgm(self, db: Session) -> bool:
+        """Whether the pg_trgm extension is installed (rechecked on every reload)."""
+        self._ensure_loaded(db)
+        return self._trgm
+
+entity_cache = EntityCache()
+
+@event.listens_for(Entity, "after_insert")
+@event.listens_for(Entity, "after_update")
+@event.listens_for(Entity, "after_delete")
+def _invalidate_entity_cache(mapper, connection, target):
+    entity_cache.invalidate()
+
+class IdentityResolver:
+    def __init__(self, db: Session, cache: EntityCache = entity_cache, limit: int = IDENTITY_MATCH_LIMIT):
+        self.db = db
+        self.cache = cache
+        self.limit = limit
+
+    def resolve(self, sender: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Candidate entities for a sender, best first: a single exact email or
+        Slack ID match, otherwise up to `limit` fuzzy name matches.
+        """
+        email = normalize_email(sender.get("email"))
+        if email:
+            hit = self.cache.by_email(self.db, email)
+            if hit:
+                metrics.increment("identity.matches.email")
+                return [_match(*hit, "email")]
+
+        slack_id = normalize_slack_id(sender.get("slack_id"))
+        if slack_id:
+            hit = self.cache.by_slack_id(self.db, slack_id)
+            if hit:
+                metrics.increment("identity.matches.slack")
+                return [_match(*hit, "slack")]
+
+        name = normalize_name(sender.get("name"))
+        if not name:
+            return []
+        cached = self.cache.fuzzy.get(name)
+        if cached is not None:
+            metrics.increment("identity.fuzzy.cache_hits")
+            return cached
+        matches = self.fuzzy_matches(name)
+        self.cache.fuzzy.set(name, matches)
+        return matches
+
+    def fuzzy_matches(self, name: str) -> List[Dict[str, Any]]:
+        """Top-k trigram matches on entities.name (served by entities_name_trgm_idx)."""
+        if not self.cache.has_trgm(self.db):
+            return self.ilike_matches(name)
+        # Transaction-local threshold for the % operator, so the index does the filtering
+        self.db.execute(text("SELECT set_config('pg_trgm.similarity_threshold', :v, true)"),
+                        {"v": str(IDENTITY_MIN_SIMILARITY)})
+        similarity = func.similarity(Entity.name, name)
+        with metrics.timer("identity.fuzzy.query_ms"):
+            rows = self.db.execute(
+                select(Entity.id, Entity.name, similarity.label("score"))
+                .where(Entity.name.op("%")(name))
+                .order_by(similarity.desc())
+                .limit(self.limit)
+            ).all()
+        return [_match(row.id, row.name, "name", row.score) for row in rows]
+
+    def ilike_matches(self, name: str) -> List[Dict[str, Any]]:
+        """Fallback without pg_trgm: names containing any word of `name`, ranked by similarity."""
+        words = [re.sub(r"([\\%_])", r"\\\1", word) for word in name.split() if len(word) > 1]
+        if not words:
+            return []
+        metrics.increment("identity.fuzzy.ilike_fallback")
+        with metrics.timer("identity.fuzzy.query_ms"):
+            rows = self.db.execute(
+                select(Entity.id, Entity.name)
+                .where(or_(*(Entity.name.ilike(f"%{word}%", escape="\\") for word in words)))
+                .limit(IDENTITY_FALLBACK_CANDIDATES)
+            ).all()
+        scored = [(row, SequenceMatcher(None, normalize_name(row.name) or "", name).ratio()) for row in rows]
+        scored = sorted((item for item in scored if item[1] >= IDENTITY_MIN_SIMILARITY), key=lambda item: item[1], reverse=True)
+        return [_match(row.id, row.name, "name", score) for row, score in scored[:self.limit]]
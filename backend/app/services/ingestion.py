@@ -1,52 +1,50 @@
 import httpx
 import os
 from sqlalchemy.orm import Session
-from app.models import IngestionAuditLog, SessionLocal
+from app.models import IngestionAuditLog
 from app.services.gmail import GmailService
+from app.services.gmail_direct import GmailDirectService
+from app.services.deepseek import bypass_summary_cache
 from app.services.slack import SlackService
 import logging
 
 logger = logging.getLogger(__name__)
 
-async def process_ingestion(audit_log_id: str):
+# Jobs enqueued by /gmail/sync for the direct (non-Nango) Gmail integration
+GMAIL_DIRECT_PLATFORM = "gmail-direct"
+
+# Sync results that mean nothing was ingested; raised so the queue retries the job
+FAILED_SYNC_STATUSES = {"error", "no_model_found"}
+
+class IngestionError(Exception):
+    pass
+
+async def process_ingestion(db: Session, audit_entry: IngestionAuditLog) -> str:
     """
-    Background task to process a Nango webhook event.
+    Process one Nango webhook event claimed from the ingestion queue.
+    Returns the final job status; raises on failure so the queue can retry it.
     """
-    db = SessionLocal()
-    audit_entry = db.query(IngestionAuditLog).filter(IngestionAuditLog.id == audit_log_id).first()
+    connection_id = audit_entry.source_uuid
+    platform = audit_entry.source_platform
     
-    if not audit_entry:
-        logger.error(f"Audit entry {audit_log_id} not found.")
-        db.close()
-        return
-
-    try:
-        connection_id = audit_entry.source_uuid
-        platform = audit_entry.source_platform
-        
-        # Determine service based on platform
-        if any(x in platform for x in ["google-gmail", "gmail", "google-mail"]):
-            service = GmailService(db)
-            await service.sync_gmail_threads(connection_id)
-        elif "slack" in platform:
-            service = SlackService(db)
-            await service.sync_slack_messages(connection_id)
-        else:
-            logger.warning(f"Unknown platform: {platform}")
-            audit_entry.status = "ignored"
-            db.commit()
-            db.close()
-            return
-
-        audit_entry.status = "processed"
-        db.commit()
-        logger.info(f"Successfully processed ingestion for {connection_id} on {platform}")
+    # Determine service based on platform
+    if platform == GMAIL_DIRECT_PLATFORM:
+        with bypass_summary_cache(bool((audit_entry.raw_payload or {}).get("refresh"))):
+            result = await GmailDirectService(db).sync_messages()
+    elif any(x in platform for x in ["google-gmail", "gmail", "google-mail"]):
+        service = GmailService(db)
+        result = await service.sync_gmail_threads(connection_id, provider_config_key=platform)
+    elif "slack" in platform:
+        service = SlackService(db)
+        result = await service.sync_slack_messages(connection_id)
+    else:
+        logger.warning(f"Unknown platform: {platform}")
+        return "ignored"
 
-    except Exception as e:
-        logger.error(f"Error processing ingestion: {e}")
-        audit_entry.status = "failed"
-        audit_entry.error_message = str(e)
-        db.commit()
-    finally:
-        db.close()
+    # The sync services report failures in their result instead of raising
+    status = (result or {}).get("status")
+    if status in FAILED_SYNC_STATUSES:
+        raise IngestionError(f"{platform} sync for {connection_id} returned {status}: {result.get('message', '')}")
 
+    logger.info(f"Successfully processed ingestion for {connection_id} on {platform}")
+    return "processed"
@@ -0,0 +1,274 @@
+"""
+Durable ingestion work queue on top of ingestion_audit_log.
+
+Webhooks insert a row with status 'received'. Workers claim due rows with
+SELECT ... FOR UPDATE SKIP LOCKED, so any number of worker processes can share
+the table. Failed jobs are retried with exponential backoff until
+INGESTION_MAX_ATTEMPTS, then parked in the 'dead' state. Jobs whose worker died
+mid-run become claimable again after INGESTION_LOCK_TIMEOUT_SECONDS; while a job
+runs, its worker refreshes the claim every INGESTION_HEARTBEAT_SECONDS, so a
+long sync is never taken over by another worker.
+
+Events are coalesced per connection (source_platform, source_uuid): a new
+webhook for a connection that already has a pending job is recorded as
+'coalesced' and debounces that job instead of adding another sync. A connection
+with a sync in flight is not claimed again until it finishes; events that arrive
+meanwhile are folded into the next run.
+
+Which process owns the queue: in the Procfile deployment the `worker` process
+(scripts/ingestion_worker.py) runs every job and the `web` process only
+enqueues (INGESTION_WORKERS=0), so long syncs never run on the API's event loop.
+Without a dedicated worker, the API runs INGESTION_WORKERS in-process workers.
+"""
+import asyncio
+import os
+import socket
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, List
+from sqlalchemy import or_, and_, func, exists, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased
+from app.models import IngestionAuditLog, SessionLocal
+from app.services.ingestion import process_ingestion
+from app.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# In-process workers for the API (0 when a dedicated worker runs); also the worker script's default concurrency
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))
+INGESTION_MAX_ATTEMPTS = int(os.getenv("INGESTION_MAX_ATTEMPTS", "5"))
+INGESTION_RETRY_BASE_SECONDS = float(os.getenv("INGESTION_RETRY_BASE_SECONDS", "30"))
+INGESTION_LOCK_TIMEOUT_SECONDS = float(os.getenv("INGESTION_LOCK_TIMEOUT_SECONDS", "900"))
+INGESTION_HEARTBEAT_SECONDS = float(os.getenv("INGESTION_HEARTBEAT_SECONDS", str(INGESTION_LOCK_TIMEOUT_SECONDS / 3)))
+INGESTION_POLL_SECONDS = float(os.getenv("INGESTION_POLL_SECONDS", "5"))
+INGESTION_DEBOUNCE_SECONDS = float(os.getenv("INGESTION_DEBOUNCE_SECONDS", "5"))
+INGESTION_DEBOUNCE_MAX_SECONDS = float(os.getenv("INGESTION_DEBOUNCE_MAX_SECONDS", "60"))
+
+PENDING_STATUSES = ("received", "retry")
+
+def _as_utc(value: datetime) -> datetime:
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+def _same_connection(job, other) -> Any:
+    return and_(other.source_platform == job.source_platform, other.source_uuid == job.source_uuid)
+
+def enqueue(db: Session, source_uuid: str, source_platform: str, payload: Dict[str, Any]) -> IngestionAuditLog:
+    """
+    Record a webhook event. If the connection already has a job waiting, the event
+    is stored as 'coalesced' and that job's start is pushed back by the debounce
+    window (never beyond INGESTION_DEBOUNCE_MAX_SECONDS after it was first queued).
+    The caller owns the commit.
+    """
+    now = datetime.now(timezone.utc)
+    pending = db.query(IngestionAuditLog).filter(
+        IngestionAuditLog.source_platform == source_platform,
+        IngestionAuditLog.source_uuid == source_uuid,
+        IngestionAuditLog.status == "received"
+    ).order_by(IngestionAuditLog.created_at).with_for_update(skip_locked=True).first()
+
+    if pending:
+        latest_start = _as_utc(pending.created_at) + timedelta(seconds=INGESTION_DEBOUNCE_MAX_SECONDS)
+        pending.available_at = min(now + timedelta(seconds=INGESTION_DEBOUNCE_SECONDS), latest_start)
+        job = IngestionAuditLog(
+            source_uuid=source_uuid,
+            source_platform=source_platform,
+            raw_payload=payload,
+            status="coalesced",
+            attempts=0,
+            coalesced_into=pending.id
+        )
+        metrics.increment("ingestion.events.coalesced")
+    else:
+        job = IngestionAuditLog(
+            source_uuid=source_uuid,
+            source_platform=source_platform,
+            raw_payload=payload,
+            status="received",
+            attempts=0,
+            available_at=now + timedelta(seconds=INGESTION_DEBOUNCE_SECONDS)
+        )
+    db.add(job)
+    return job
+
+def claim_job(db: Session, worker_id: str) -> Optional[IngestionAuditLog]:
+    """
+    Atomically claim the oldest due job whose connection has no sync in flight,
+    or return None if there is nothing to do. Other pending events for the same
+    connection are marked 'coalesced' into the claimed job. The claim is committed
+    before the job runs so other workers skip it.
+    """
+    stale_before = datetime.now(timezone.utc) - timedelta(seconds=INGESTION_LOCK_TIMEOUT_SECONDS)
+    inflight = aliased(IngestionAuditLog)
+    connection_busy = exists().where(
+        _same_connection(IngestionAuditLog, inflight),
+        inflight.id != IngestionAuditLog.id,
+        inflight.status == "processing",
+        inflight.locked_at >= stale_before
+    )
+    job = db.query(IngestionAuditLog).filter(
+        or_(
+            and_(
+                IngestionAuditLog.status.in_(PENDING_STATUSES),
+                or_(IngestionAuditLog.available_at == None, IngestionAuditLog.available_at <= func.now())
+            ),
+            and_(IngestionAuditLog.status == "processing", IngestionAuditLog.locked_at < stale_before)
+        ),
+        ~connection_busy
+    ).order_by(IngestionAuditLog.created_at).with_for_update(skip_locked=True).first()
+
+    if not job:
+        db.rollback()
+        return None
+
+    job.status = "processing"
+    job.attempts = (job.attempts or 0) + 1
+    job.locked_at = datetime.now(timezone.utc)
+    job.locked_by = worker_id
+
+    # One sync covers every event queued so far for this connection
+    siblings = db.query(IngestionAuditLog).filter(
+        IngestionAuditLog.source_platform == job.source_platform,
+        IngestionAuditLog.source_uuid == job.source_uuid,
+        IngestionAuditLog.status.in_(PENDING_STATUSES),
+        IngestionAuditLog.id != job.id
+    ).with_for_update(skip_locked=True).all()
+    for sibling in siblings:
+        sibling.status = "coalesced"
+        sibling.coalesced_into = job.id
+
+    try:
+        db.commit()
+    except IntegrityError:
+        # Another worker started a sync for this connection first
+        db.rollback()
+        return None
+    if siblings:
+        metrics.increment("ingestion.events.coalesced", len(siblings))
+    return job
+
+def finish_job(db: Session, job: IngestionAuditLog, status: str):
+    job.status = status
+    job.error_message = None
+    job.locked_at = None
+    job.locked_by = None
+    db.commit()
+    metrics.increment(f"ingestion.jobs.{status}")
+
+def fail_job(db: Session, job: IngestionAuditLog, error: Exception):
+    """Schedule a retry with exponential backoff, or dead-letter the job once attempts run out."""
+    job.error_message = str(error)
+    job.locked_at = None
+    job.locked_by = None
+    if job.attempts >= INGESTION_MAX_ATTEMPTS:
+        job.status = "dead"
+        metrics.increment("ingestion.jobs.dead")
+        logger.error(f"[Compass] Ingestion job {job.id} dead after {job.attempts} attempts: {error}")
+    else:
+        delay = INGESTION_RETRY_BASE_SECONDS * (2 ** (job.attempts - 1))
+        job.status = "retry"
+        job.available_at = datetime.now(timezone.utc) + timedelta(seconds=delay)
+        metrics.increment("ingestion.jobs.retried")
+        logger.warning(f"[Compass] Ingestion job {job.id} failed (attempt {job.attempts}), retrying in {delay:.0f}s: {error}")
+    db.commit()
+
+def refresh_claim(job_id: Any, worker_id: str) -> bool:
+    """Move locked_at forward on a job this worker still holds. Uses its own session."""
+    with SessionLocal() as db:
+        result = db.execute(
+            update(IngestionAuditLog).where(
+                IngestionAuditLog.id == job_id,
+                IngestionAuditLog.status == "processing",
+                IngestionAuditLog.locked_by == worker_id
+            ).values(locked_at=datetime.now(timezone.utc))
+        )
+        db.commit()
+        return result.rowcount > 0
+
+async def _heartbeat(job_id: Any, worker_id: str):
+    while True:
+        await asyncio.sleep(INGESTION_HEARTBEAT_SECONDS)
+        try:
+            if not await asyncio.to_thread(refresh_claim, job_id, worker_id):
+                logger.warning(f"[Compass] Ingestion job {job_id} is no longer claimed by {worker_id}")
+                return
+        except Exception as e:
+            logger.warning(f"[Compass] Could not refresh claim on ingestion job {job_id}: {e}")
+
+def _fail_after_error(db: Session, job_id: Any, error: Exception):
+    # The sync may have left the session mid-transaction; reload the job cleanly
+    db.rollback()
+    job = db.query(IngestionAuditLog).filter(IngestionAuditLog.id == job_id).first()
+    fail_job(db, job, error)
+
+async def run_next_job(worker_id: str) -> bool:
+    """Claim and run one job. Returns False when the queue had nothing due."""
+    db = SessionLocal()
+    try:
+        job = await asyncio.to_thread(claim_job, db, worker_id)
+        if not job:
+            return False
+        job_id = job.id
+        heartbeat = asyncio.create_task(_heartbeat(job_id, worker_id))
+        try:
+            with metrics.timer("ingestion.job.duration_ms"):
+                status = await process_ingestion(db, job)
+        except Exception as e:
+            heartbeat.cancel()
+            await asyncio.to_thread(_fail_after_error, db, job_id, e)
+            return True
+        finally:
+            heartbeat.cancel()
+        await asyncio.to_thread(finish_job, db, job, status)
+        return True
+    finally:
+        db.close()
+
+class IngestionWorkerPool:
+    """
+    Runs `concurrency` worker loops in the current event loop.
+    Workers poll every INGESTION_POLL_SECONDS and are woken early by notify().
+    """
+    def __init__(self, concurrency: int = INGESTION_WORKERS):
+        self.concurrency = concurrency
+        self.worker_prefix = f"{socket.gethostname()}-{os.getpid()}"
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+
+    def notify(self):
+        """Wake idle workers, e.g. right after a webhook enqueued a job."""
+        self._wakeup.set()
+
+    def start(self):
+        self._stopping = False
+        for i in range(self.concurrency):
+            self._tasks.append(asyncio.create_task(self._worker(f"{self.worker_prefix}-{i}")))
+        logger.info(f"[Compass] Started {self.concurrency} ingestion workers")
+
+    async def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self, worker_id: str):
+        while not self._stopping:
+            try:
+                if await run_next_job(worker_id):
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[Compass] Ingestion worker {worker_id} error: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=INGESTION_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def run_forever(self):
+        self.start()
+        await asyncio.gather(*self._tasks)
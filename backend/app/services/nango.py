@@ -0,0 +1,188 @@
+"""
+Nango records API client.
+Streams records page by page following next_cursor, so a sync holds at most one
+page in memory, and tracks a per-connection/model modified_after watermark in
+sync_state so each sync only sees records changed since the last one.
+"""
+import os
+import httpx
+from typing import Dict, Any, List, Optional, AsyncIterator, Tuple
+from sqlalchemy.orm import Session
+from app.services.config_cache import get_setting
+from app.services.sync_state import get_sync_state, save_sync_state, clear_sync_state
+from app.utils.resilience import request_with_retry
+
+NANGO_API_BASE = os.getenv("NANGO_API_BASE", "https://api.nango.dev")
+NANGO_PAGE_LIMIT = int(os.getenv("NANGO_PAGE_LIMIT", "500"))
+
+NANGO_SYNC_CONCURRENCY = int(os.getenv("NANGO_SYNC_CONCURRENCY", "4"))
+
+# Endpoints that describe configured syncs and their models (also probed by /nango/debug-all-syncs)
+SYNC_CONFIG_ENDPOINTS = [
+    "/scripts/config",
+    "/sync/configurations",
+    "/sync-configs",
+    "/sync/status",
+    "/sync/definitions"
+]
+# Model names tried when the sync configuration does not list any
+GMAIL_MODEL_CANDIDATES = ["Message", "Thread", "gmail-sync", "emails", "google-mail"]
+
+# (connection_id -> (api_version, model)) resolved in this process
+_resolved_models: Dict[str, Tuple[str, str]] = {}
+
+class NangoError(Exception):
+    """Raised when Nango answers with an error status or a non-JSON body."""
+
+def record_modified_at(record: Dict[str, Any]) -> Optional[str]:
+    """The last_modified_at Nango stamps on every record (ISO 8601), if present."""
+    return (record.get("_nango_metadata") or {}).get("last_modified_at")
+
+class RecordWatermark:
+    """
+    modified_after checkpoint for one (connection, model), stored in sync_state.
+    Feed it every page with observe(); save() persists the newest timestamp seen.
+    """
+    def __init__(self, db: Session, connection_id: str, model: str):
+        self.db = db
+        self.connection_id = connection_id
+        self.model = model
+        state = get_sync_state(db, "nango", connection_id, model)
+        self.modified_after = state.cursor if state else None
+        self.latest = self.modified_after
+
+    def observe(self, records: List[Dict[str, Any]]):
+        for record in records:
+            modified_at = record_modified_at(record)
+            # ISO 8601 timestamps in the same zone compare correctly as strings
+            if modified_at and (self.latest is None or modified_at > self.latest):
+                self.latest = modified_at
+
+    def save(self):
+        """Persist the watermark. The caller owns the commit."""
+        if self.latest and self.latest != self.modified_after:
+            save_sync_state(self.db, "nango", self.connection_id, self.model, cursor=self.latest)
+
+def v2_model_name(model: str) -> str:
+    # Nango v2 capitalization rule: model must start with Capital
+    return model[0].upper() + model[1:] if model else model
+
+def _collect_models(data: Any, provider_config_key: str, matched: bool = False) -> List[str]:
+    """
+    Pull model names out of a sync-configuration payload. Only entries that belong
+    to provider_config_key count; the payload shapes differ between Nango versions.
+    """
+    models: List[str] = []
+    if isinstance(data, list):
+        for item in data:
+            models.extend(_collect_models(item, provider_config_key, matched))
+    elif isinstance(data, dict):
+        key = data.get("providerConfigKey") or data.get("provider_config_key") or data.get("unique_key")
+        matched = matched or key == provider_config_key
+        for name, value in data.items():
+            if name == "models" and matched and isinstance(value, list):
+                models.extend(m.get("name") if isinstance(m, dict) else m for m in value)
+            elif isinstance(value, (dict, list)):
+                models.extend(_collect_models(value, provider_config_key, matched))
+    return [m for m in dict.fromkeys(models) if isinstance(m, str) and m]
+
+class NangoClient:
+    def __init__(self, secret: Optional[str] = None):
+        self.secret = secret or get_setting("NANGO_SECRET_KEY")
+        self.base_url = NANGO_API_BASE
+
+    def _headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.secret}", "Accept": "application/json"}
+
+    async def iter_record_pages(self, connection_id: str, model: str, api_version: str = "v2",
+                                modified_after: Optional[str] = None,
+                                limit: int = NANGO_PAGE_LIMIT) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Yield pages of records for one connection and model until next_cursor runs out.
+        api_version 'v1' uses /sync/records, 'v2' uses /records.
+        """
+        if api_version == "v1":
+            url = f"{self.base_url}/sync/records"
+            params = {"model": model, "connectionId": connection_id, "limit": limit}
+            if modified_after:
+                params["delta"] = modified_after
+        else:
+            url = f"{self.base_url}/records"
+            params = {"model": model, "connection_id": connection_id, "limit": limit}
+            if modified_after:
+                params["modified_after"] = modified_after
+
+        async with httpx.AsyncClient(timeout=30) as client:
+            cursor = None
+            while True:
+                page_params = {**params, "cursor": cursor} if cursor else params
+                res = await request_with_retry(client, "GET", url, headers=self._headers(), params=page_params)
+                if res.status_code != 200 or "application/json" not in res.headers.get("content-type", ""):
+                    raise NangoError(f"{api_version} {model}: HTTP {res.status_code} {res.text[:200]}")
+                data = res.json()
+                yield data.get("records", [])
+                cursor = data.get("next_cursor")
+                if not cursor:
+                    break
+
+    async def list_sync_models(self, provider_config_key: str) -> List[str]:
+        """Model names configured for an integration, from the first sync-config endpoint that answers."""
+        async with httpx.AsyncClient(timeout=15) as client:
+            for path in SYNC_CONFIG_ENDPOINTS:
+                try:
+                    res = await client.get(f"{self.base_url}{path}", headers=self._headers())
+                    if res.status_code != 200 or "application/json" not in res.headers.get("content-type", ""):
+                        continue
+                    models = _collect_models(res.json(), provider_config_key)
+                    if models:
+                        return models
+                except httpx.HTTPError:
+                    continue
+        return []
+
+    async def probe(self, connection_id: str, model: str, api_version: str, require_records: bool) -> bool:
+        """Whether a (version, model) pair answers for this connection, optionally with data."""
+        pages = self.iter_record_pages(connection_id, model, api_version, limit=1)
+        try:
+            records = await pages.__anext__()
+            return bool(records) or not require_records
+        except (NangoError, httpx.HTTPError, StopAsyncIteration):
+            return False
+        finally:
+            await pages.aclose()
+
+    async def resolve_model(self, db: Session, connection_id: str, provider_config_key: str,
+                            candidates: List[str] = GMAIL_MODEL_CANDIDATES) -> Optional[Tuple[str, str]]:
+        """
+        The working (api_version, model) pair for a connection. Discovered once, then
+        served from memory and the sync_state table ('model_discovery' resource).
+        Models listed in the sync configuration are trusted if the endpoint answers;
+        fallback candidates must actually return records.
+        """
+        if connection_id in _resolved_models:
+            return _resolved_models[connection_id]
+
+        state = get_sync_state(db, "nango", connection_id, "model_discovery")
+        if state and state.state and state.state.get("model"):
+            resolved = (state.state["api_version"], state.state["model"])
+            _resolved_models[connection_id] = resolved
+            return resolved
+
+        configured = await self.list_sync_models(provider_config_key)
+        attempts = [(model, False) for model in configured]
+        attempts += [(model, True) for model in candidates if model not in configured]
+        for model, require_records in attempts:
+            for api_version, version_model in (("v2", v2_model_name(model)), ("v1", model)):
+                if await self.probe(connection_id, version_model, api_version, require_records):
+                    save_sync_state(db, "nango", connection_id, "model_discovery",
+                                    state={"api_version": api_version, "model": version_model})
+                    db.commit()
+                    _resolved_models[connection_id] = (api_version, version_model)
+                    return api_version, version_model
+        return None
+
+    def forget_model(self, db: Session, connection_id: str):
+        """Drop a resolved model (e.g. after it stopped working) so the next sync rediscovers it."""
+        _resolved_models.pop(connection_id, None)
+        clear_sync_state(db, "nango", connection_id, "model_discovery")
+        db.commit()
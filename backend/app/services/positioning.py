@@ -0,0 +1,226 @@
+"""
+Live meeting positioning advice for the local overlay bot.
+
+The active playbook is split into heading-scoped chunks and embedded once per
+playbook version; each request retrieves only the PLAYBOOK_TOP_K chunks closest
+to what was just said, so prompts stay small and time-to-first-token low.
+Advice is streamed as Server-Sent Events in the format local_bot expects: one
+word per `data:` line, `[CONFLICT]` first when the statement contradicts the
+playbook, and `[DONE]` last. SSE comment lines (`: ...`) carry timings.
+"""
+import os
+import re
+import math
+import time
+import asyncio
+import hashlib
+import logging
+from typing import AsyncIterator, List, Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models import Playbook
+from app.services.embeddings import get_embedder
+from app.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+PLAYBOOK_CHUNK_CHARS = int(os.getenv("PLAYBOOK_CHUNK_CHARS", "800"))
+PLAYBOOK_TOP_K = int(os.getenv("PLAYBOOK_TOP_K", "3"))
+POSITIONING_MAX_TOKENS = int(os.getenv("POSITIONING_MAX_TOKENS", "120"))
+# After a failed chunk embedding, how long to serve keyword retrieval before retrying
+PLAYBOOK_EMBED_RETRY_SECONDS = float(os.getenv("PLAYBOOK_EMBED_RETRY_SECONDS", "30"))
+
+CONFLICT_SIGNAL = "[CONFLICT]"
+DONE_SIGNAL = "[DONE]"
+
+POSITIONING_SYSTEM_PROMPT = (
+    "You are a real-time negotiation coach whispering to a startup founder during a live meeting. "
+    "Given what was just said and the relevant sections of the founder's playbook, reply with one "
+    "short, actionable piece of positioning advice (at most 30 words, plain text, no lists). "
+    f"If what was said conflicts with the playbook, start your reply with {CONFLICT_SIGNAL} and say how to respond."
+)
+
+def split_playbook(content: str, max_chars: int = PLAYBOOK_CHUNK_CHARS) -> List[str]:
+    """
+    Markdown-aware chunks: one per heading section, with its heading path kept as
+    a prefix so a chunk still makes sense alone; long sections split by paragraph.
+    """
+    chunks: List[str] = []
+    headings: List[str] = []
+    body: List[str] = []
+
+    def flush():
+        text = "\n".join(body).strip()
+        body.clear()
+        if not text:
+            return
+        prefix = " > ".join(headings)
+        current = ""
+        for paragraph in re.split(r"\n\s*\n", text):
+            if current and len(current) + len(paragraph) > max_chars:
+                chunks.append(f"{prefix}\n{current}".strip())
+                current = ""
+            current = f"{current}\n\n{paragraph}".strip()
+        if current:
+            chunks.append(f"{prefix}\n{current}".strip())
+
+    for line in content.splitlines():
+        heading = re.match(r"^(#{1,6})\s+(.*)", line)
+        if heading:
+            flush()
+            level = len(heading.group(1))
+            headings[:] = headings[:level - 1] + [heading.group(2).strip()]
+        else:
+            body.append(line)
+    flush()
+    return chunks
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def _terms(text: str) -> set:
+    return set(re.findall(r"\w{3,}", text.lower()))
+
+class PlaybookIndex:
+    def __init__(self, version: str, chunks: List[str], vectors: Optional[List[List[float]]]):
+        self.version = version
+        self.chunks = chunks
+        self.vectors = vectors
+        self.built_at = time.monotonic()
+
+    def is_current(self, version: str) -> bool:
+        """Same content, and embedded (or the last embedding attempt is recent enough)."""
+        if self.version != version:
+            return False
+        return self.vectors is not None or not self.chunks or \
+            time.monotonic() - self.built_at < PLAYBOOK_EMBED_RETRY_SECONDS
+
+    async def search(self, text: str, embedder, k: int = PLAYBOOK_TOP_K) -> List[str]:
+        if len(self.chunks) <= k:
+            return list(self.chunks)
+        scores = None
+        if self.vectors is not None:
+            try:
+                query = (await embedder.get_embeddings([text]))[0]
+                scores = [_cosine(query, vector) for vector in self.vectors]
+            except Exception as e:
+                logger.warning(f"[Compass] Playbook query embedding failed, using keyword overlap: {e}")
+        if scores is None:
+            terms = _terms(text)
+            scores = [len(terms & _terms(chunk)) for chunk in self.chunks]
+        ranked = sorted(range(len(self.chunks)), key=lambda i: scores[i], reverse=True)[:k]
+        # Keep playbook order so the prompt reads naturally
+        return [self.chunks[i] for i in sorted(ranked)]
+
+_index: Optional[PlaybookIndex] = None
+_index_lock = asyncio.Lock()
+_retry_task: Optional[asyncio.Task] = None
+
+def _version(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+async def build_playbook_index(content: str, embedder=None) -> PlaybookIndex:
+    embedder = embedder or get_embedder()
+    chunks = split_playbook(content)
+    vectors = None
+    if chunks:
+        try:
+            vectors = await embedder.get_embeddings(chunks)
+        except Exception as e:
+            logger.warning(f"[Compass] Playbook chunk embedding failed, falling back to keywords: {e}")
+    metrics.set_gauge("meeting.playbook.chunks", len(chunks))
+    return PlaybookIndex(_version(content), chunks, vectors)
+
+async def get_playbook_index(db: AsyncSession) -> Optional[PlaybookIndex]:
+    """
+    The index for the active playbook, rebuilt when its content changes. An
+    index whose chunk embeddings failed keeps serving keyword retrieval while
+    the embedding is retried in the background every PLAYBOOK_EMBED_RETRY_SECONDS.
+    """
+    global _retry_task
+    content = (await db.scalars(select(Playbook.content).where(Playbook.is_active == True).limit(1))).first()
+    if not content:
+        return None
+    version = _version(content)
+    if _index is None or _index.version != version:
+        await refresh_playbook_index(content)
+    elif not _index.is_current(version) and (_retry_task is None or _retry_task.done()):
+        metrics.increment("meeting.playbook.embed_retries")
+        _retry_task = asyncio.create_task(refresh_playbook_index(content))
+    return _index
+
+async def refresh_playbook_index(content: str):
+    """Precompute the index for new playbook content (startup, POST /playbook)."""
+    global _index
+    async with _index_lock:
+        if _index is None or not _index.is_current(_version(content)):
+            with metrics.timer("meeting.playbook.index_build_ms"):
+                _index = await build_playbook_index(content)
+
+def _sse(data: str) -> str:
+    return f"data: {data}\n\n"
+
+async def stream_positioning(text: str, index: Optional[PlaybookIndex], deepseek,
+                             received_at: Optional[float] = None) -> AsyncIterator[str]:
+    """
+    SSE lines of positioning advice for `text`. Words are emitted as soon as they
+    are complete; ttft_ms (request received -> first word) is reported as an SSE
+    comment and recorded under meeting.positioning.ttft_ms.
+    """
+    received_at = received_at or time.perf_counter()
+    sections: List[str] = []
+    if index is not None:
+        with metrics.timer("meeting.positioning.retrieval_ms"):
+            sections = await index.search(text, get_embedder())
+
+    playbook = "\n\n---\n\n".join(sections) if sections else "(no playbook configured)"
+    messages = [
+        {"role": "system", "content": POSITIONING_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Relevant playbook sections:\n{playbook}\n\nJust said in the meeting:\n{text}"}
+    ]
+
+    buffer = ""
+    first_word_sent = False
+
+    def emit(words: List[str]) -> List[str]:
+        nonlocal first_word_sent
+        lines = []
+        for word in words:
+            if not first_word_sent:
+                first_word_sent = True
+                ttft_ms = (time.perf_counter() - received_at) * 1000
+                metrics.observe("meeting.positioning.ttft_ms", ttft_ms)
+                lines.append(f": ttft_ms={ttft_ms:.0f}\n\n")
+                if word.startswith(CONFLICT_SIGNAL):
+                    metrics.increment("meeting.positioning.conflicts")
+                    lines.append(_sse(CONFLICT_SIGNAL))
+                    word = word[len(CONFLICT_SIGNAL):]
+                    if not word:
+                        continue
+            lines.append(_sse(word))
+        return lines
+
+    try:
+        async for delta in deepseek.stream_chat("positioning", messages, max_tokens=POSITIONING_MAX_TOKENS):
+            buffer += delta
+            # Everything up to the last whitespace is complete words
+            cut = max(buffer.rfind(" "), buffer.rfind("\n"))
+            if cut < 0:
+                continue
+            complete, buffer = buffer[:cut], buffer[cut + 1:]
+            for line in emit(complete.split()):
+                yield line
+        for line in emit(buffer.split()):
+            yield line
+    except Exception as e:
+        metrics.increment("meeting.positioning.errors")
+        logger.error(f"[Compass] Positioning stream failed: {e}")
+        yield f": error={type(e).__name__}\n\n"
+
+    total_ms = (time.perf_counter() - received_at) * 1000
+    metrics.observe("meeting.positioning.total_ms", total_ms)
+    logger.info(f"[Compass] Positioning advice streamed in {total_ms:.0f}ms")
+    yield f": total_ms={total_ms:.0f}\n\n"
+    yield _sse(DONE_SIGNAL)
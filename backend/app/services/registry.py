@@ -0,0 +1,23 @@
+"""
+Shared service instances.
+DeepSeekService (and its client) and CompassAgent (and its compiled LangGraph
+workflow) are built once per process instead of on every request.
+"""
+from functools import lru_cache
+from app.services.config_cache import invalidate_config
+from app.services.deepseek import DeepSeekService
+from app.services.agent import CompassAgent
+
+@lru_cache(maxsize=None)
+def get_deepseek_service() -> DeepSeekService:
+    return DeepSeekService()
+
+@lru_cache(maxsize=None)
+def get_compass_agent() -> CompassAgent:
+    return CompassAgent(deepseek=get_deepseek_service())
+
+def reset_services():
+    """Drop cached config and services so the next request rebuilds them from fresh settings."""
+    invalidate_config()
+    get_compass_agent.cache_clear()
+    get_deepseek_service.cache_clear()
@@ -0,0 +1,181 @@
+"""
+Semantic search over threads, messages and meetings.
+
+The query is embedded once, then each table is searched two ways: ANN over its
+pgvector column and Postgres full-text search over its text. The per-signal
+rankings are merged with reciprocal rank fusion (RRF), so a row that is close in
+vector space and matches the keywords ranks first. Each signal only reads the
+top SEARCH_CANDIDATES rows per table, which keeps latency low enough for type-ahead.
+"""
+import os
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Iterable, Union
+from sqlalchemy import String, func, literal_column, exists, and_, text
+from sqlalchemy.dialects.postgresql import asyncpg as postgresql_asyncpg
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, defer
+from app.models import Thread, Message, Meeting
+from app.services.embeddings import get_embedder
+from app.services.vector_index import distance_comparator, HNSW_EF_SEARCH, FTS_INDEXES
+
+logger = logging.getLogger(__name__)
+
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", "50"))
+SEARCH_IVFFLAT_PROBES = int(os.getenv("SEARCH_IVFFLAT_PROBES", "10"))
+RRF_K = 60
+
+SEARCH_KINDS = ("threads", "messages", "meetings")
+
+# Must match the expressions of the *_fts_idx GIN indexes so Postgres can use them.
+# The constants are inlined SQL, not bound parameters: asyncpg would compile
+# those to $1::VARCHAR casts and the planner would no longer match the index.
+FTS_CONFIG = literal_column("'english'::regconfig")
+_EMPTY = literal_column("''", String)
+_SPACE = literal_column("' '", String)
+THREAD_DOCUMENT = (func.coalesce(Thread.title, _EMPTY) + _SPACE
+                   + func.coalesce(Thread.rolling_summary.op('->>')(literal_column("'strategic_context'")), _EMPTY))
+MESSAGE_DOCUMENT = func.coalesce(Message.cleaned_content, Message.raw_content, _EMPTY)
+MEETING_DOCUMENT = func.coalesce(Meeting.title, _EMPTY) + _SPACE + func.coalesce(Meeting.transcript, _EMPTY)
+
+SEARCH_TARGETS: Dict[str, Dict[str, Any]] = {
+    "threads": {"model": Thread, "vector": Thread.summary_vector, "document": THREAD_DOCUMENT, "time": Thread.last_updated},
+    "messages": {"model": Message, "vector": Message.message_vector, "document": MESSAGE_DOCUMENT, "time": Message.timestamp},
+    "meetings": {"model": Meeting, "vector": Meeting.meeting_vector, "document": MEETING_DOCUMENT, "time": Meeting.start_time},
+}
+
+def check_fts_documents() -> List[str]:
+    """
+    Warn about search documents that no longer compile (for asyncpg) to exactly
+    the expression of their *_fts_idx index, i.e. FTS would seq-scan. Search
+    still works, only slower. Returns the mismatched kinds.
+    """
+    dialect = postgresql_asyncpg.dialect()
+    mismatched = []
+    for kind, target in SEARCH_TARGETS.items():
+        compiled = target["document"].compile(dialect=dialect)
+        sql = str(compiled).replace(f"{target['model'].__tablename__}.", "")
+        if compiled.params or FTS_INDEXES[kind] != f"to_tsvector('english'::regconfig, {sql})":
+            logger.warning(f"[Compass] {kind} search document does not match {kind}_fts_idx, full-text search will not use it: {sql}")
+            mismatched.append(kind)
+    return mismatched
+
+check_fts_documents()
+
+def _snippet(value: Optional[str], length: int = 240) -> str:
+    value = (value or "").strip()
+    return value if len(value) <= length else value[:length].rstrip() + "…"
+
+def _serialize(kind: str, row: Any) -> Dict[str, Any]:
+    if kind == "threads":
+        summary = row.rolling_summary or {}
+        return {"kind": kind, "id": row.id, "title": row.title, "snippet": _snippet(summary.get("strategic_context")),
+                "source": "slack" if row.id.startswith("SLACK-") else "gmail",
+                "timestamp": row.last_updated.isoformat() if row.last_updated else None}
+    if kind == "messages":
+        return {"kind": kind, "id": row.id, "thread_id": row.thread_id, "title": None,
+                "snippet": _snippet(row.cleaned_content or row.raw_content), "source": row.source,
+                "entity_id": str(row.entity_id) if row.entity_id else None,
+                "timestamp": row.timestamp.isoformat() if row.timestamp else None}
+    return {"kind": kind, "id": str(row.id), "title": row.title, "snippet": _snippet(row.positioning_notes or row.transcript),
+            "source": "meeting", "timestamp": row.start_time.isoformat() if row.start_time else None}
+
+class SemanticSearch:
+    def __init__(self, db: Union[Session, AsyncSession], embedder=None):
+        self.db = db
+        self.embedder = embedder or get_embedder()
+
+    def _filters(self, kind: str, source: Optional[str], entity_id: Optional[str],
+                 start: Optional[datetime], end: Optional[datetime]) -> Optional[List[Any]]:
+        """SQL filters for one table, or None when the filters rule the whole table out."""
+        target = SEARCH_TARGETS[kind]
+        clauses = []
+        if start:
+            clauses.append(target["time"] >= start)
+        if end:
+            clauses.append(target["time"] <= end)
+
+        if kind == "meetings":
+            if entity_id or (source and source != "meeting"):
+                return None
+        elif kind == "messages":
+            if source:
+                clauses.append(Message.source == source)
+            if entity_id:
+                clauses.append(Message.entity_id == entity_id)
+        else:
+            if source == "meeting":
+                return None
+            # A thread matches if any of its messages does
+            message_clauses = [Message.thread_id == Thread.id]
+            if source:
+                message_clauses.append(Message.source == source)
+            if entity_id:
+                message_clauses.append(Message.entity_id == entity_id)
+            if len(message_clauses) > 1:
+                clauses.append(exists().where(and_(*message_clauses)))
+        return clauses
+
+    def _vector_ranking(self, db: Session, kind: str, vector: List[float], clauses: List[Any], candidates: int) -> List[Any]:
+        target = SEARCH_TARGETS[kind]
+        return db.query(target["model"]).options(defer(target["vector"])).filter(
+            target["vector"] != None, *clauses
+        ).order_by(distance_comparator(target["vector"])(vector)).limit(candidates).all()
+
+    def _text_ranking(self, db: Session, kind: str, query: str, clauses: List[Any], candidates: int) -> List[Any]:
+        target = SEARCH_TARGETS[kind]
+        tsvector = func.to_tsvector(FTS_CONFIG, target["document"])
+        tsquery = func.websearch_to_tsquery(FTS_CONFIG, query)
+        return db.query(target["model"]).options(defer(target["vector"])).filter(
+            tsvector.op('@@')(tsquery), *clauses
+        ).order_by(func.ts_rank(tsvector, tsquery).desc()).limit(candidates).all()
+
+    async def search(self, query: str, kinds: Iterable[str] = SEARCH_KINDS, source: Optional[str] = None,
+                     entity_id: Optional[str] = None, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                     limit: int = 20, offset: int = 0, probes: Optional[int] = None, ef_search: Optional[int] = None,
+                     mode: str = "hybrid") -> Dict[str, Any]:
+        """
+        Ranked results across the requested tables. mode is 'hybrid' (vector + full-text),
+        'vector' or 'text'. probes and ef_search override ivfflat.probes and
+        hnsw.ef_search for this query only; whichever index type is built uses its own.
+        """
+        candidates = max(SEARCH_CANDIDATES, offset + limit)
+        vector = (await self.embedder.get_embeddings([query]))[0] if mode in ("hybrid", "vector") else None
+
+        def rank(db: Session):
+            # Transaction-local, so pooled connections keep their defaults
+            db.execute(text("SELECT set_config('ivfflat.probes', :probes, true)"),
+                       {"probes": str(probes or SEARCH_IVFFLAT_PROBES)})
+            db.execute(text("SELECT set_config('hnsw.ef_search', :ef_search, true)"),
+                       {"ef_search": str(max(ef_search or HNSW_EF_SEARCH, candidates))})
+
+            scores: Dict[tuple, float] = {}
+            rows: Dict[tuple, Any] = {}
+            for kind in kinds:
+                clauses = self._filters(kind, source, entity_id, start, end)
+                if clauses is None:
+                    continue
+                rankings = []
+                if vector is not None:
+                    rankings.append(self._vector_ranking(db, kind, vector, clauses, candidates))
+                if mode in ("hybrid", "text"):
+                    rankings.append(self._text_ranking(db, kind, query, clauses, candidates))
+                for ranking in rankings:
+                    for rank_position, row in enumerate(ranking):
+                        key = (kind, str(row.id))
+                        rows[key] = row
+                        scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank_position + 1)
+
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+            page = ranked[offset:offset + limit]
+            results = [{**_serialize(kind, rows[(kind, row_id)]), "score": round(score, 6)} for (kind, row_id), score in page]
+            # Read-only; ends the transaction that scoped the index settings
+            db.rollback()
+            return results, len(ranked)
+
+        # An AsyncSession runs the same queries on its greenlet-adapted connection
+        if isinstance(self.db, AsyncSession):
+            results, total = await self.db.run_sync(rank)
+        else:
+            results, total = rank(self.db)
+        return {"query": query, "total": total, "offset": offset, "limit": limit, "results": results}
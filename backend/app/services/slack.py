@@ -1,80 +1,89 @@
 import httpx
 import os
 from typing import List, Dict, Any
-from app.services.deepseek import DeepSeekService
-from app.services.agent import CompassAgent
-from app.models import Thread, Message
+from app.services.agent import ThreadBatch, queue_message, queue_unsummarized
+from app.services.embeddings import embed_synced_content
+from app.services.config_cache import get_setting
+from app.services.nango import NangoClient, NangoError, RecordWatermark
+from app.services.registry import get_deepseek_service, get_compass_agent
+from app.repository import load_threads, bulk_upsert_threads, bulk_insert_messages
 from datetime import datetime
 
 class SlackService:
     def __init__(self, db_session):
-        self.nango_secret = os.getenv("NANGO_SECRET_KEY")
-        self.deepseek = DeepSeekService()
-        self.agent = CompassAgent()
+        self.nango_secret = get_setting("NANGO_SECRET_KEY")
+        self.nango = NangoClient(self.nango_secret)
+        self.deepseek = get_deepseek_service()
+        self.agent = get_compass_agent()
         self.db = db_session
 
-    async def sync_slack_messages(self, connection_id: str):
+    async def sync_slack_messages(self, connection_id: str, model: str = "slack-messages"):
         """
-        Sync messages from Slack via Nango.
+        Sync messages from Slack via Nango, streaming records page by page and
+        only asking for records modified since the stored watermark.
         """
-        # 1. Fetch data from Nango (Slack integration)
-        async with httpx.AsyncClient() as client:
-            # CORRECT V2 ENDPOINT: /records?model={sync_id}&connection_id={cid}
-            url = f"https://api.nango.dev/records?model=slack-messages&connection_id={connection_id}"
-            response = await client.get(
-                url,
-                headers={
-                    "Authorization": f"Bearer {self.nango_secret}",
-                    "Accept": "application/json"
-                }
-            )
-            
-            if response.status_code != 200:
-                return {"status": "error", "code": response.status_code, "text": response.text[:200]}
-                
-            try:
-                data = response.json()
-            except Exception:
-                return {"status": "error", "message": "Invalid JSON from Nango"}
-                
-            records = data.get("records", [])
+        watermark = RecordWatermark(self.db, connection_id, model)
+        total_records = processed = threads = 0
+        try:
+            async for records in self.nango.iter_record_pages(connection_id, model, "v2", modified_after=watermark.modified_after):
+                total_records += len(records)
+                watermark.observe(records)
+                page_processed, page_threads = await self._process_records(records)
+                processed += page_processed
+                threads += page_threads
+        except NangoError as e:
+            return {"status": "error", "message": str(e)}
+
+        watermark.save()
+        self.db.commit()
+        return {"status": "success", "processed_records": processed, "threads": threads, "fetched_records": total_records}
 
-        # 2. Process records into threads and messages
+    async def _process_records(self, records: List[Dict[str, Any]]):
+        """
+        Store one page of Slack records and run the agent on the new messages.
+        Returns (new_messages, threads_summarized).
+        """
+        # Process records into threads and messages, oldest first
+        records.sort(key=lambda r: float(r.get("ts") or 0))
+        thread_rows, message_rows, parsed = [], [], []
         for record in records:
             # Slack uses channel ID + ts as thread reference usually
             channel_id = record.get("channel_id")
             thread_ts = record.get("thread_ts") or record.get("ts")
             thread_id = f"SLACK-{channel_id}-{thread_ts}"
             message_body = record.get("text")
+            # channel + ts uniquely identifies a Slack message when Nango omits an id
+            msg_id = record.get("id") or f"SLACK-{channel_id}-{record.get('ts')}"
             
-            # 3. Check if thread exists, else create
-            thread = self.db.query(Thread).filter(Thread.id == thread_id).first()
-            if not thread:
-                thread = Thread(id=thread_id, title=f"Slack Thread: {channel_id}")
-                self.db.add(thread)
-            
-            # 4. Trigger Agent (Summarization + Identity + Actions)
+            thread_rows.append({"id": thread_id, "title": f"Slack Thread: {channel_id}", "last_updated": datetime.utcnow()})
+            message_rows.append({
+                "id": msg_id,
+                "thread_id": thread_id,
+                "source": "slack",
+                "raw_content": message_body,
+                "timestamp": datetime.fromtimestamp(float(record.get("ts")))
+            })
             sender_info = {
                 "slack_id": record.get("user_id"),
                 "name": record.get("user_name")
             }
-            
-            await self.agent.run(
-                thread_id=thread_id,
-                message=message_body,
-                current_summary=thread.rolling_summary or {},
-                sender_info=sender_info
-            )
-            
-            # 5. Save message
-            msg = Message(
-                id=record.get("id"),
-                thread_id=thread_id,
-                source="slack",
-                raw_content=message_body,
-                timestamp=datetime.fromtimestamp(float(record.get("ts")))
-            )
-            self.db.add(msg)
+            parsed.append((msg_id, thread_id, message_body, sender_info))
+
+        # Upsert threads and messages in batches; re-delivered messages are skipped instead of raising
+        bulk_upsert_threads(self.db, thread_rows)
+        inserted_ids = bulk_insert_messages(self.db, message_rows)
+        threads = load_threads(self.db, [row["id"] for row in thread_rows])
         
+        # Queue new messages for the agent (Summarization + Identity + Actions), one run per thread
+        batches: Dict[str, ThreadBatch] = {}
+        for msg_id, thread_id, message_body, sender_info in parsed:
+            if msg_id in inserted_ids:
+                queue_message(batches, thread_id, message_body, threads[thread_id].rolling_summary or {}, sender_info, msg_id)
+        # Plus messages whose summarization failed in an earlier sync
+        queue_unsummarized(self.db, batches)
         self.db.commit()
-        return {"status": "success", "processed_records": len(records)}
+
+        # Threads are committed first so the agent's summary writes can see them
+        await self.agent.run_threads(batches)
+        await embed_synced_content(self.db, inserted_ids, batches.keys())
+        return len(inserted_ids), len(batches)
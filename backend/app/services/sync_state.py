@@ -0,0 +1,38 @@
+"""
+Checkpoint storage for incremental syncs.
+One row per (provider, connection_id, resource) in the sync_state table.
+"""
+from datetime import datetime
+from typing import Optional, Dict, Any
+from sqlalchemy.orm import Session
+from app.models import SyncState
+
+
+def get_sync_state(db: Session, provider: str, connection_id: str, resource: str) -> Optional[SyncState]:
+    """Return the stored checkpoint, or None if this resource has never been synced"""
+    return db.query(SyncState).filter(
+        SyncState.provider == provider,
+        SyncState.connection_id == connection_id,
+        SyncState.resource == resource
+    ).first()
+
+
+def save_sync_state(db: Session, provider: str, connection_id: str, resource: str,
+                    cursor: Optional[str] = None, state: Optional[Dict[str, Any]] = None) -> SyncState:
+    """Create or update a checkpoint. The caller owns the commit."""
+    record = get_sync_state(db, provider, connection_id, resource)
+    if not record:
+        record = SyncState(provider=provider, connection_id=connection_id, resource=resource)
+        db.add(record)
+    record.cursor = cursor
+    if state is not None:
+        record.state = state
+    record.updated_at = datetime.utcnow()
+    return record
+
+
+def clear_sync_state(db: Session, provider: str, connection_id: str, resource: str):
+    """Drop a checkpoint so the next sync starts from scratch. The caller owns the commit."""
+    record = get_sync_state(db, provider, connection_id, resource)
+    if record:
+        db.delete(record)
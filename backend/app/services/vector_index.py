@@ -0,0 +1,221 @@
+"""
+Managed pgvector indexes for the summary/message/meeting vector columns.
+
+HNSW is the default: it needs no training data, so it can be built on an empty
+table and stays accurate as rows arrive. ivfflat is still available; its
+`lists` is sized from the current row count (rows / 1000, or sqrt(rows) past
+one million) and it is only built once a table holds enough rows to train on.
+The operator class always follows VECTOR_METRIC, and search uses the matching
+distance operator. Rebuilds create the new index under a temporary name and
+swap it in, so search never runs without an index.
+
+The full-text GIN indexes used by app.services.search are built the same way
+(CONCURRENTLY, off the startup path) by ensure_fts_indexes.
+"""
+import os
+import math
+import time
+import logging
+from typing import Dict, Any, List, Optional, Iterable
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+VECTOR_INDEX_METHOD = os.getenv("VECTOR_INDEX_METHOD", "hnsw")  # 'hnsw' or 'ivfflat'
+VECTOR_METRIC = os.getenv("VECTOR_METRIC", "l2")  # 'l2', 'cosine' or 'ip'
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "64"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "40"))
+IVFFLAT_MIN_ROWS = int(os.getenv("IVFFLAT_MIN_ROWS", "1000"))
+
+# metric -> (operator class, SQL operator, pgvector.sqlalchemy comparator)
+DISTANCE_METRICS = {
+    "l2": ("vector_l2_ops", "<->", "l2_distance"),
+    "cosine": ("vector_cosine_ops", "<=>", "cosine_distance"),
+    "ip": ("vector_ip_ops", "<#>", "max_inner_product"),
+}
+
+# table -> vector column
+VECTOR_COLUMNS = {
+    "threads": "summary_vector",
+    "messages": "message_vector",
+    "meetings": "meeting_vector",
+}
+
+# Full-text GIN indexes; the expressions must match the search documents in app.services.search
+FTS_INDEXES = {
+    "threads": "to_tsvector('english'::regconfig, coalesce(title, '') || ' ' || coalesce(rolling_summary ->> 'strategic_context', ''))",
+    "messages": "to_tsvector('english'::regconfig, coalesce(cleaned_content, raw_content, ''))",
+    "meetings": "to_tsvector('english'::regconfig, coalesce(title, '') || ' ' || coalesce(transcript, ''))",
+}
+
+def index_name(table: str) -> str:
+    return f"{table}_vector_idx"
+
+def distance_comparator(column, metric: str = VECTOR_METRIC):
+    """Bound pgvector distance function for a column, e.g. Thread.summary_vector.l2_distance."""
+    return getattr(column, DISTANCE_METRICS[metric][2])
+
+def ivfflat_lists(rows: int) -> int:
+    """pgvector's sizing guidance: rows / 1000 up to 1M rows, sqrt(rows) beyond."""
+    if rows <= 1_000_000:
+        return max(1, rows // 1000)
+    return int(math.sqrt(rows))
+
+def ivfflat_probes(lists: int) -> int:
+    """A starting point for ivfflat.probes; raise it for recall, lower it for speed."""
+    return max(1, int(math.sqrt(lists)))
+
+def index_ddl(table: str, method: str = VECTOR_INDEX_METHOD, metric: str = VECTOR_METRIC, rows: int = 0,
+              name: Optional[str] = None) -> Optional[str]:
+    """CREATE INDEX statement for a table, or None when ivfflat has too few rows to train on."""
+    column = VECTOR_COLUMNS[table]
+    opclass = DISTANCE_METRICS[metric][0]
+    if method == "hnsw":
+        params = f"m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION}"
+    elif method == "ivfflat":
+        if rows < IVFFLAT_MIN_ROWS:
+            return None
+        params = f"lists = {ivfflat_lists(rows)}"
+    else:
+        raise ValueError(f"Unknown vector index method: {method}")
+    return (f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name or index_name(table)} "
+            f"ON {table} USING {method} ({column} {opclass}) WITH ({params})")
+
+def _row_count(conn, table: str) -> int:
+    column = VECTOR_COLUMNS[table]
+    return conn.execute(text(f"SELECT count(*) FROM {table} WHERE {column} IS NOT NULL")).scalar() or 0
+
+def index_status(engine: Engine, tables: Iterable[str] = VECTOR_COLUMNS) -> Dict[str, Any]:
+    """Current definition and size of each vector index, plus the rows it covers."""
+    status = {}
+    with engine.connect() as conn:
+        for table in tables:
+            row = conn.execute(text(
+                "SELECT indexdef, pg_size_pretty(pg_relation_size(indexname::regclass)) AS size "
+                "FROM pg_indexes WHERE tablename = :table AND indexname = :name"
+            ), {"table": table, "name": index_name(table)}).first()
+            status[table] = {
+                "index": row.indexdef if row else None,
+                "size": row.size if row else None,
+                "rows": _row_count(conn, table)
+            }
+    return status
+
+def ensure_vector_indexes(engine: Engine, method: str = VECTOR_INDEX_METHOD, metric: str = VECTOR_METRIC,
+                          tables: Iterable[str] = VECTOR_COLUMNS, rebuild: bool = False) -> Dict[str, str]:
+    """
+    Create missing vector indexes. With rebuild, replace them, e.g. after a bulk
+    load (ivfflat lists are re-sized) or to switch method/metric: the new index is
+    built as <name>_new, then the old one is dropped and the new one renamed, so
+    the old index keeps serving queries for the whole build. Indexes are built
+    and dropped CONCURRENTLY so writes are not blocked.
+    """
+    results = {}
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for table in tables:
+            rows = _row_count(conn, table)
+            ddl = index_ddl(table, method, metric, rows)
+            if ddl is None:
+                results[table] = f"skipped ({rows} rows < IVFFLAT_MIN_ROWS)"
+                continue
+            started = time.perf_counter()
+            if rebuild:
+                name, staging = index_name(table), f"{index_name(table)}_new"
+                # Leftover (possibly INVALID) index from an interrupted rebuild
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {staging}"))
+                conn.execute(text(index_ddl(table, method, metric, rows, name=staging)))
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+                conn.execute(text(f"ALTER INDEX {staging} RENAME TO {name}"))
+            else:
+                conn.execute(text(ddl))
+            results[table] = f"ok ({rows} rows, {time.perf_counter() - started:.1f}s)"
+            logger.info(f"[Compass] Vector index {index_name(table)}: {results[table]}")
+    return results
+
+def fts_index_name(table: str) -> str:
+    return f"{table}_fts_idx"
+
+def ensure_fts_indexes(engine: Engine, tables: Iterable[str] = FTS_INDEXES) -> Dict[str, str]:
+    """
+    Create missing full-text indexes CONCURRENTLY so writes are not blocked.
+    An INVALID index left by an interrupted build is dropped and built again.
+    """
+    results = {}
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for table in tables:
+            name = fts_index_name(table)
+            valid = conn.execute(text(
+                "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+            ), {"name": name}).scalar()
+            if valid:
+                results[table] = "exists"
+                continue
+            started = time.perf_counter()
+            if valid is not None:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+            conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} USING gin ({FTS_INDEXES[table]})"))
+            results[table] = f"ok ({time.perf_counter() - started:.1f}s)"
+            logger.info(f"[Compass] Full-text index {name}: {results[table]}")
+    return results
+
+def _search_settings(conn, ef_search: Optional[int], probes: Optional[int]):
+    conn.execute(text("SELECT set_config('hnsw.ef_search', :v, true)"), {"v": str(ef_search or HNSW_EF_SEARCH)})
+    if probes:
+        conn.execute(text("SELECT set_config('ivfflat.probes', :v, true)"), {"v": str(probes)})
+
+def benchmark(engine: Engine, table: str, queries: int = 50, k: int = 10, metric: str = VECTOR_METRIC,
+              ef_search: Optional[int] = None, probes: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Recall@k and latency of the ANN index against exact (sequential) search,
+    using vectors sampled from the table itself as queries.
+    """
+    column = VECTOR_COLUMNS[table]
+    operator = DISTANCE_METRICS[metric][1]
+    search_sql = text(
+        f"SELECT id FROM {table} WHERE {column} IS NOT NULL "
+        f"ORDER BY {column} {operator} CAST(:q AS vector) LIMIT :k"
+    )
+
+    with engine.connect() as conn:
+        samples = [row[0] for row in conn.execute(text(
+            f"SELECT {column}::text FROM {table} WHERE {column} IS NOT NULL ORDER BY random() LIMIT :n"
+        ), {"n": queries})]
+        conn.rollback()
+
+        recalls: List[float] = []
+        ann_ms: List[float] = []
+        exact_ms: List[float] = []
+        for sample in samples:
+            with conn.begin():
+                conn.execute(text("SET LOCAL enable_indexscan = off"))
+                conn.execute(text("SET LOCAL enable_bitmapscan = off"))
+                started = time.perf_counter()
+                exact = {row[0] for row in conn.execute(search_sql, {"q": sample, "k": k})}
+                exact_ms.append((time.perf_counter() - started) * 1000)
+
+            with conn.begin():
+                _search_settings(conn, ef_search, probes)
+                started = time.perf_counter()
+                approx = {row[0] for row in conn.execute(search_sql, {"q": sample, "k": k})}
+                ann_ms.append((time.perf_counter() - started) * 1000)
+
+            recalls.append(len(exact & approx) / len(exact) if exact else 1.0)
+
+    def percentile(values: List[float], p: float) -> Optional[float]:
+        if not values:
+            return None
+        ordered = sorted(values)
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 2)
+
+    return {
+        "table": table,
+        "queries": len(samples),
+        "k": k,
+        "recall": round(sum(recalls) / len(recalls), 4) if recalls else None,
+        "ann_ms_p50": percentile(ann_ms, 0.5),
+        "ann_ms_p95": percentile(ann_ms, 0.95),
+        "exact_ms_p50": percentile(exact_ms, 0.5),
+        "exact_ms_p95": percentile(exact_ms, 0.95),
+    }
@@ -0,0 +1,60 @@
+"""
+Connection pool instrumentation for the shared SQLAlchemy engine.
+Checkout wait, timeouts and saturation are published through app.utils.metrics
+as db.pool.* (sync engine) and db.async_pool.* (async engine); pool_status()
+backs GET /health/db.
+"""
+import time
+from typing import Dict, Any
+from sqlalchemy import exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from app.utils import metrics
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that times every checkout and reports how full the pool is."""
+    metric_prefix = "db.pool"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            metrics.increment(f"{self.metric_prefix}.timeouts")
+            raise
+        finally:
+            metrics.observe(f"{self.metric_prefix}.checkout_wait_ms", (time.perf_counter() - started) * 1000)
+            self._report()
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        self._report()
+
+    def capacity(self) -> int:
+        # max_overflow < 0 means unbounded; report against the steady-state size then
+        return self.size() + max(self._max_overflow, 0)
+
+    def _report(self):
+        checked_out = self.checkedout()
+        metrics.set_gauge(f"{self.metric_prefix}.checked_out", checked_out)
+        metrics.set_gauge(f"{self.metric_prefix}.saturation", round(checked_out / self.capacity(), 3) if self.capacity() else 0.0)
+
+class InstrumentedAsyncQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    """Same instrumentation for the asyncpg engine, reported as db.async_pool.*"""
+    metric_prefix = "db.async_pool"
+
+def pool_status(engine: Engine) -> Dict[str, Any]:
+    pool = engine.pool
+    status: Dict[str, Any] = {"class": type(pool).__name__, "pre_ping": pool._pre_ping, "recycle": pool._recycle}
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        status.update({
+            "size": pool.size(),
+            "max_overflow": pool._max_overflow,
+            "timeout": pool.timeout(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "saturation": round(pool.checkedout() / capacity, 3) if capacity else 0.0,
+        })
+    return status
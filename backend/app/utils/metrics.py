@@ -0,0 +1,53 @@
+"""
+Minimal in-process metrics registry.
+Counters, gauges and timing summaries, exposed as JSON via GET /metrics.
+"""
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Any
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = defaultdict(float)
+_gauges: Dict[str, float] = {}
+_summaries: Dict[str, Dict[str, float]] = {}
+
+def increment(name: str, value: float = 1.0):
+    """Add to a monotonically increasing counter."""
+    with _lock:
+        _counters[name] += value
+
+def set_gauge(name: str, value: float):
+    """Record the current value of something that goes up and down."""
+    with _lock:
+        _gauges[name] = value
+
+def observe(name: str, value: float):
+    """Record one sample (e.g. a latency in ms) into a count/sum/min/max summary."""
+    with _lock:
+        summary = _summaries.get(name)
+        if summary is None:
+            _summaries[name] = {"count": 1, "sum": value, "min": value, "max": value, "last": value}
+            return
+        summary["count"] += 1
+        summary["sum"] += value
+        summary["min"] = min(summary["min"], value)
+        summary["max"] = max(summary["max"], value)
+        summary["last"] = value
+
+@contextmanager
+def timer(name: str):
+    """Observe the wall-clock duration of a block in milliseconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, (time.perf_counter() - start) * 1000)
+
+def snapshot() -> Dict[str, Any]:
+    with _lock:
+        summaries = {
+            name: {**s, "avg": s["sum"] / s["count"]} for name, s in _summaries.items()
+        }
+        return {"counters": dict(_counters), "gauges": dict(_gauges), "summaries": summaries}
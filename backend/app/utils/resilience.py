@@ -1,4 +1,5 @@
 import asyncio
+import httpx
 import functools
 import random
 from typing import Callable, Any
@@ -24,3 +25,31 @@ def retry_with_backoff(max_retries: int = 3, base_delay: float = 1.0):
         return wrapper
     return decorator
 
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+async def request_with_retry(client, method: str, url: str, max_retries: int = 3, base_delay: float = 1.0, **kwargs):
+    """
+    Issue an httpx request, retrying transport errors and 429/5xx responses.
+    Honours a numeric Retry-After header when the upstream sends one.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            if attempt >= max_retries:
+                raise
+            delay = base_delay * (2 ** attempt) + random.uniform(0, 0.5)
+            print(f"Retrying {method} {url} in {delay:.2f}s (Attempt {attempt}/{max_retries}). Error: {e}")
+            await asyncio.sleep(delay)
+            continue
+
+        if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= max_retries:
+            return response
+
+        retry_after = response.headers.get("retry-after", "")
+        delay = float(retry_after) if retry_after.isdigit() else base_delay * (2 ** attempt) + random.uniform(0, 0.5)
+        print(f"Retrying {method} {url} in {delay:.2f}s (Attempt {attempt}/{max_retries}). Status: {response.status_code}")
+        await asyncio.sleep(delay)
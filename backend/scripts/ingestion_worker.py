@@ -0,0 +1,19 @@
+import os
+import sys
+import asyncio
+import logging
+# Add app to path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from app.services.ingestion_queue import IngestionWorkerPool, INGESTION_WORKERS
+
+def main():
+    """
+    Standalone ingestion worker process. Run as many of these as needed;
+    jobs are claimed with SKIP LOCKED so workers never process the same event twice.
+    """
+    logging.basicConfig(level=logging.INFO)
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else max(INGESTION_WORKERS, 1)
+    asyncio.run(IngestionWorkerPool(concurrency).run_forever())
+
+if __name__ == "__main__":
+    main()
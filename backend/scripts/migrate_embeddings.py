@@ -1,34 +1,41 @@
 import os
 import sys
+import asyncio
+import argparse
 from sqlalchemy.orm import Session
 # Add app to path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from app.models import get_db_engine, Thread, Message, Meeting
-from app.services.deepseek import DeepSeekService
+from app.models import get_db_engine
+from app.services.embeddings import EmbeddingPipeline, EMBED_TARGETS, EMBEDDING_BATCH_SIZE, HashEmbedder, get_embedder
+from app.services.registry import get_deepseek_service
 
-def migrate_embeddings():
+async def migrate_embeddings(tables, batch_size: int, limit: int = None, backend: str = None):
     """
-    Migration script to re-index all pgvector data using the local embedding model.
+    Backfill pgvector columns for rows that have no embedding yet.
+    Progress is committed per batch, so re-running resumes where it stopped.
     """
     engine = get_db_engine()
-    ds = DeepSeekService()
-    
+    if backend == "hash":
+        embedder = HashEmbedder()
+    elif backend == "llm":
+        # Explicit, so --backend llm wins over EMBEDDING_BACKEND=hash
+        embedder = get_deepseek_service()
+    else:
+        embedder = get_embedder()
+
     with Session(engine) as session:
-        print("Migrating Threads...")
-        threads = session.query(Thread).all()
-        for thread in threads:
-            # text_to_embed = thread.rolling_summary.get("strategic_context", "")
-            # thread.summary_vector = ds.get_embedding(text_to_embed)
-            pass
-            
-        print("Migrating Messages...")
-        # ... similar for messages and meetings ...
-        
-        session.commit()
+        pipeline = EmbeddingPipeline(session, embedder=embedder, batch_size=batch_size)
+        for table in tables:
+            print(f"Embedding {table}...")
+            written = await pipeline.embed_pending(table, limit=limit)
+            print(f"  {written} rows embedded")
         print("Migration complete.")
 
 if __name__ == "__main__":
-    # migrate_embeddings()
-    pass
-
-
+    parser = argparse.ArgumentParser(description="Backfill pgvector embeddings")
+    parser.add_argument("--tables", nargs="+", choices=list(EMBED_TARGETS), default=list(EMBED_TARGETS))
+    parser.add_argument("--batch-size", type=int, default=EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--limit", type=int, default=None, help="Stop after this many rows per table")
+    parser.add_argument("--backend", choices=["llm", "hash"], default=None, help="Override EMBEDDING_BACKEND")
+    args = parser.parse_args()
+    asyncio.run(migrate_embeddings(args.tables, args.batch_size, args.limit, args.backend))
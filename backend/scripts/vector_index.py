@@ -0,0 +1,88 @@
+import os
+import sys
+import json
+import argparse
+# Add app to path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from app.models import get_db_engine
+from app.services.vector_index import (
+    VECTOR_COLUMNS, DISTANCE_METRICS, VECTOR_INDEX_METHOD, VECTOR_METRIC, HNSW_EF_SEARCH,
+    FTS_INDEXES, index_status, ensure_vector_indexes, ensure_fts_indexes, benchmark, ivfflat_lists, ivfflat_probes
+)
+
+def status(args):
+    print(json.dumps(index_status(get_db_engine(), args.tables), indent=2))
+
+def rebuild(args):
+    """Rebuild (swapped in when ready), e.g. after a bulk backfill or to change method/metric."""
+    results = ensure_vector_indexes(get_db_engine(), args.method, args.metric, args.tables, rebuild=not args.missing_only)
+    for table, result in results.items():
+        print(f"{table}: {result}")
+    if args.metric != VECTOR_METRIC:
+        print(f"Set VECTOR_METRIC={args.metric} so search uses the matching operator.")
+
+def fts(args):
+    """Create missing full-text indexes used by semantic search."""
+    for table, result in ensure_fts_indexes(get_db_engine(), [t for t in args.tables if t in FTS_INDEXES]).items():
+        print(f"{table}: {result}")
+
+def tune(args):
+    """
+    Sweep ef_search (HNSW) or probes (ivfflat) and report recall/latency for each
+    value, so the smallest setting that meets --target-recall can be configured.
+    """
+    engine = get_db_engine()
+    for table in args.tables:
+        if args.method == "ivfflat":
+            rows = index_status(engine, [table])[table]["rows"]
+            base = ivfflat_probes(ivfflat_lists(rows))
+            settings = sorted({base, base * 2, base * 4, base * 8})
+        else:
+            settings = [HNSW_EF_SEARCH, 64, 100, 200, 400]
+
+        chosen = None
+        for value in settings:
+            kwargs = {"probes": value} if args.method == "ivfflat" else {"ef_search": value}
+            result = benchmark(engine, table, args.queries, args.k, args.metric, **kwargs)
+            print(json.dumps({**result, **kwargs}))
+            if chosen is None and result["recall"] is not None and result["recall"] >= args.target_recall:
+                chosen = value
+        setting = "SEARCH_IVFFLAT_PROBES" if args.method == "ivfflat" else "HNSW_EF_SEARCH"
+        print(f"{table}: {setting}={chosen}" if chosen else f"{table}: no setting reached recall {args.target_recall}")
+
+def bench(args):
+    engine = get_db_engine()
+    for table in args.tables:
+        print(json.dumps(benchmark(engine, table, args.queries, args.k, args.metric, args.ef_search, args.probes)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage pgvector indexes")
+    parser.add_argument("--tables", nargs="+", choices=list(VECTOR_COLUMNS), default=list(VECTOR_COLUMNS))
+    parser.add_argument("--metric", choices=list(DISTANCE_METRICS), default=VECTOR_METRIC)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("status", help="Show index definitions and row counts").set_defaults(func=status)
+
+    rebuild_parser = commands.add_parser("rebuild", help="Rebuild indexes (CONCURRENTLY)")
+    rebuild_parser.add_argument("--method", choices=["hnsw", "ivfflat"], default=VECTOR_INDEX_METHOD)
+    rebuild_parser.add_argument("--missing-only", action="store_true", help="Only create indexes that do not exist")
+    rebuild_parser.set_defaults(func=rebuild)
+
+    commands.add_parser("fts", help="Create missing full-text indexes (CONCURRENTLY)").set_defaults(func=fts)
+
+    tune_parser = commands.add_parser("tune", help="Sweep search settings against exact search")
+    tune_parser.add_argument("--method", choices=["hnsw", "ivfflat"], default=VECTOR_INDEX_METHOD)
+    tune_parser.add_argument("--target-recall", type=float, default=0.95)
+    tune_parser.add_argument("--queries", type=int, default=50)
+    tune_parser.add_argument("--k", type=int, default=10)
+    tune_parser.set_defaults(func=tune)
+
+    bench_parser = commands.add_parser("benchmark", help="Recall@k and latency vs exact search")
+    bench_parser.add_argument("--queries", type=int, default=50)
+    bench_parser.add_argument("--k", type=int, default=10)
+    bench_parser.add_argument("--ef-search", type=int, default=None)
+    bench_parser.add_argument("--probes", type=int, default=None)
+    bench_parser.set_defaults(func=bench)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -116,8 +116,8 @@ function SettingsContent() {
   const syncGmail = async () => {
     try {
       const res = await fetch('/api/gmail/sync', { method: 'POST' });
-      const data = await res.json();
-      alert(`✅ Synced ${data.processed} new emails!`);
+      if (!res.ok) throw new Error(`HTTP ${res.status}`);
+      alert('✅ Gmail sync queued. New emails will appear shortly.');
     } catch (err: any) {
       alert(`❌ Sync failed: ${err.message}`);
     }
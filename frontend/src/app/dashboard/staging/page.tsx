@@ -41,8 +41,7 @@ export default function StagingArea() {
     try {
       const res = await fetch('/api/gmail/sync', { method: 'POST' });
       if (res.ok) {
-        const data = await res.json();
-        alert(`✅ Synced ${data.processed} new emails!`);
+        alert('✅ Gmail sync queued. New emails will appear shortly.');
       }
       await fetchActions();
     } catch (err) {
@@ -0,0 +1,96 @@
+import os
+import asyncio
+import threading
+import httpx
+
+ADVICE_QUEUE_SIZE = int(os.getenv("ADVICE_QUEUE_SIZE", "1"))
+ADVICE_HTTP2 = os.getenv("ADVICE_HTTP2", "true").lower() == "true"
+
+class AdviceClient:
+    """
+    Streams positioning advice from POST /meeting/positioning on a dedicated
+    asyncio thread with one long-lived keep-alive client (HTTP/2 when the API is
+    served over TLS), so the audio thread never waits on the network.
+
+    submit() is safe to call from any thread and never blocks. Segments wait in a
+    bounded queue; when it is full the oldest waiting segment is superseded by
+    the newest, so advice always tracks what was said most recently.
+    """
+    def __init__(self, api_url, on_advice, queue_size=ADVICE_QUEUE_SIZE):
+        self.api_url = api_url
+        self.on_advice = on_advice  # on_advice(text, is_conflict), called from the client thread
+        self.queue_size = queue_size
+        self.superseded = 0
+        self._loop = None
+        self._queue = None
+        self._client = None
+        self._worker = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="advice-client", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(timeout=5)
+        self._thread.join(timeout=5)
+
+    def submit(self, text):
+        """Queue a transcript segment for advice (non-blocking, any thread)."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._enqueue, text)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._client = httpx.AsyncClient(
+            http2=ADVICE_HTTP2,
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            limits=httpx.Limits(max_keepalive_connections=2, keepalive_expiry=300)
+        )
+        self._worker = self._loop.create_task(self._consume())
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    def _enqueue(self, text):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.superseded += 1
+        self._queue.put_nowait(text)
+
+    async def _consume(self):
+        while True:
+            text = await self._queue.get()
+            try:
+                await self.get_positioning_advice(text)
+            except Exception as e:
+                print(f"Error getting streaming advice: {e}")
+
+    async def get_positioning_advice(self, text):
+        """
+        Listen to SSE stream for word-by-word updates.
+        Handles [CONFLICT] signal for playbook violations.
+        """
+        async with self._client.stream("POST", f"{self.api_url}/meeting/positioning", json={"text": text}) as response:
+            current_advice = ""
+            is_conflict = False
+            async for line in response.aiter_lines():
+                if line.startswith("data: "):
+                    token = line[6:].strip()
+                    if token == "[DONE]":
+                        break
+                    if token == "[CONFLICT]":
+                        is_conflict = True
+                        continue
+                    current_advice += " " + token
+                    self.on_advice(current_advice.strip(), is_conflict)
+
+    async def _shutdown(self):
+        self._worker.cancel()
+        await self._client.aclose()
+        self._loop.call_soon(self._loop.stop)
@@ -0,0 +1,472 @@
+"""
+Three-stage audio pipeline for the meeting bot.
+
+    capture thread --(chunk queue)--> VAD thread --(utterance queue)--> transcription workers
+
+Capture only reads the source and never waits on later stages: when the VAD
+stage falls behind a live source, the oldest queued chunks are dropped and
+counted (file replays block instead). The VAD stage runs Silero's streaming
+VADIterator once per 512-sample chunk (model state carries over between
+chunks) and cuts utterances at the end of speech. The utterance queue is
+bounded, so a slow transcriber backs up into the VAD stage rather than growing
+memory. Transcripts are delivered in utterance order even with several
+workers.
+
+In streaming mode (the default) an utterance is also transcribed while it is
+still being spoken: every PARTIAL_INTERVAL_SECONDS the audio since the last
+committed point, at most about PARTIAL_WINDOW_SECONDS, is transcribed with a
+cheap PARTIAL_BEAM_SIZE. Segments ending before the last
+PARTIAL_OVERLAP_SECONDS are committed and the window moves past them; the
+overlap is re-transcribed next time, so words cut at the window edge settle.
+Provisional text goes to on_partial. When VAD detects silence only the
+uncommitted tail is transcribed, with the full WHISPER_BEAM_SIZE, so the final
+text no longer costs a pass over the whole utterance.
+
+Audio lives in preallocated float32 AudioBuffers, one per utterance in flight,
+drawn from a fixed pool: samples are converted from int16 straight into the
+buffer, and VAD chunks, partial snapshots and the final utterance are views of
+it, so an hour-long meeting allocates no per-sample objects and memory stays
+at the pool size. Utterances longer than MAX_UTTERANCE_SECONDS (Whisper's own
+30s window) are cut where the buffer fills.
+
+Sources are pluggable: PyAudioSource for the microphone, WavFileSource to feed
+a recording (16 kHz mono 16-bit), e.g.
+
+    python audio_pipeline.py meeting.wav
+"""
+import os
+import sys
+import time
+import wave
+import queue
+import threading
+import collections
+import numpy as np
+
+SAMPLE_RATE = 16000
+CHUNK_SAMPLES = 512  # What Silero VAD expects at 16 kHz
+PRE_ROLL_SAMPLES = 1600  # 100ms
+MIN_UTTERANCE_SAMPLES = SAMPLE_RATE  # 1s
+MAX_UTTERANCE_SECONDS = float(os.getenv("MAX_UTTERANCE_SECONDS", "30"))
+
+CAPTURE_QUEUE_CHUNKS = int(os.getenv("CAPTURE_QUEUE_CHUNKS", "256"))  # ~8s of audio
+UTTERANCE_QUEUE_SIZE = int(os.getenv("UTTERANCE_QUEUE_SIZE", "4"))
+TRANSCRIBE_WORKERS = int(os.getenv("TRANSCRIBE_WORKERS", "1"))
+WHISPER_BEAM_SIZE = int(os.getenv("WHISPER_BEAM_SIZE", "5"))
+VAD_THRESHOLD = float(os.getenv("VAD_THRESHOLD", "0.5"))
+VAD_MIN_SILENCE_MS = int(os.getenv("VAD_MIN_SILENCE_MS", "300"))
+
+STREAMING_TRANSCRIPTION = os.getenv("STREAMING_TRANSCRIPTION", "true").lower() == "true"
+PARTIAL_BEAM_SIZE = int(os.getenv("PARTIAL_BEAM_SIZE", "1"))
+PARTIAL_WINDOW_SECONDS = float(os.getenv("PARTIAL_WINDOW_SECONDS", "5"))
+PARTIAL_INTERVAL_SECONDS = float(os.getenv("PARTIAL_INTERVAL_SECONDS", "1"))
+PARTIAL_OVERLAP_SECONDS = float(os.getenv("PARTIAL_OVERLAP_SECONDS", "1"))
+
+_END = object()
+
+class StageStats:
+    """Thread-safe count/total/max for one latency measurement."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms):
+        with self._lock:
+            self.count += 1
+            self.total_ms += ms
+            self.max_ms = max(self.max_ms, ms)
+
+    def snapshot(self):
+        with self._lock:
+            avg = self.total_ms / self.count if self.count else 0.0
+            return {"count": self.count, "avg_ms": round(avg, 2), "max_ms": round(self.max_ms, 2)}
+
+class PipelineStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = collections.defaultdict(StageStats)
+        self.counters = collections.Counter()
+
+    def observe(self, name, ms):
+        self.timings[name].observe(ms)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return {"counters": counters, "timings": {name: s.snapshot() for name, s in list(self.timings.items())}}
+
+class PyAudioSource:
+    """Microphone input, 16 kHz mono int16."""
+    live = True  # Must be drained in real time; never block the reader
+    def __init__(self, rate=SAMPLE_RATE, chunk=CHUNK_SAMPLES):
+        import pyaudio
+        self.chunk = chunk
+        self._pa = pyaudio.PyAudio()
+        self._stream = self._pa.open(format=pyaudio.paInt16, channels=1, rate=rate,
+                                     input=True, frames_per_buffer=chunk)
+
+    def read(self):
+        data = self._stream.read(self.chunk, exception_on_overflow=False)
+        return np.frombuffer(data, np.int16)
+
+    def close(self):
+        self._stream.stop_stream()
+        self._stream.close()
+        self._pa.terminate()
+
+class WavFileSource:
+    """
+    Replays a 16 kHz mono 16-bit WAV file. With realtime=True chunks are paced
+    like a microphone; otherwise the file is read as fast as the pipeline allows.
+    """
+    def __init__(self, path, chunk=CHUNK_SAMPLES, realtime=False):
+        self.chunk = chunk
+        self.realtime = realtime
+        self.live = realtime  # Faster-than-realtime replays wait for the pipeline instead of dropping
+        self._wav = wave.open(path, "rb")
+        if (self._wav.getframerate(), self._wav.getnchannels(), self._wav.getsampwidth()) != (SAMPLE_RATE, 1, 2):
+            raise ValueError(f"{path}: expected 16 kHz mono 16-bit PCM")
+        self._next_at = time.monotonic()
+
+    def read(self):
+        data = self._wav.readframes(self.chunk)
+        if not data:
+            return None
+        samples = np.frombuffer(data, np.int16)
+        if len(samples) < self.chunk:
+            samples = np.pad(samples, (0, self.chunk - len(samples)))
+        if self.realtime:
+            self._next_at += self.chunk / SAMPLE_RATE
+            time.sleep(max(0.0, self._next_at - time.monotonic()))
+        return samples
+
+    def close(self):
+        self._wav.close()
+
+class AudioBuffer:
+    """
+    Preallocated float32 samples of one utterance and its pre-roll. Writes
+    only append, so views handed out stay valid until the buffer is released.
+    """
+    def __init__(self, capacity, pool=None):
+        self.data = np.zeros(capacity, np.float32)
+        self.start = 0
+        self.end = 0
+        self._pool = pool
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def free(self):
+        return len(self.data) - self.end
+
+    def write(self, samples):
+        """Append int16 samples as float32 in [-1, 1); returns a view of them."""
+        view = self.data[self.end:self.end + len(samples)]
+        np.copyto(view, samples, casting="unsafe")  # Converts in place, no temporary array
+        view *= 1 / 32768.0
+        self.end += len(samples)
+        return view
+
+    def view(self):
+        return self.data[self.start:self.end]
+
+    def keep_last(self, samples, room):
+        """Drop all but the last `samples` (pre-roll), keeping `room` free for the next write."""
+        self.start = max(self.start, self.end - samples)
+        if self.free < room:
+            kept = self.end - self.start
+            self.data[:kept] = self.data[self.start:self.end]
+            self.start, self.end = 0, kept
+
+    def reset(self):
+        self.start = self.end = 0
+
+    def release(self):
+        if self._pool is not None:
+            self._pool.release(self)
+
+class AudioBufferPool:
+    """Fixed set of AudioBuffers; acquire() blocks until one is released."""
+    def __init__(self, count, capacity):
+        self._free = queue.Queue()
+        for _ in range(count):
+            self._free.put(AudioBuffer(capacity, self))
+
+    def acquire(self):
+        buffer = self._free.get()
+        buffer.reset()
+        return buffer
+
+    def release(self, buffer):
+        self._free.put(buffer)
+
+class _Stream:
+    """Streaming state of one utterance, shared by its partial and final jobs."""
+    def __init__(self):
+        self.committed = []  # Settled segment texts
+        self.offset = 0  # Samples covered by `committed`
+        self.idle = threading.Event()  # No partial in flight
+        self.idle.set()
+
+    def prompt(self):
+        # Recent committed text keeps Whisper consistent across windows
+        return " ".join(self.committed)[-200:] or None
+
+def load_vad_iterator(threshold=VAD_THRESHOLD, min_silence_ms=VAD_MIN_SILENCE_MS):
+    from silero_vad import load_silero_vad, VADIterator
+    return VADIterator(load_silero_vad(), threshold=threshold, sampling_rate=SAMPLE_RATE,
+                       min_silence_duration_ms=min_silence_ms)
+
+class AudioPipeline:
+    """
+    on_text(text) is called from a transcription worker with the final text,
+    in utterance order: once per utterance when streaming, once per non-empty
+    segment otherwise. on_partial(text) gets the provisional text of the
+    utterance currently being spoken. The transcriber needs a faster-whisper
+    style transcribe(audio, beam_size=..., initial_prompt=...) -> (segments, info).
+    """
+    def __init__(self, source, transcriber, on_text, vad_iterator=None,
+                 workers=TRANSCRIBE_WORKERS, beam_size=WHISPER_BEAM_SIZE,
+                 on_partial=None, streaming=STREAMING_TRANSCRIPTION,
+                 partial_beam_size=PARTIAL_BEAM_SIZE, window_seconds=PARTIAL_WINDOW_SECONDS,
+                 interval_seconds=PARTIAL_INTERVAL_SECONDS, overlap_seconds=PARTIAL_OVERLAP_SECONDS):
+        self.source = source
+        self.transcriber = transcriber
+        self.on_text = on_text
+        self.on_partial = on_partial
+        self.vad = vad_iterator or load_vad_iterator()
+        self.workers = max(1, workers)
+        self.beam_size = beam_size
+        self.streaming = streaming
+        self.partial_beam_size = partial_beam_size
+        self.window_samples = int(window_seconds * SAMPLE_RATE)
+        self.interval_samples = max(CHUNK_SAMPLES, int(interval_seconds * SAMPLE_RATE))
+        self.overlap_seconds = overlap_seconds
+        self.stats = PipelineStats()
+        # Queued utterances, one per worker and the one VAD is filling
+        self.buffers = AudioBufferPool(UTTERANCE_QUEUE_SIZE + self.workers + 1,
+                                       int(MAX_UTTERANCE_SECONDS * SAMPLE_RATE) + PRE_ROLL_SAMPLES)
+
+        self._chunks = queue.Queue(maxsize=CAPTURE_QUEUE_CHUNKS)
+        self._utterances = queue.Queue(maxsize=UTTERANCE_QUEUE_SIZE)
+        self._running = threading.Event()
+        self._threads = []
+
+        # In-order delivery across workers
+        self._emit_lock = threading.Condition()
+        self._next_emit = 0
+
+    def start(self):
+        self._running.set()
+        self._threads = [threading.Thread(target=self._capture, name="capture", daemon=True),
+                         threading.Thread(target=self._detect, name="vad", daemon=True)]
+        self._threads += [threading.Thread(target=self._transcribe, name=f"transcribe-{i}", daemon=True)
+                          for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stop capturing; utterances already cut are still transcribed."""
+        self._running.clear()
+
+    def join(self, timeout=None):
+        for thread in self._threads:
+            thread.join(timeout)
+
+    # Stage 1: capture
+    def _capture(self):
+        try:
+            while self._running.is_set():
+                samples = self.source.read()
+                if samples is None:
+                    break
+                if self.source.live:
+                    self._offer(self._chunks, (time.perf_counter(), samples))
+                else:
+                    self._chunks.put((time.perf_counter(), samples))
+                self.stats.increment("capture.chunks")
+        finally:
+            self.source.close()
+            self._chunks.put(_END)
+
+    def _offer(self, q, item):
+        """Put without blocking capture: drop the oldest chunk when the queue is full."""
+        while True:
+            try:
+                q.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                    self.stats.increment("capture.dropped_chunks")
+                except queue.Empty:
+                    pass
+
+    # Stage 2: VAD
+    def _detect(self):
+        import torch
+        buffer = self.buffers.acquire()
+        speaking = False
+        sequence = 0
+        stream = None
+        since_partial = 0
+
+        def cut():
+            nonlocal buffer, sequence, stream
+            if len(buffer) > MIN_UTTERANCE_SAMPLES:
+                # Blocks when transcription is behind: backpressure into the chunk queue
+                self._utterances.put((sequence, time.perf_counter(), buffer.view(), buffer, stream, True))
+                sequence += 1
+                buffer = self.buffers.acquire()
+            else:
+                self.stats.increment("vad.short_utterances")
+                buffer.reset()
+            stream = _Stream() if speaking and self.streaming else None
+
+        def partial():
+            # Never blocks VAD: skipped while the previous pass is still running
+            if len(buffer) <= MIN_UTTERANCE_SAMPLES or not stream.idle.is_set():
+                return False
+            stream.idle.clear()
+            try:
+                self._utterances.put_nowait((sequence, time.perf_counter(), buffer.view(), buffer, stream, False))
+                return True
+            except queue.Full:
+                stream.idle.set()
+                return False
+
+        while True:
+            item = self._chunks.get()
+            if item is _END:
+                break
+            captured_at, samples = item
+            self.stats.observe("capture.queue_wait_ms", (time.perf_counter() - captured_at) * 1000)
+            if speaking and buffer.free < len(samples):
+                # Utterance hit MAX_UTTERANCE_SECONDS: transcribe what we have, keep listening
+                self.stats.increment("vad.forced_cuts")
+                cut()
+            elif not speaking:
+                buffer.keep_last(PRE_ROLL_SAMPLES, len(samples))
+            chunk = buffer.write(samples)
+
+            started = time.perf_counter()
+            event = self.vad(torch.from_numpy(chunk))
+            self.stats.observe("vad.chunk_ms", (time.perf_counter() - started) * 1000)
+
+            if event and "start" in event and not speaking:
+                # The buffer already holds the pre-roll and this chunk
+                speaking = True
+                stream = _Stream() if self.streaming else None
+                since_partial = 0
+            if speaking:
+                since_partial += len(chunk)
+                if stream is not None and since_partial >= self.interval_samples:
+                    since_partial = 0
+                    if not partial():
+                        self.stats.increment("partial.skipped")
+            if event and "end" in event and speaking:
+                speaking = False
+                cut()
+
+        if speaking:
+            speaking = False
+            cut()
+        buffer.release()
+        self.vad.reset_states()
+        for _ in range(self.workers):
+            self._utterances.put(_END)
+
+    # Stage 3: transcription
+    def _transcribe(self):
+        while True:
+            item = self._utterances.get()
+            if item is _END:
+                break
+            sequence, cut_at, audio, buffer, stream, final = item
+            if not final:
+                self._partial(sequence, cut_at, audio, stream)
+                continue
+            started = time.perf_counter()
+            self.stats.observe("transcribe.queue_wait_ms", (started - cut_at) * 1000)
+            texts = []
+            try:
+                if stream is None:
+                    texts = self._segment_texts(self._run(audio, self.beam_size))
+                else:
+                    stream.idle.wait()
+                    tail = self._run(audio[stream.offset:], self.beam_size, stream.prompt())
+                    text = " ".join(stream.committed + self._segment_texts(tail))
+                    texts = [text] if text else []
+            except Exception as e:
+                self.stats.increment("transcribe.errors")
+                print(f"Transcription failed: {e}")
+            finally:
+                buffer.release()
+            self.stats.observe("transcribe.ms", (time.perf_counter() - started) * 1000)
+
+            with self._emit_lock:
+                self._emit_lock.wait_for(lambda: self._next_emit == sequence)
+                for text in texts:
+                    self.on_text(text)
+                self._next_emit += 1
+                self._emit_lock.notify_all()
+            # End of speech -> text delivered
+            self.stats.observe("utterance.latency_ms", (time.perf_counter() - cut_at) * 1000)
+
+    def _run(self, audio, beam_size, prompt=None):
+        segments, _ = self.transcriber.transcribe(audio, beam_size=beam_size, initial_prompt=prompt)
+        return list(segments)
+
+    @staticmethod
+    def _segment_texts(segments):
+        return [segment.text.strip() for segment in segments if segment.text.strip()]
+
+    def _partial(self, sequence, snapshot_at, audio, stream):
+        """One rolling-window pass: commit settled segments, report the rest as provisional."""
+        started = time.perf_counter()
+        try:
+            window = audio[stream.offset:]
+            segments = self._run(window, self.partial_beam_size, stream.prompt())
+            settled_before = len(window) / SAMPLE_RATE - self.overlap_seconds
+            settled = [segment for segment in segments if segment.end <= settled_before]
+            if not settled and len(window) >= self.window_samples and segments:
+                # One segment spans the whole window: commit up to its last boundary to keep windows bounded
+                settled = segments[:-1] or segments
+            if settled:
+                stream.committed += self._segment_texts(settled)
+                stream.offset += min(len(window), int(settled[-1].end * SAMPLE_RATE))
+            text = " ".join(stream.committed + self._segment_texts(segments[len(settled):]))
+        except Exception as e:
+            self.stats.increment("partial.errors")
+            print(f"Partial transcription failed: {e}")
+            text = ""
+        finally:
+            self.stats.observe("partial.ms", (time.perf_counter() - started) * 1000)
+            stream.idle.set()
+
+        if text and self.on_partial is not None:
+            with self._emit_lock:
+                # Earlier utterances still pending: their final text goes first
+                if self._next_emit != sequence:
+                    self.stats.increment("partial.out_of_order")
+                    return
+                self.on_partial(text)
+            # Audio snapshot -> provisional text delivered
+            self.stats.observe("partial.latency_ms", (time.perf_counter() - snapshot_at) * 1000)
+
+if __name__ == "__main__":
+    from faster_whisper import WhisperModel
+    model = WhisperModel(os.getenv("WHISPER_MODEL_PATH", "base"), device="cpu", compute_type="int8")
+    pipeline = AudioPipeline(WavFileSource(sys.argv[1]), model, on_text=print,
+                             on_partial=lambda text: print(f"... {text}"))
+    pipeline.start()
+    pipeline.join()
+    print(pipeline.stats.snapshot())
@@ -1,105 +1,67 @@
 import sys
-import threading
-import queue
-import numpy as np
-import pyaudio
 from PyQt6.QtWidgets import QApplication, QWidget, QLabel, QVBoxLayout
 from PyQt6.QtCore import Qt, pyqtSignal, QThread
 from faster_whisper import WhisperModel
-import httpx
 import json
 import os
 from dotenv import load_dotenv
+from advice_client import AdviceClient
+from audio_pipeline import AudioPipeline, PyAudioSource, load_vad_iterator
 
 load_dotenv()
 
 # Configuration
 WHISPER_MODEL = os.getenv("WHISPER_MODEL_PATH", "base")
 API_URL = os.getenv("NEXT_PUBLIC_API_URL", "http://localhost:8000")
-
-import torch
-import collections
+# Ask for advice on provisional text once it has grown by this many words
+ADVICE_PREFETCH_WORDS = int(os.getenv("ADVICE_PREFETCH_WORDS", "6"))
 
 class TranscriptionThread(QThread):
     new_text = pyqtSignal(str)
+    new_partial = pyqtSignal(str)
     new_advice = pyqtSignal(str)
 
     def __init__(self):
         super().__init__()
         self.model = WhisperModel(WHISPER_MODEL, device="cpu", compute_type="int8")
-        
-        # Silero VAD setup
-        self.vad_model, utils = torch.hub.load(repo_or_dir='snakers4/silero-vad',
-                                              model='silero_vad',
-                                              force_reload=False)
-        (self.get_speech_timestamps, _, _, _, _) = utils
-        
-        # Circular buffer for 100ms pre-roll (1600 samples at 16kHz)
-        self.pre_roll = collections.deque(maxlen=1600)
-        self.audio_queue = queue.Queue()
-        self.is_running = True
+        # Streaming Silero VAD; keeps its state across 512-sample chunks
+        self.vad = load_vad_iterator()
+        self.pipeline = None
+        self._prefetched = ""  # Last provisional text sent for advice in this utterance
 
-    def run(self):
-        p = pyaudio.PyAudio()
-        stream = p.open(format=pyaudio.paInt16,
-                        channels=1,
-                        rate=16000,
-                        input=True,
-                        frames_per_buffer=512) # Small buffer for low latency
+        # Network I/O lives on its own asyncio thread; capture only hands off text
+        self.advice = AdviceClient(API_URL, on_advice=self._emit_advice)
+
+    def _emit_advice(self, text, is_conflict):
+        # Qt queues cross-thread signal emissions to the GUI thread
+        self.new_advice.emit(json.dumps({"text": text, "is_conflict": is_conflict}))
 
+    def _on_partial(self, text):
+        self.new_partial.emit(text)
+        if len(text.split()) - len(self._prefetched.split()) >= ADVICE_PREFETCH_WORDS:
+            self._prefetched = text
+            self.advice.submit(text)
+
+    def _on_text(self, text):
+        self.new_text.emit(text)
+        # Advice for the final text is already on its way when the last prefetch matched it
+        if text != self._prefetched:
+            self.advice.submit(text)
+        self._prefetched = ""
+
+    def run(self):
+        self.advice.start()
+        # Capture, VAD and transcription each run on their own thread
+        self.pipeline = AudioPipeline(PyAudioSource(), self.model, on_text=self._on_text,
+                                      on_partial=self._on_partial, vad_iterator=self.vad)
         print("Listening with VAD and 100ms pre-roll...")
-        audio_buffer = []
-        is_speaking = False
-
-        while self.is_running:
-            data = stream.read(512)
-            audio_chunk = np.frombuffer(data, np.int16).astype(np.float32) / 32768.0
-            
-            # Add to pre-roll
-            self.pre_roll.extend(audio_chunk)
-            
-            # Check for speech using Silero VAD
-            speech_timestamps = self.get_speech_timestamps(torch.from_numpy(audio_chunk), self.vad_model, sampling_rate=16000)
-            
-            if speech_timestamps:
-                if not is_speaking:
-                    # Start of speech: include pre-roll
-                    audio_buffer.extend(list(self.pre_roll))
-                    is_speaking = True
-                audio_buffer.extend(audio_chunk)
-            elif is_speaking:
-                # End of speech: process buffer
-                is_speaking = False
-                if len(audio_buffer) > 16000: # Min 1s of audio
-                    segments, _ = self.model.transcribe(np.array(audio_buffer), beam_size=5)
-                    for segment in segments:
-                        text = segment.text.strip()
-                        if text:
-                            self.new_text.emit(text)
-                            self.get_positioning_advice(text)
-                audio_buffer = []
-
-    def get_positioning_advice(self, text):
-        """
-        Listen to SSE stream for character-by-character updates.
-        Handles [CONFLICT] signal for playbook violations.
-        """
-        try:
-            with httpx.stream("POST", f"{API_URL}/meeting/positioning", json={"text": text}, timeout=None) as response:
-                current_advice = ""
-                is_conflict = False
-                for line in response.iter_lines():
-                    if line.startswith("data: "):
-                        token = line[6:].strip()
-                        if token == "[DONE]":
-                            break
-                        if token == "[CONFLICT]":
-                            is_conflict = True
-                            continue
-                        current_advice += " " + token
-                        self.new_advice.emit(json.dumps({"text": current_advice.strip(), "is_conflict": is_conflict}))
-        except Exception as e:
-            print(f"Error getting streaming advice: {e}")
+        self.pipeline.start()
+        self.pipeline.join()
+        print(f"Audio pipeline stopped: {self.pipeline.stats.snapshot()}")
+
+    def stop(self):
+        if self.pipeline is not None:
+            self.pipeline.stop()
 
 class OverlayWindow(QWidget):
     # ... existing code ...
@@ -122,6 +84,8 @@ if __name__ == "__main__":
 
     thread = TranscriptionThread()
     thread.new_text.connect(overlay.update_transcript)
+    # Provisional text is shown in place and replaced by the final transcript
+    thread.new_partial.connect(overlay.update_transcript)
     thread.new_advice.connect(overlay.update_advice)
     thread.start()
 